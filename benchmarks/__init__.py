@@ -0,0 +1 @@
+"""Performance benchmarks. Run from the repository root, see `python -m benchmarks.scale --help`."""
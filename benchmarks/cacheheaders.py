@@ -0,0 +1,123 @@
+"""Micro-benchmark for computing the cache headers of a response, which is done
+for every response from the original, imageinfo, scale and planner routes.
+
+Cases:
+
+* `parse`: parsing a Cache-Control header without the memo.
+* `parse_cached`: memoized parsing, for a working set of header values.
+* `cache_headers_minimum`: cache_headers with a pre-parsed cache_control_minimum,
+  as configured tenants use it.
+* `cache_headers_minimum_str`: the same with the minimum given as a string.
+* `cache_headers_passthrough`: cache_headers without a minimum or override.
+
+Per-call latency percentiles are printed and written to a JSON report, which can
+be compared with an earlier one using --baseline.
+
+    python -m benchmarks.cacheheaders --output before.json
+"""
+
+import argparse
+import sys
+from typing import List
+
+import httpx
+
+from benchmarks.common import find_regressions, measure_calls, write_report
+from skipscale.utils import ParsedCacheControl, cache_headers, parse_cache_control
+
+KEY_FIELDS = ("benchmark",)
+
+MINIMUM = "public, max-age=600, stale-while-revalidate=60, stale-if-error=86400"
+
+# Typical values from object storage and CDN origins
+HEADERS = [
+    "public, max-age={n}",
+    "max-age={n}, s-maxage=86400",
+    "public, max-age={n}, immutable",
+    "private, max-age={n}, must-revalidate",
+    "no-cache, max-age={n}",
+]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.cacheheaders",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--headers", type=int, default=100, help="distinct Cache-Control values"
+    )
+    parser.add_argument("--calls", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--output", default="benchmark-cacheheaders.json")
+    parser.add_argument("--baseline", help="earlier report to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative increase reported as a regression (default 0.1)",
+    )
+    args = parser.parse_args(argv)
+
+    values = [
+        HEADERS[n % len(HEADERS)].format(n=60 * (n + 1)) for n in range(args.headers)
+    ]
+    responses = [
+        httpx.Response(
+            200,
+            headers={
+                "cache-control": value,
+                "etag": f'"{n}"',
+                "last-modified": "Mon, 02 Jan 2023 15:04:05 GMT",
+                "content-type": "image/jpeg",
+            },
+        )
+        for n, value in enumerate(values)
+    ]
+    minimum = ParsedCacheControl(MINIMUM)
+
+    def response(i: int) -> httpx.Response:
+        return responses[i % len(responses)]
+
+    cases = {
+        "parse": lambda i: ParsedCacheControl(values[i % len(values)]),
+        "parse_cached": lambda i: parse_cache_control(values[i % len(values)]),
+        "cache_headers_minimum": lambda i: cache_headers(
+            None, minimum, False, response(i)
+        ),
+        "cache_headers_minimum_str": lambda i: cache_headers(
+            None, MINIMUM, False, response(i)
+        ),
+        "cache_headers_passthrough": lambda i: cache_headers(
+            None, None, False, response(i)
+        ),
+    }
+
+    results: List[dict] = []
+    for name, fn in cases.items():
+        result = {"benchmark": name, **measure_calls(fn, args.calls, args.rounds)}
+        results.append(result)
+        latency = result["latency_ms"]
+        print(
+            f"{name:28} p50 {latency['p50'] * 1000:8.2f} µs  "
+            f"p90 {latency['p90'] * 1000:8.2f} µs",
+            flush=True,
+        )
+
+    write_report(args.output, "cacheheaders", vars(args), results)
+    print(f"wrote {args.output}")
+
+    if args.baseline:
+        regressions = find_regressions(
+            results, args.baseline, KEY_FIELDS, args.threshold
+        )
+        for regression in regressions:
+            print("regression:", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
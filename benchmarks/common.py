@@ -0,0 +1,151 @@
+"""Helpers shared by the benchmarks: statistics, resource usage and JSON reports."""
+
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import pyvips
+
+
+def latency_summary(samples: Sequence[float]) -> Dict[str, float]:
+    """Summary of latency samples given in seconds, in milliseconds."""
+
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        # Nearest rank
+        index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+        return ordered[index] * 1000
+
+    return {
+        "min": ordered[0] * 1000,
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": ordered[-1] * 1000,
+        "mean": statistics.fmean(ordered) * 1000,
+    }
+
+
+def measure_calls(fn: Callable[[int], None], calls: int, rounds: int) -> dict:
+    """Time rounds of calls to fn(i) and summarize the time per call."""
+
+    samples = []
+    for _ in range(rounds):
+        t = time.perf_counter()
+        for i in range(calls):
+            fn(i)
+        samples.append((time.perf_counter() - t) / calls)
+    return {"latency_ms": latency_summary(samples), "calls": calls * rounds}
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident set size of the current process."""
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def process_peak_rss_bytes(pid: int) -> Optional[int]:
+    """Peak resident set size of another process. Linux only, None elsewhere."""
+
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_process_peak_rss(pid: int) -> bool:
+    """Reset the peak RSS of a process so that it can be measured per benchmark
+    case. Linux only."""
+
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def environment_info() -> Dict[str, Any]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "libvips": "%d.%d.%d" % tuple(pyvips.version(n) for n in range(3)),
+        "pyvips": pyvips.__version__,
+    }
+
+
+def write_report(path: str, name: str, args: Dict[str, Any], results: List[dict]):
+    report = {
+        "benchmark": name,
+        "environment": environment_info(),
+        "arguments": args,
+        "results": results,
+    }
+    with open(path, "w", encoding="UTF-8") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+def find_regressions(
+    results: Iterable[dict],
+    baseline_path: str,
+    key_fields: Sequence[str],
+    threshold: float,
+) -> List[str]:
+    """Compare median latency, peak RSS and output size to a previous report. Returns a
+    description of each case that got worse by more than the threshold (a
+    fraction, 0.1 is 10%)."""
+
+    with open(baseline_path, encoding="UTF-8") as f:
+        baseline = json.load(f)
+
+    def key(result: dict) -> tuple:
+        return tuple(result.get(field) for field in key_fields)
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        name = " ".join(str(part) for part in key(result) if part is not None)
+        metrics = [
+            ("p50 latency", old["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            ("peak RSS", old.get("peak_rss_bytes"), result.get("peak_rss_bytes")),
+            ("output size", old.get("output_bytes"), result.get("output_bytes")),
+        ]
+        for metric, before, after in metrics:
+            if before and after and after > before * (1 + threshold):
+                regressions.append(
+                    f"{name}: {metric} {before:.4g} -> {after:.4g} "
+                    f"(+{(after / before - 1) * 100:.0f}%)"
+                )
+    return regressions
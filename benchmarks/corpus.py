@@ -0,0 +1,89 @@
+"""Synthetic test images for the benchmarks.
+
+Images are generated once into a corpus directory and reused by later runs. They
+combine gradients with noise so the encoders have realistic work to do."""
+
+import math
+import os
+from dataclasses import dataclass
+from typing import List, Sequence
+
+from pyvips import GValue, Image
+
+SAVE_OPTIONS = {
+    "jpeg": (".jpg", {"Q": 90}),
+    "png": (".png", {"compression": 6}),
+    "webp": (".webp", {"Q": 85}),
+    "gif": (".gif", {}),
+}
+
+ASPECT_RATIO = 3 / 2
+
+
+@dataclass(frozen=True)
+class CorpusImage:
+    name: str  # file name, also the path at the stand-in origin
+    format: str
+    megapixels: float
+    width: int  # after applying the EXIF orientation
+    height: int
+    orientation: int = 1
+
+    @property
+    def label(self) -> str:
+        return os.path.splitext(self.name)[0]
+
+
+def corpus_spec(
+    formats: Sequence[str], megapixels: Sequence[float], rotated: bool = True
+) -> List[CorpusImage]:
+    """The images of a corpus. With `rotated`, also includes a JPEG stored in
+    portrait orientation with EXIF orientation 6 for each size."""
+
+    images = []
+    for mp in megapixels:
+        height = round(math.sqrt(mp * 1_000_000 / ASPECT_RATIO))
+        width = round(height * ASPECT_RATIO)
+        size = f"{mp:g}mp"
+        for format in formats:
+            suffix, _ = SAVE_OPTIONS[format]
+            images.append(
+                CorpusImage(f"{format}-{size}{suffix}", format, mp, width, height)
+            )
+        if rotated and "jpeg" in formats:
+            images.append(
+                CorpusImage(f"jpeg-rot6-{size}.jpg", "jpeg", mp, width, height, 6)
+            )
+    return images
+
+
+def synthetic_image(width: int, height: int) -> Image:
+    xyz = Image.xyz(width, height)
+    red = xyz[0] * (255 / width)
+    green = xyz[1] * (255 / height)
+    blue = Image.gaussnoise(width, height, mean=128, sigma=16)
+    noise = Image.gaussnoise(width, height, mean=0, sigma=8)
+    return (red.bandjoin([green, blue]) + noise).cast("uchar")
+
+
+def ensure_corpus(directory: str, images: Sequence[CorpusImage], log=print):
+    """Generate the images that don't exist in the directory yet."""
+
+    os.makedirs(directory, exist_ok=True)
+    for image in images:
+        path = os.path.join(directory, image.name)
+        if os.path.exists(path):
+            continue
+        log(f"generating {image.name} ({image.width}x{image.height})")
+        if image.orientation in (5, 6, 7, 8):
+            # Stored with the axes swapped, autorot() turns it back
+            i = synthetic_image(image.height, image.width)
+        else:
+            i = synthetic_image(image.width, image.height)
+        if image.orientation != 1:
+            i = i.copy()
+            i.set_type(GValue.gint_type, "orientation", image.orientation)
+        _, options = SAVE_OPTIONS[image.format]
+        tmp_path = os.path.join(directory, ".tmp-" + image.name)
+        i.write_to_file(tmp_path, **options)
+        os.replace(tmp_path, path)
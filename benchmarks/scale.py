@@ -0,0 +1,478 @@
+"""Benchmarks for the scale pipeline across image formats and sizes.
+
+For each image of a synthetic corpus (see benchmarks.corpus) these cases are run:
+
+* `blocking_scale`: the scaling function called directly, in a fresh process for
+  each case so that the reported peak RSS belongs to that case alone.
+* `scale`, `planner` and `imageinfo`: HTTP requests to the app served by uvicorn,
+  with a stand-in origin serving the corpus. There is no caching proxy, so the
+  cache endpoint points straight back at the app. Request coalescing and the
+  imageinfo cache are disabled so every request does the full work.
+
+Latency percentiles, throughput and peak RSS are printed and written to a JSON
+report. Given an earlier report with --baseline, cases that got slower, used more
+memory or produced larger output are listed and the exit status is 1.
+
+    python -m benchmarks.scale --megapixels 1 12 --output before.json
+    python -m benchmarks.scale --megapixels 1 12 --baseline before.json
+"""
+
+import argparse
+import asyncio
+import functools
+import itertools
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Sequence, Tuple
+
+import httpx
+
+from benchmarks.common import (
+    find_regressions,
+    latency_summary,
+    peak_rss_bytes,
+    process_peak_rss_bytes,
+    reset_process_peak_rss,
+    write_report,
+)
+from benchmarks.corpus import SAVE_OPTIONS, CorpusImage, corpus_spec, ensure_corpus
+from skipscale.encoderprofiles import DEFAULT_ENCODER_PROFILE, ENCODER_PROFILES
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = ("blocking_scale", "scale", "planner", "imageinfo")
+OUTPUT_FORMATS = ("jpeg", "webp", "png")
+TENANT = "bench"
+# Fields identifying a case when comparing with a baseline
+KEY_FIELDS = ("benchmark", "image", "width", "output_format", "profile")
+
+APP_CONFIG = """\
+cache_endpoint = "http://127.0.0.1:{port}/"
+app_path_prefixes = ["/"]
+default_quality = {quality}
+coalesce_requests = false
+imageinfo_cache_entries = 0
+scale_pool_workers = {scale_pool_workers}
+origin_request_timeout_seconds = 300.0
+cache_endpoint_timeout_seconds = 300.0
+
+[tenants.{tenant}]
+origin = "http://127.0.0.1:{origin_port}/"
+"""
+
+
+def target_size(image: CorpusImage, width: int) -> Tuple[int, int]:
+    return width, max(1, round(width * image.height / image.width))
+
+
+def scale_query(
+    image: CorpusImage, width: int, output_format: str, quality: int, profile: str
+):
+    target_width, target_height = target_size(image, width)
+    return {
+        "width": target_width,
+        "height": target_height,
+        "quality": quality,
+        "format": output_format,
+        "profile": profile,
+    }
+
+
+def _run_blocking_scale(path: str, q: dict, iterations: int) -> dict:
+    """Runs in a child process."""
+
+    import pyvips
+
+    from skipscale.scale import blocking_scale
+
+    # Repeating the same operations would otherwise be served from the libvips
+    # operation cache.
+    pyvips.cache_set_max(0)
+
+    with open(path, "rb") as f:
+        content = f.read()
+    output = blocking_scale(content, dict(q, crop=None))  # warm up
+
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        blocking_scale(content, dict(q, crop=None))
+        samples.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+
+    return {
+        "samples": samples,
+        "total": total,
+        "output_bytes": len(output),
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def benchmark_blocking_scale(
+    corpus_dir: str,
+    images: Sequence[CorpusImage],
+    widths: Sequence[int],
+    output_formats: Sequence[str],
+    profiles: Sequence[str],
+    quality: int,
+    iterations: int,
+) -> List[dict]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for image in images:
+        for width in widths:
+            for output_format, profile in itertools.product(output_formats, profiles):
+                q = scale_query(image, width, output_format, quality, profile)
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    run = executor.submit(
+                        _run_blocking_scale,
+                        os.path.join(corpus_dir, image.name),
+                        q,
+                        iterations,
+                    ).result()
+                result = _result("blocking_scale", image, width, output_format, profile)
+                result.update(
+                    iterations=iterations,
+                    concurrency=1,
+                    latency_ms=latency_summary(run["samples"]),
+                    throughput_per_second=iterations / run["total"],
+                    peak_rss_bytes=run["peak_rss_bytes"],
+                    output_bytes=run["output_bytes"],
+                )
+                report(result)
+                results.append(result)
+    return results
+
+
+class _OriginHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInOrigin:
+    """Serves the corpus directory over HTTP from a background thread."""
+
+    def __init__(self, directory: str) -> None:
+        handler = functools.partial(_OriginHandler, directory=directory)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class AppServer:
+    """The app in a uvicorn subprocess, configured with the origin as tenant."""
+
+    def __init__(
+        self, workdir: str, origin_port: int, quality: int, scale_pool_workers: int
+    ) -> None:
+        self.port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        config_path = os.path.join(workdir, "config.toml")
+        with open(config_path, "w", encoding="UTF-8") as f:
+            f.write(
+                APP_CONFIG.format(
+                    port=self.port,
+                    quality=quality,
+                    scale_pool_workers=scale_pool_workers,
+                    tenant=TENANT,
+                    origin_port=origin_port,
+                )
+            )
+        self._config_path = config_path
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "skipscale.main:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=REPO_ROOT,
+            env=dict(os.environ, SKIPSCALE_CONFIG=self._config_path),
+        )
+        deadline = time.monotonic() + 30
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("app server exited during startup")
+            try:
+                if httpx.get(self.base_url + "/").status_code == 200:
+                    return self
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("app server did not start")
+            time.sleep(0.1)
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.wait()
+
+
+async def _drive(
+    url: str, requests: int, concurrency: int, expected_status: int
+) -> Tuple[List[float], float, int]:
+    """Requests the URL a number of times with the given concurrency, after one
+    warm-up request. Returns the latencies, total time and last response size."""
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+
+        async def get() -> int:
+            r = await client.get(url)
+            if r.status_code != expected_status:
+                raise RuntimeError(f"{url}: unexpected status {r.status_code}")
+            return len(r.content)
+
+        await get()
+
+        samples: List[float] = []
+        remaining = requests
+        size = 0
+
+        async def worker():
+            nonlocal remaining, size
+            while remaining > 0:
+                remaining -= 1
+                t = time.perf_counter()
+                size = await get()
+                samples.append(time.perf_counter() - t)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return samples, time.perf_counter() - start, size
+
+
+def benchmark_routes(
+    server: AppServer,
+    benchmarks: Sequence[str],
+    images: Sequence[CorpusImage],
+    widths: Sequence[int],
+    output_formats: Sequence[str],
+    profiles: Sequence[str],
+    quality: int,
+    requests: int,
+    concurrency: int,
+) -> List[dict]:
+    cases = []
+    for image in images:
+        if "imageinfo" in benchmarks:
+            url = f"{server.base_url}/imageinfo/{TENANT}/{image.name}"
+            cases.append((_result("imageinfo", image), url, 200))
+        for width in widths:
+            if "planner" in benchmarks:
+                url = f"{server.base_url}/{TENANT}/{image.name}?width={width}"
+                cases.append((_result("planner", image, width), url, 307))
+            if "scale" not in benchmarks:
+                continue
+            for output_format, profile in itertools.product(output_formats, profiles):
+                q = scale_query(image, width, output_format, quality, profile)
+                url = f"{server.base_url}/scale/{TENANT}/{image.name}?" + "&".join(
+                    f"{k}={v}" for k, v in q.items()
+                )
+                result = _result("scale", image, width, output_format, profile)
+                cases.append((result, url, 200))
+
+    results = []
+    for result, url, expected_status in cases:
+        pid = server.process.pid
+        measure_rss = reset_process_peak_rss(pid)
+        samples, total, size = asyncio.run(
+            _drive(url, requests, concurrency, expected_status)
+        )
+        result.update(
+            iterations=requests,
+            concurrency=concurrency,
+            latency_ms=latency_summary(samples),
+            throughput_per_second=requests / total,
+            peak_rss_bytes=process_peak_rss_bytes(pid) if measure_rss else None,
+        )
+        if result["benchmark"] == "scale":
+            result["output_bytes"] = size
+        report(result)
+        results.append(result)
+    return results
+
+
+def _result(
+    benchmark: str,
+    image: CorpusImage,
+    width: Optional[int] = None,
+    output_format: Optional[str] = None,
+    profile: Optional[str] = None,
+) -> dict:
+    return {
+        "benchmark": benchmark,
+        "image": image.label,
+        "format": image.format,
+        "megapixels": image.megapixels,
+        "orientation": image.orientation,
+        "width": width,
+        "output_format": output_format,
+        "profile": profile,
+    }
+
+
+def report(result: dict) -> None:
+    latency = result["latency_ms"]
+    rss = result.get("peak_rss_bytes")
+    print(
+        f"{result['benchmark']:<15} {result['image']:<16} "
+        f"{result['width'] or '':>5} {result['output_format'] or '':<5} "
+        f"{result['profile'] or '':<8} "
+        f"p50 {latency['p50']:8.1f} ms  p90 {latency['p90']:8.1f} ms  "
+        f"p99 {latency['p99']:8.1f} ms  {result['throughput_per_second']:7.2f}/s  "
+        + (f"peak RSS {rss / 2**20:6.0f} MiB" if rss else ""),
+        flush=True,
+    )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.scale",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--corpus",
+        default=os.path.join(tempfile.gettempdir(), "skipscale-benchmark-corpus"),
+        help="directory for the generated images, reused between runs",
+    )
+    parser.add_argument(
+        "--formats", nargs="+", choices=tuple(SAVE_OPTIONS), default=list(SAVE_OPTIONS)
+    )
+    parser.add_argument(
+        "--megapixels", nargs="+", type=float, default=[1, 12, 50], metavar="MP"
+    )
+    parser.add_argument(
+        "--no-rotated", action="store_true", help="skip the EXIF-rotated JPEGs"
+    )
+    parser.add_argument("--widths", nargs="+", type=int, default=[320, 1280])
+    parser.add_argument(
+        "--output-formats",
+        nargs="+",
+        choices=OUTPUT_FORMATS,
+        default=list(OUTPUT_FORMATS),
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=tuple(ENCODER_PROFILES),
+        default=[DEFAULT_ENCODER_PROFILE],
+        help="encoder profiles, default %(default)s",
+    )
+    parser.add_argument("--quality", type=int, default=85)
+    parser.add_argument(
+        "--benchmarks", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS)
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=5,
+        help="calls per blocking_scale case, after one warm-up call",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=20,
+        help="requests per route case, after one warm-up request",
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--scale-pool-workers",
+        type=int,
+        help="scale_pool_workers of the app, defaults to --concurrency",
+    )
+    parser.add_argument("--output", default="benchmark-scale.json")
+    parser.add_argument("--baseline", help="earlier report to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative increase reported as a regression (default 0.1)",
+    )
+    args = parser.parse_args(argv)
+
+    images = corpus_spec(args.formats, args.megapixels, rotated=not args.no_rotated)
+    ensure_corpus(args.corpus, images)
+
+    results = []
+    if "blocking_scale" in args.benchmarks:
+        results += benchmark_blocking_scale(
+            args.corpus,
+            images,
+            args.widths,
+            args.output_formats,
+            args.profiles,
+            args.quality,
+            args.iterations,
+        )
+    if set(args.benchmarks) - {"blocking_scale"}:
+        with tempfile.TemporaryDirectory() as workdir, StandInOrigin(
+            args.corpus
+        ) as origin, AppServer(
+            workdir,
+            origin.port,
+            args.quality,
+            args.scale_pool_workers or args.concurrency,
+        ) as server:
+            results += benchmark_routes(
+                server,
+                args.benchmarks,
+                images,
+                args.widths,
+                args.output_formats,
+                args.profiles,
+                args.quality,
+                args.requests,
+                args.concurrency,
+            )
+
+    write_report(args.output, "scale", vars(args), results)
+    print(f"wrote {args.output}")
+
+    if args.baseline:
+        regressions = find_regressions(
+            results, args.baseline, KEY_FIELDS, args.threshold
+        )
+        for regression in regressions:
+            print("regression:", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
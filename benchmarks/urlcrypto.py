@@ -0,0 +1,145 @@
+"""Micro-benchmark for decrypting origin URLs, which is done for every request
+for an original with an encrypted URL.
+
+Cases:
+
+* `decrypt_url`: decrypting and verifying without the cache.
+* `decrypt_url_cached`: cache hits, for a working set of URLs that fits the cache.
+* `decrypt_url_cached_invalid`: rejections of tampered ciphertexts from the
+  invalid cache.
+* `encryption_key`: looking up the tenant key in the configuration.
+
+Per-call latency percentiles are printed and written to a JSON report, which can
+be compared with an earlier one using --baseline.
+
+    python -m benchmarks.urlcrypto --output before.json
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from typing import List
+
+from benchmarks.common import find_regressions, measure_calls, write_report
+from skipscale.config import Config
+from skipscale.lrucache import LRUCache
+from skipscale.urlcrypto import decrypt_url, decrypt_url_cached, encrypt_url
+
+KEY = bytes.fromhex("01234567890123456789012345678901")
+TENANT = "bench"
+KEY_FIELDS = ("benchmark",)
+
+CONFIG = """\
+cache_endpoint = "http://127.0.0.1:8000/"
+app_path_prefixes = ["/"]
+
+[encryption]
+key = "01234567890123456789012345678901"
+username = "admin"
+password = "admin"
+url_prefix = "https://images.example.com/"
+"""
+
+TENANT_CONFIG = """
+[tenants.tenant{n}]
+[tenants.tenant{n}.encryption]
+key = "{key}"
+username = "admin"
+password = "admin"
+url_prefix = "https://images.example.com/"
+"""
+
+
+def make_config(tenants: int, workdir: str) -> Config:
+    path = os.path.join(workdir, "config.toml")
+    with open(path, "w", encoding="UTF-8") as f:
+        f.write(CONFIG)
+        for n in range(tenants):
+            f.write(TENANT_CONFIG.format(n=n, key=f"{n:032x}"))
+    return Config(path)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.urlcrypto",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--urls", type=int, default=1000, help="distinct URLs")
+    parser.add_argument("--tenants", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--output", default="benchmark-urlcrypto.json")
+    parser.add_argument("--baseline", help="earlier report to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative increase reported as a regression (default 0.1)",
+    )
+    args = parser.parse_args(argv)
+
+    ciphertexts = [
+        encrypt_url(KEY, TENANT, f"https://storage.example.com/images/{n}.jpg")
+        for n in range(args.urls)
+    ]
+    # Flip a bit of the authentication tag
+    tampered = [c[:-1] + ("B" if c[-1] == "A" else "A") for c in ciphertexts]
+    cache = LRUCache(args.urls)
+    invalid_cache = LRUCache(args.urls)
+    for ciphertext in ciphertexts:
+        decrypt_url_cached(cache, KEY, TENANT, ciphertext)
+    for ciphertext in tampered:
+        try:
+            decrypt_url_cached(cache, KEY, TENANT, ciphertext, invalid_cache)
+        except ValueError:
+            pass
+
+    def cached_invalid(i: int) -> None:
+        try:
+            decrypt_url_cached(cache, KEY, TENANT, tampered[i], invalid_cache)
+        except ValueError:
+            pass
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = make_config(args.tenants, workdir)
+    tenant_names = [f"tenant{n}" for n in range(args.tenants)] + ["unconfigured"]
+
+    cases = {
+        "decrypt_url": lambda i: decrypt_url(KEY, TENANT, ciphertexts[i]),
+        "decrypt_url_cached": lambda i: decrypt_url_cached(
+            cache, KEY, TENANT, ciphertexts[i]
+        ),
+        "decrypt_url_cached_invalid": cached_invalid,
+        "encryption_key": lambda i: config.encryption_key(
+            tenant_names[i % len(tenant_names)]
+        ),
+    }
+
+    results: List[dict] = []
+    for name, fn in cases.items():
+        result = {"benchmark": name, **measure_calls(fn, args.urls, args.rounds)}
+        results.append(result)
+        latency = result["latency_ms"]
+        print(
+            f"{name:28} p50 {latency['p50'] * 1000:8.2f} µs  "
+            f"p90 {latency['p90'] * 1000:8.2f} µs",
+            flush=True,
+        )
+
+    write_report(args.output, "urlcrypto", vars(args), results)
+    print(f"wrote {args.output}")
+
+    if args.baseline:
+        regressions = find_regressions(
+            results, args.baseline, KEY_FIELDS, args.threshold
+        )
+        for regression in regressions:
+            print("regression:", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
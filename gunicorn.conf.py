@@ -0,0 +1,12 @@
+"""gunicorn settings, read from the working directory when gunicorn starts."""
+
+import os
+
+from prometheus_client import multiprocess
+
+
+def child_exit(server, worker):
+    # Live gauges, like the scale pool's queued and running jobs, would otherwise
+    # keep reporting the last values of workers that exited or were restarted.
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,208 @@
+"""Per-process objects derived from the configuration, kept in app.state, and
+reloading them when the configuration file changes."""
+
+import asyncio
+import os
+import signal
+from typing import Any, Dict, Optional, Tuple
+
+from starlette.applications import Starlette
+
+from skipscale.config import Config
+from skipscale.decodedcache import DecodedImageCache
+from skipscale.diskcache import OriginalCache
+from skipscale.httpclients import HTTPClients
+from skipscale.lrucache import LRUCache
+from skipscale.scalepool import ScalePool
+from skipscale.urlcrypto import INVALID_CACHE_ENTRIES
+from skipscale.utils import get_logger, SingleFlight
+from skipscale.warmup import Warmup
+
+log = get_logger(__name__)
+
+# Settings that are applied once at startup: the routes are mounted at the path
+# prefixes, and Sentry is initialized with its middleware.
+RESTART_REQUIRED = (
+    "app_path_prefixes",
+    "sentry_dsn",
+    "sentry_traces_sample_rate",
+    "sentry_profiles_sample_rate",
+)
+
+
+def _original_cache(config: Config) -> Optional[OriginalCache]:
+    if not config.original_cache_dir():
+        return None
+    return OriginalCache(config.original_cache_dir(), config.original_cache_max_bytes())
+
+
+def _scale_pool_settings(config: Config) -> tuple:
+    return (
+        config.scale_pool_workers(),
+        config.scale_pool_backend(),
+        config.scale_pool_max_queue(),
+        config.scale_pool_retry_after_seconds(),
+    )
+
+
+def _scale_pool(config: Config) -> ScalePool:
+    workers, backend, max_queue, retry_after_seconds = _scale_pool_settings(config)
+    return ScalePool(
+        workers=workers,
+        backend=backend,
+        max_queue=max_queue,
+        retry_after_seconds=retry_after_seconds,
+    )
+
+
+def _decoded_cache_settings(config: Config) -> tuple:
+    return (
+        config.decoded_cache_max_pixels(),
+        config.decoded_cache_ttl_seconds(),
+        config.scale_pool_backend(),
+    )
+
+
+def _decoded_cache(config: Config) -> Optional[DecodedImageCache]:
+    # Processes of the process backend can't share images with this one
+    if not config.decoded_cache_max_pixels() or config.scale_pool_backend() != "thread":
+        return None
+    return DecodedImageCache(
+        config.decoded_cache_max_pixels(), config.decoded_cache_ttl_seconds()
+    )
+
+
+def init_state(app: Starlette, config: Config) -> None:
+    app.state.config = config
+    app.state.singleflight = SingleFlight(enabled=config.coalesce_requests())
+    app.state.original_cache = _original_cache(config)
+    app.state.imageinfo_cache = LRUCache(config.imageinfo_cache_entries(), "imageinfo")
+    app.state.decrypted_url_cache = LRUCache(
+        config.decrypted_url_cache_entries(), "decrypted_url"
+    )
+    app.state.invalid_url_cache = LRUCache(INVALID_CACHE_ENTRIES, "invalid_url")
+    app.state.scale_pool = _scale_pool(config)
+    app.state.decoded_cache = _decoded_cache(config)
+    app.state.http_clients = HTTPClients(config)
+    app.state.warmup = Warmup(
+        app.state.http_clients.internal,
+        concurrency=config.warmup_concurrency(),
+        max_queue=config.warmup_max_queue(),
+    )
+
+
+def apply_config(app: Starlette, config: Config) -> None:
+    """Switch app.state to a new configuration, replacing only what depends on
+    settings that changed. Requests in progress finish with the objects they
+    started with.
+
+    The replacements are built before any of them is put in place, so if that
+    raises, or a setting that needs a restart was changed (ValueError), the app
+    stays on the current configuration."""
+
+    old: Config = app.state.config
+    for name in RESTART_REQUIRED:
+        if getattr(old, name)() != getattr(config, name)():
+            raise ValueError(f"changing {name} requires a restart")
+
+    # The cached imageinfo responses include headers derived from tenant settings
+    state: Dict[str, Any] = {
+        "imageinfo_cache": LRUCache(config.imageinfo_cache_entries(), "imageinfo")
+    }
+    if (old.original_cache_dir(), old.original_cache_max_bytes()) != (
+        config.original_cache_dir(),
+        config.original_cache_max_bytes(),
+    ):
+        state["original_cache"] = _original_cache(config)
+    # Decrypted URLs are keyed by the encryption key, so only the size matters
+    if old.decrypted_url_cache_entries() != config.decrypted_url_cache_entries():
+        state["decrypted_url_cache"] = LRUCache(
+            config.decrypted_url_cache_entries(), "decrypted_url"
+        )
+    if _decoded_cache_settings(old) != _decoded_cache_settings(config):
+        state["decoded_cache"] = _decoded_cache(config)
+    # Last, it is the only one that has to be shut down if something fails
+    if _scale_pool_settings(old) != _scale_pool_settings(config):
+        state["scale_pool"] = _scale_pool(config)
+
+    try:
+        app.state.http_clients.reconfigure(config)
+    except Exception:
+        if "scale_pool" in state:
+            state["scale_pool"].shutdown()
+        raise
+
+    old_pool: ScalePool = app.state.scale_pool
+    for name, value in state.items():
+        setattr(app.state, name, value)
+    app.state.singleflight.enabled = config.coalesce_requests()
+    app.state.warmup.reconfigure(
+        app.state.http_clients.internal,
+        config.warmup_concurrency(),
+        config.warmup_max_queue(),
+    )
+    app.state.config = config
+    if "scale_pool" in state:
+        old_pool.shutdown_when_idle()
+
+
+class ConfigReloader:
+    """Reloads the configuration on SIGHUP, and when the file changes if
+    config_reload_interval_seconds is set. An invalid file is logged and the
+    current configuration is kept."""
+
+    def __init__(self, app: Starlette) -> None:
+        self._app = app
+        self._path: str = app.state.config.path
+        self._task: Optional[asyncio.Task] = None
+        self._signal_handler = False
+
+    def reload(self) -> bool:
+        try:
+            config = Config(self._path)
+            apply_config(self._app, config)
+        except Exception:
+            log.exception(
+                "reloading %s failed, keeping the current configuration", self._path
+            )
+            return False
+        log.info("reloaded configuration from %s", self._path)
+        return True
+
+    def _file_version(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            # Follows symlinks, so a Kubernetes ConfigMap update is seen as a change
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    async def _watch(self, interval: float) -> None:
+        version = self._file_version()
+        while True:
+            await asyncio.sleep(interval)
+            current = self._file_version()
+            if current is not None and current != version:
+                version = current
+                self.reload()
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+            self._signal_handler = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not in the main thread, or not supported by the event loop
+            log.debug("not reloading the configuration on SIGHUP")
+
+        interval = self._app.state.config.config_reload_interval_seconds()
+        if interval:
+            self._task = asyncio.create_task(self._watch(interval))
+
+    def stop(self) -> None:
+        if self._signal_handler:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self._signal_handler = False
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
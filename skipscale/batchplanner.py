@@ -0,0 +1,166 @@
+"""Canonical URLs for many images and sizes in one request, so that they can be
+rendered into pages without going through the planner redirect."""
+
+import asyncio
+import math
+from typing import Any
+from urllib.parse import parse_qsl, urlsplit
+
+from schema import Schema, And, SchemaError
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from skipscale.config import Config
+from skipscale.encrypt import authenticate
+from skipscale.planner import (
+    canonical_url,
+    dimensions_schema,
+    fetch_center_point,
+    fetch_imageinfo,
+    needs_center_point,
+    validate_query,
+)
+from skipscale.planner_math import ScaleDimensions, plan_scale_many
+from skipscale.utils import extract_forwardable_params, get_logger
+
+log = get_logger(__name__)
+
+MAX_IMAGES = 200
+MAX_VARIANTS = 50
+# Images resolved in parallel per batch request
+CONCURRENCY = 8
+
+post_schema = Schema(
+    {
+        "images": And(
+            [
+                {
+                    "uri": And(str, len),
+                    "variants": And([{str: object}], lambda v: len(v) <= MAX_VARIANTS),
+                }
+            ],
+            lambda i: len(i) <= MAX_IMAGES,
+        )
+    }
+)
+
+
+def plan_dimensions(
+    config: Config, tenant: str, queries: list[dict], imageinfo: dict
+) -> list[ScaleDimensions]:
+    """plan_scale for all variants of an image at once."""
+
+    dimensions = [dimensions_schema.validate(q) for q in queries]
+    planned = plan_scale_many(
+        imageinfo["width"],
+        imageinfo["height"],
+        width=[d.get("width", 0) for d in dimensions],
+        height=[d.get("height", 0) for d in dimensions],
+        dpr=[d.get("dpr", 1) for d in dimensions],
+        mode=[d.get("mode") for d in dimensions],
+        center_x=[d.get("center_x", math.nan) for d in dimensions],
+        center_y=[d.get("center_y", math.nan) for d in dimensions],
+        max_pixel_ratio=config.tenant(tenant).max_pixel_ratio,
+    )
+    return [planned[i] for i in range(len(planned))]
+
+
+async def plan_image(
+    request: Request, tenant: str, uri: str, variants: list[dict[str, Any]]
+) -> dict[str, Any]:
+    config: Config = request.app.state.config
+    parts = urlsplit(uri)
+    image_uri = parts.path.lstrip("/")
+    # uri may carry v= and hash= like planner requests do
+    _, fwd_q = extract_forwardable_params(dict(parse_qsl(parts.query)))
+
+    queries: list[dict | HTTPException] = []
+    for variant in variants:
+        try:
+            q = validate_query({k: str(v) for k, v in variant.items()})
+            if q.get("format") == "auto":
+                raise HTTPException(400, "format=auto needs the Accept header")
+            queries.append(q)
+        except HTTPException as exc:
+            queries.append(exc)
+
+    try:
+        imageinfo, _ = await fetch_imageinfo(
+            request, tenant, image_uri, fwd_q, forward_conditional_headers=False
+        )
+    except HTTPException as exc:
+        return {"uri": uri, "error": exc.status_code}
+
+    center_point = None
+    if any(
+        isinstance(q, dict) and needs_center_point(config, q, imageinfo)
+        for q in queries
+    ):
+        center_point = await fetch_center_point(request, tenant, image_uri, fwd_q)
+
+    valid = [q for q in queries if isinstance(q, dict)]
+    for q in valid:
+        if center_point is not None and needs_center_point(config, q, imageinfo):
+            q["center_x"], q["center_y"] = center_point
+    # SVGs are served as they are
+    if imageinfo["format"] != "svg":
+        planned = iter(plan_dimensions(config, tenant, valid, imageinfo))
+    else:
+        planned = iter([None] * len(valid))
+
+    results: list[dict[str, Any]] = []
+    for q in queries:
+        if isinstance(q, HTTPException):
+            results.append({"error": q.detail})
+            continue
+        try:
+            url = canonical_url(
+                config,
+                tenant,
+                image_uri,
+                fwd_q,
+                q,
+                imageinfo,
+                scale_dimensions=next(planned),
+            )
+        except HTTPException as exc:
+            results.append({"error": exc.detail})
+            continue
+        results.append({"url": url})
+
+    return {"uri": uri, "variants": results}
+
+
+async def batch_planner(request: Request):
+    """Resolve imageinfo once per image and plan all its variants. The results are
+    the URLs the planner would redirect to, in the order requested."""
+
+    tenant = request.path_params["tenant"]
+    if not authenticate(request, tenant):
+        raise HTTPException(401)
+    try:
+        raw_body = await request.json()
+        body = post_schema.validate(raw_body)
+    except SchemaError as exc:
+        log.warning("batch planner request validation failed: %s", exc)
+        raise HTTPException(400, detail="Validation failed")
+    except Exception:
+        log.exception("batch planner request parsing failed")
+        raise HTTPException(400, detail="Parsing failed")
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def bounded(image):
+        async with semaphore:
+            try:
+                return await plan_image(
+                    request, tenant, image["uri"], image["variants"]
+                )
+            except Exception:
+                # Only this image fails, e.g. on a transport error or bad imageinfo
+                log.exception("batch planning failed for %s", image["uri"])
+                return {"uri": image["uri"], "error": 500}
+
+    images = await asyncio.gather(*(bounded(image) for image in body["images"]))
+    return JSONResponse({"images": images})
@@ -2,14 +2,22 @@
 
 import os
 import re
+from dataclasses import dataclass
 from typing import Any, List, Optional, Tuple, Dict
 
 import schema
 import validators
 import toml
 
+from skipscale.encoderprofiles import DEFAULT_ENCODER_PROFILE, ENCODER_PROFILES
+from skipscale.utils import ParsedCacheControl
+
 config_path = os.getenv("SKIPSCALE_CONFIG", "config.toml")
 
+# Path prefixes of routes that would shadow planner requests of a tenant with the
+# same name, see main.routes
+RESERVED_TENANT_NAMES = ("warmup",)
+
 encryption_fields = {
     "key": schema.And(schema.Use(bytes.fromhex), lambda k: len(k) == 16),
     "username": str,
@@ -24,7 +32,18 @@ tenant_overrideable_fields = {
         str, schema.Use(str.lower), lambda s: s in ("jpeg", "png", "webp")
     ),
     schema.Optional("force_default_format"): bool,
+    schema.Optional("auto_format"): bool,
+    schema.Optional("planner_internal_render"): bool,
+    schema.Optional("scale_animations"): bool,
     schema.Optional("max_pixel_ratio"): int,
+    schema.Optional("encoder_profile"): schema.And(
+        str, lambda s: s in ENCODER_PROFILES
+    ),
+    schema.Optional("encoder_profile_max_pixels"): {
+        schema.And(str, lambda s: s in ENCODER_PROFILES): schema.And(
+            int, lambda n: n > 0
+        )
+    },
     schema.Optional("cache_control_override"): str,
     schema.Optional("cache_control_minimum"): str,
     schema.Optional("encryption"): encryption_fields,
@@ -34,6 +53,11 @@ tenant_overrideable_fields = {
     schema.Optional("strip_regex"): schema.And(
         str, lambda s: re.compile(s) is not None
     ),
+    schema.Optional("origin_request_connect_timeout_seconds"): float,
+    schema.Optional("origin_request_timeout_seconds"): float,
+    schema.Optional("origin_request_max_keepalive_connections"): int,
+    schema.Optional("origin_request_max_connections"): int,
+    schema.Optional("origin_request_http2"): bool,
 }
 
 main_fields = {
@@ -41,39 +65,188 @@ main_fields = {
         schema.And(str, lambda s: s.endswith("/"))
     ],  # default ["/"]
     "cache_endpoint": schema.And(str, lambda s: s.endswith("/")),
-    schema.Optional("origin_request_connect_timeout_seconds"): float,
-    schema.Optional("origin_request_timeout_seconds"): float,
-    schema.Optional("origin_request_max_keepalive_connections"): int,
-    schema.Optional("origin_request_max_connections"): int,
-    schema.Optional("origin_request_http2"): bool,
     schema.Optional("origin_request_local_address"): str,
+    schema.Optional("cache_endpoint_connect_timeout_seconds"): float,
+    schema.Optional("cache_endpoint_timeout_seconds"): float,
+    schema.Optional("cache_endpoint_max_keepalive_connections"): int,
+    schema.Optional("cache_endpoint_max_connections"): int,
+    schema.Optional("cache_endpoint_http2"): bool,
+    schema.Optional("coalesce_requests"): bool,
+    schema.Optional("original_stream_threshold_bytes"): schema.And(
+        int, lambda n: n >= 0
+    ),
+    schema.Optional("original_cache_dir"): str,
+    schema.Optional("original_cache_max_bytes"): schema.And(int, lambda n: n > 0),
+    schema.Optional("imageinfo_cache_entries"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("imageinfo_cache_max_ttl_seconds"): schema.And(
+        int, lambda n: n >= 0
+    ),
+    schema.Optional("imageinfo_probe_bytes"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("decrypted_url_cache_entries"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("scale_pool_workers"): schema.And(int, lambda n: n > 0),
+    schema.Optional("scale_pool_backend"): schema.And(
+        str, schema.Use(str.lower), lambda s: s in ("thread", "process")
+    ),
+    schema.Optional("scale_pool_max_queue"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("scale_pool_retry_after_seconds"): schema.And(
+        int, lambda n: n >= 0
+    ),
+    schema.Optional("decoded_cache_max_pixels"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("decoded_cache_ttl_seconds"): schema.And(float, lambda n: n > 0),
+    schema.Optional("animation_max_frames"): schema.And(int, lambda n: n > 0),
+    schema.Optional("animation_max_pixels"): schema.And(int, lambda n: n > 0),
+    schema.Optional("warmup_concurrency"): schema.And(int, lambda n: n > 0),
+    schema.Optional("warmup_max_queue"): schema.And(int, lambda n: n >= 0),
+    schema.Optional("thumbnail_crop_concurrency"): schema.And(int, lambda n: n > 0),
+    schema.Optional("thumbnail_crop_timeout_seconds"): schema.And(
+        float, lambda n: n > 0
+    ),
+    schema.Optional("config_reload_interval_seconds"): schema.And(
+        float, lambda n: n >= 0
+    ),
+    schema.Optional("metrics_enabled"): bool,
     schema.Optional("sentry_dsn"): str,
     schema.Optional("sentry_traces_sample_rate"): float,
     schema.Optional("sentry_profiles_sample_rate"): float,
     schema.Optional("visionrecognizer_url"): str,
     schema.Optional("visionrecognizer_cache_endpoint"): str,
     schema.Optional("visionrecognizer_bearer_token"): str,
-    schema.Optional("tenants"): {str: tenant_overrideable_fields},
+    schema.Optional("tenants"): {
+        schema.And(
+            str, lambda s: s not in RESERVED_TENANT_NAMES
+        ): tenant_overrideable_fields
+    },
 }
 
 config_schema = schema.Schema({**main_fields, **tenant_overrideable_fields})
 
 
+@dataclass(frozen=True, slots=True)
+class TenantConfig:
+    """The tenant-overrideable settings of one tenant, with the global values and
+    defaults applied. See the Config methods of the same name."""
+
+    default_quality: int
+    default_format: Optional[str]
+    force_default_format: bool
+    auto_format: bool
+    planner_internal_render: bool
+    scale_animations: bool
+    max_pixel_ratio: Optional[int]
+    encoder_profile: str
+    # (profile, max pixels), smallest limit first
+    encoder_profile_max_pixels: Tuple[Tuple[str, int], ...]
+    cache_control_override: Optional[str]
+    cache_control_minimum: Optional[str]
+    parsed_cache_control_minimum: Optional[ParsedCacheControl]
+    origin: Optional[str]
+    proxy: Optional[str]
+    allow_cors: bool
+    strip_regex: Optional[re.Pattern]
+    encryption_key: Optional[bytes]
+    encryption_credentials: Optional[Tuple[str, str]]
+    encryption_url_prefix: Optional[str]
+    encryption_asset_url_prefix: Optional[str]
+    origin_request_connect_timeout_seconds: float
+    origin_request_timeout_seconds: float
+    origin_request_max_keepalive_connections: Optional[int]
+    origin_request_max_connections: Optional[int]
+    origin_request_http2: bool
+
+    def encoder_profile_for(self, output_pixels: int) -> str:
+        for profile, limit in self.encoder_profile_max_pixels:
+            if output_pixels <= limit:
+                return profile
+        return self.encoder_profile
+
+
 class Config:
     """Server configuration parsed from a TOML file."""
 
-    def __init__(self):
-        with open(config_path, encoding="UTF-8") as f:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or config_path
+        with open(self.path, encoding="UTF-8") as f:
             parsed_config = toml.load(f)
         self.validated_config = config_schema.validate(parsed_config)
 
-        self._strip_regex_cache: Dict[str, Any] = {}
-
-    def _optional_main_optional_tenant(self, tenant: str, key: str) -> Any:
-        if (
-            tenant in self.validated_config["tenants"]
-            and key in self.validated_config["tenants"][tenant]
-        ):
+        # Tenant settings are looked up several times per request, so resolve them
+        # once. Unknown tenants share the global settings.
+        self._default_tenant = self._resolve_tenant(None)
+        self._tenants: Dict[str, TenantConfig] = {
+            tenant: self._resolve_tenant(tenant)
+            for tenant in self.validated_config.get("tenants", {})
+        }
+
+    def _resolve_tenant(self, tenant: Optional[str]) -> TenantConfig:
+        def get(key: str, default: Any = None) -> Any:
+            result = self._optional_main_optional_tenant(tenant, key)
+            if result is None:
+                return default
+            return result
+
+        def connection_limit(key: str, default: int) -> Optional[int]:
+            # 0 means unlimited
+            return get(key, default) or None
+
+        encryption = get("encryption")
+        cache_control_minimum = get("cache_control_minimum")
+        strip_regex = get("strip_regex")
+        return TenantConfig(
+            default_quality=get("default_quality") or 85,
+            default_format=get("default_format") or None,
+            force_default_format=get("force_default_format", False),
+            auto_format=get("auto_format", False),
+            planner_internal_render=get("planner_internal_render", False),
+            scale_animations=get("scale_animations", False),
+            max_pixel_ratio=get("max_pixel_ratio"),
+            encoder_profile=get("encoder_profile") or DEFAULT_ENCODER_PROFILE,
+            encoder_profile_max_pixels=tuple(
+                sorted(
+                    get("encoder_profile_max_pixels", {}).items(), key=lambda p: p[1]
+                )
+            ),
+            cache_control_override=get("cache_control_override"),
+            cache_control_minimum=cache_control_minimum,
+            parsed_cache_control_minimum=(
+                ParsedCacheControl(cache_control_minimum)
+                if cache_control_minimum
+                else None
+            ),
+            origin=get("origin"),
+            proxy=get("proxy"),
+            allow_cors=get("force_allow_cors", False),
+            strip_regex=re.compile(strip_regex) if strip_regex else None,
+            encryption_key=encryption["key"] if encryption else None,
+            encryption_credentials=(
+                (encryption["username"], encryption["password"]) if encryption else None
+            ),
+            encryption_url_prefix=encryption["url_prefix"] if encryption else None,
+            encryption_asset_url_prefix=(
+                encryption.get("asset_url_prefix", encryption["url_prefix"])
+                if encryption
+                else None
+            ),
+            origin_request_connect_timeout_seconds=get(
+                "origin_request_connect_timeout_seconds", 5.0
+            ),
+            origin_request_timeout_seconds=get("origin_request_timeout_seconds", 5.0),
+            origin_request_max_keepalive_connections=connection_limit(
+                "origin_request_max_keepalive_connections", 10
+            ),
+            origin_request_max_connections=connection_limit(
+                "origin_request_max_connections", 100
+            ),
+            origin_request_http2=get("origin_request_http2", False),
+        )
+
+    def tenant(self, tenant: Optional[str]) -> TenantConfig:
+        """Resolved settings of a tenant. Tenants without a section of their own
+        get the global settings."""
+        return self._tenants.get(tenant, self._default_tenant)  # type: ignore
+
+    def _optional_main_optional_tenant(self, tenant: Optional[str], key: str) -> Any:
+        tenants = self.validated_config.get("tenants", {})
+        if tenant in tenants and key in tenants[tenant]:
             return self.validated_config["tenants"][tenant][key]
 
         if key in self.validated_config:
@@ -81,6 +254,14 @@ class Config:
 
         return None
 
+    def has_tenant(self, tenant: str) -> bool:
+        """Returns True if the tenant has a section of its own in the config."""
+        return tenant in self.validated_config.get("tenants", {})
+
+    def tenant_names(self) -> List[str]:
+        """Tenants with a section of their own in the config."""
+        return list(self.validated_config.get("tenants", {}))
+
     def app_path_prefixes(self) -> List[str]:
         if "app_path_prefixes" in self.validated_config:
             return self.validated_config["app_path_prefixes"]
@@ -89,40 +270,210 @@ class Config:
     def cache_endpoint(self) -> str:
         return self.validated_config["cache_endpoint"]
 
-    def origin_request_connect_timeout_seconds(self) -> float:
-        if "origin_request_connect_timeout_seconds" in self.validated_config:
-            return self.validated_config["origin_request_connect_timeout_seconds"]
-        return 5.0
-
-    def origin_request_timeout_seconds(self) -> float:
-        if "origin_request_timeout_seconds" in self.validated_config:
-            return self.validated_config["origin_request_timeout_seconds"]
-        return 5.0
-
-    def origin_request_max_keepalive_connections(self) -> Optional[int]:
-        if "origin_request_max_keepalive_connections" in self.validated_config:
-            if self.validated_config["origin_request_max_keepalive_connections"] > 0:
-                return self.validated_config["origin_request_max_keepalive_connections"]
+    def origin_request_connect_timeout_seconds(
+        self, tenant: Optional[str] = None
+    ) -> float:
+        return self.tenant(tenant).origin_request_connect_timeout_seconds
+
+    def origin_request_timeout_seconds(self, tenant: Optional[str] = None) -> float:
+        return self.tenant(tenant).origin_request_timeout_seconds
+
+    def origin_request_max_keepalive_connections(
+        self, tenant: Optional[str] = None
+    ) -> Optional[int]:
+        return self.tenant(tenant).origin_request_max_keepalive_connections
+
+    def origin_request_max_connections(
+        self, tenant: Optional[str] = None
+    ) -> Optional[int]:
+        return self.tenant(tenant).origin_request_max_connections
+
+    def origin_request_http2(self, tenant: Optional[str] = None) -> bool:
+        return self.tenant(tenant).origin_request_http2
+
+    def cache_endpoint_connect_timeout_seconds(self) -> float:
+        """Connect timeout for requests to the cache endpoint. Defaults to
+        the global origin_request_connect_timeout_seconds."""
+        if "cache_endpoint_connect_timeout_seconds" in self.validated_config:
+            return self.validated_config["cache_endpoint_connect_timeout_seconds"]
+        return self.origin_request_connect_timeout_seconds()
+
+    def cache_endpoint_timeout_seconds(self) -> float:
+        """Timeout for requests to the cache endpoint. Defaults to the global
+        origin_request_timeout_seconds."""
+        if "cache_endpoint_timeout_seconds" in self.validated_config:
+            return self.validated_config["cache_endpoint_timeout_seconds"]
+        return self.origin_request_timeout_seconds()
+
+    def cache_endpoint_max_keepalive_connections(self) -> Optional[int]:
+        if "cache_endpoint_max_keepalive_connections" in self.validated_config:
+            if self.validated_config["cache_endpoint_max_keepalive_connections"] > 0:
+                return self.validated_config["cache_endpoint_max_keepalive_connections"]
             return None
-        return 10
+        return self.origin_request_max_keepalive_connections()
 
-    def origin_request_max_connections(self) -> Optional[int]:
-        if "origin_request_max_connections" in self.validated_config:
-            if self.validated_config["origin_request_max_connections"] > 0:
-                return self.validated_config["origin_request_max_connections"]
+    def cache_endpoint_max_connections(self) -> Optional[int]:
+        if "cache_endpoint_max_connections" in self.validated_config:
+            if self.validated_config["cache_endpoint_max_connections"] > 0:
+                return self.validated_config["cache_endpoint_max_connections"]
             return None
-        return 100
+        return self.origin_request_max_connections()
 
-    def origin_request_http2(self) -> bool:
-        if "origin_request_http2" in self.validated_config:
-            return self.validated_config["origin_request_http2"]
-        return False
+    def cache_endpoint_http2(self) -> bool:
+        if "cache_endpoint_http2" in self.validated_config:
+            return self.validated_config["cache_endpoint_http2"]
+        return self.origin_request_http2()
 
     def origin_request_local_address(self) -> Optional[str]:
         if "origin_request_local_address" in self.validated_config:
             return self.validated_config["origin_request_local_address"]
         return None
 
+    def coalesce_requests(self) -> bool:
+        """If True (default), identical concurrent outgoing requests and scaling
+        jobs within a worker process share one request/job."""
+        if "coalesce_requests" in self.validated_config:
+            return self.validated_config["coalesce_requests"]
+        return True
+
+    def original_stream_threshold_bytes(self) -> Optional[int]:
+        """Original and asset responses larger than this (or of unknown length) are
+        streamed to the client instead of being buffered in memory. If not set,
+        responses are always buffered."""
+        if "original_stream_threshold_bytes" in self.validated_config:
+            return self.validated_config["original_stream_threshold_bytes"]
+        return None
+
+    def original_cache_dir(self) -> Optional[str]:
+        """Directory for a local disk cache of original images used for scaling.
+        May be shared by all worker processes on the host. Disabled if not set."""
+        if "original_cache_dir" in self.validated_config:
+            return self.validated_config["original_cache_dir"]
+        return None
+
+    def original_cache_max_bytes(self) -> int:
+        if "original_cache_max_bytes" in self.validated_config:
+            return self.validated_config["original_cache_max_bytes"]
+        return 1024**3
+
+    def imageinfo_cache_entries(self) -> int:
+        """Number of imageinfo results the planner keeps in memory in each worker
+        process. 0 disables the cache."""
+        if "imageinfo_cache_entries" in self.validated_config:
+            return self.validated_config["imageinfo_cache_entries"]
+        return 1024
+
+    def imageinfo_cache_max_ttl_seconds(self) -> int:
+        """Upper limit for how long a cached imageinfo result is used. Within this,
+        the max-age or s-maxage of the imageinfo response is respected."""
+        if "imageinfo_cache_max_ttl_seconds" in self.validated_config:
+            return self.validated_config["imageinfo_cache_max_ttl_seconds"]
+        return 60
+
+    def imageinfo_probe_bytes(self) -> int:
+        """If set, imageinfo first requests only this many leading bytes of the
+        original and parses the dimensions from the file header. 0 disables."""
+        if "imageinfo_probe_bytes" in self.validated_config:
+            return self.validated_config["imageinfo_probe_bytes"]
+        return 0
+
+    def decrypted_url_cache_entries(self) -> int:
+        """Number of decrypted origin URLs remembered per worker process."""
+        if "decrypted_url_cache_entries" in self.validated_config:
+            return self.validated_config["decrypted_url_cache_entries"]
+        return 10000
+
+    def scale_pool_workers(self) -> int:
+        """Number of scaling jobs run in parallel in each worker process."""
+        if "scale_pool_workers" in self.validated_config:
+            return self.validated_config["scale_pool_workers"]
+        return 1
+
+    def scale_pool_backend(self) -> str:
+        """Either "thread" (default) or "process"."""
+        if "scale_pool_backend" in self.validated_config:
+            return self.validated_config["scale_pool_backend"]
+        return "thread"
+
+    def scale_pool_max_queue(self) -> int:
+        """Maximum number of scaling jobs waiting for a free pool slot before new
+        jobs are rejected with a 503. 0 means unbounded."""
+        if "scale_pool_max_queue" in self.validated_config:
+            return self.validated_config["scale_pool_max_queue"]
+        return 0
+
+    def scale_pool_retry_after_seconds(self) -> int:
+        if "scale_pool_retry_after_seconds" in self.validated_config:
+            return self.validated_config["scale_pool_retry_after_seconds"]
+        return 1
+
+    def decoded_cache_max_pixels(self) -> int:
+        """Total pixels of decoded originals kept in memory for scaling other
+        variants, per worker process. 0 disables. Only used with the thread scale
+        pool backend."""
+        if "decoded_cache_max_pixels" in self.validated_config:
+            return self.validated_config["decoded_cache_max_pixels"]
+        return 0
+
+    def decoded_cache_ttl_seconds(self) -> float:
+        if "decoded_cache_ttl_seconds" in self.validated_config:
+            return self.validated_config["decoded_cache_ttl_seconds"]
+        return 10.0
+
+    def animation_max_frames(self) -> int:
+        """Animations with more frames are scaled to their first frame."""
+        if "animation_max_frames" in self.validated_config:
+            return self.validated_config["animation_max_frames"]
+        return 200
+
+    def animation_max_pixels(self) -> int:
+        """Animations with more pixels in all frames of the original together are
+        scaled to their first frame."""
+        if "animation_max_pixels" in self.validated_config:
+            return self.validated_config["animation_max_pixels"]
+        return 25_000_000
+
+    def warmup_concurrency(self) -> int:
+        """Number of warmup requests in flight at a time, per worker process."""
+        if "warmup_concurrency" in self.validated_config:
+            return self.validated_config["warmup_concurrency"]
+        return 4
+
+    def warmup_max_queue(self) -> int:
+        """Maximum number of warmup requests waiting, per worker process. 0 means
+        unbounded."""
+        if "warmup_max_queue" in self.validated_config:
+            return self.validated_config["warmup_max_queue"]
+        return 10000
+
+    def thumbnail_crop_concurrency(self) -> int:
+        """Number of images whose thumbnail crop is looked up at a time, per
+        encrypt request."""
+        if "thumbnail_crop_concurrency" in self.validated_config:
+            return self.validated_config["thumbnail_crop_concurrency"]
+        return 8
+
+    def thumbnail_crop_timeout_seconds(self) -> float:
+        """Timeout for each imageinfo and visionrecognizer request made for a
+        thumbnail crop. The URL is returned without the crop or properties that
+        timed out."""
+        if "thumbnail_crop_timeout_seconds" in self.validated_config:
+            return self.validated_config["thumbnail_crop_timeout_seconds"]
+        return 10.0
+
+    def config_reload_interval_seconds(self) -> float:
+        """How often to check the configuration file for changes. 0 disables it,
+        the configuration is then only reloaded on SIGHUP."""
+        if "config_reload_interval_seconds" in self.validated_config:
+            return self.validated_config["config_reload_interval_seconds"]
+        return 0.0
+
+    def metrics_enabled(self) -> bool:
+        """If True, Prometheus metrics are served at /metrics. Defaults to False."""
+        if "metrics_enabled" in self.validated_config:
+            return self.validated_config["metrics_enabled"]
+        return False
+
     def sentry_dsn(self) -> Optional[str]:
         if "sentry_dsn" in self.validated_config:
             return self.validated_config["sentry_dsn"]
@@ -154,23 +505,24 @@ class Config:
         return None
 
     def default_quality(self, tenant: str) -> int:
-        default_quality = self._optional_main_optional_tenant(tenant, "default_quality")
-        if not default_quality:
-            return 85
-        return default_quality
+        return self.tenant(tenant).default_quality
 
     def default_format(self, tenant: str) -> Optional[str]:
         """Default output image format. If not set, preserve the input format.
         Overridden by the `format` URL parameter."""
 
-        default_format = self._optional_main_optional_tenant(tenant, "default_format")
-        if not default_format:
-            return None
-        return default_format
+        return self.tenant(tenant).default_format
+
+    def encoder_profile(self, tenant: str, output_pixels: int) -> str:
+        """Encoder profile for a scaled image with the given number of pixels.
+        Profiles in `encoder_profile_max_pixels` apply to images up to that size,
+        larger ones use `encoder_profile` (default "max")."""
+
+        return self.tenant(tenant).encoder_profile_for(output_pixels)
 
     def cache_control_override(self, tenant: str) -> Optional[str]:
         """Unconditionally overrides origin Cache-Control."""
-        return self._optional_main_optional_tenant(tenant, "cache_control_override")
+        return self.tenant(tenant).cache_control_override
 
     def cache_control_minimum(self, tenant: str) -> Optional[str]:
         """Overrides origin Cache-Control cache times if either no Cache-Control is
@@ -181,61 +533,63 @@ class Config:
 
         Note: upstream Expires and Pragma headers will be always be ignored
         if this option is set."""
-        return self._optional_main_optional_tenant(tenant, "cache_control_minimum")
+        return self.tenant(tenant).cache_control_minimum
 
-    def max_pixel_ratio(self, tenant: str) -> int:
-        return self._optional_main_optional_tenant(tenant, "max_pixel_ratio")
+    def max_pixel_ratio(self, tenant: str) -> Optional[int]:
+        return self.tenant(tenant).max_pixel_ratio
 
     def encryption_key(self, tenant: str) -> Optional[bytes]:
-        encryption = self._optional_main_optional_tenant(tenant, "encryption")
-        if encryption:
-            return encryption["key"]
-        return None
+        return self.tenant(tenant).encryption_key
 
     def encryption_credentials(self, tenant: str) -> Optional[Tuple[str, str]]:
-        encryption = self._optional_main_optional_tenant(tenant, "encryption")
-        if encryption:
-            return encryption["username"], encryption["password"]
-        return None
+        return self.tenant(tenant).encryption_credentials
 
     def encryption_url_prefix(self, tenant: str) -> Optional[str]:
         """Returns the URL prefix used in encryption POST responses."""
 
-        encryption = self._optional_main_optional_tenant(tenant, "encryption")
-        if encryption:
-            return encryption["url_prefix"]
-        return None
+        return self.tenant(tenant).encryption_url_prefix
 
     def encryption_asset_url_prefix(self, tenant: str) -> Optional[str]:
         """Returns the URL prefix used in encryption POST responses for asset
         (unscaled) URLs. Defaults to the value of `encryption_url_prefix`."""
 
-        encryption = self._optional_main_optional_tenant(tenant, "encryption")
-        if encryption and "asset_url_prefix" in encryption:
-            return encryption["asset_url_prefix"]
-        return self.encryption_url_prefix(tenant)
+        return self.tenant(tenant).encryption_asset_url_prefix
 
     def origin(self, tenant: str) -> Optional[str]:
         """Returns a fixed origin for the tenant. If not set, the (encrypted)
         path from the request is used."""
 
-        return self._optional_main_optional_tenant(tenant, "origin")
+        return self.tenant(tenant).origin
 
     def proxy(self, tenant: str) -> Optional[str]:
         """Returns an URL to a tenant-specific HTTP proxy if set. The
         URL can include basic auth credentials for the proxy."""
 
-        return self._optional_main_optional_tenant(tenant, "proxy")
+        return self.tenant(tenant).proxy
 
     def allow_cors(self, tenant: str) -> bool:
         """Returns True if cross-origin requests should be always allowed for this tenant.
         Defaults to False."""
 
-        result = self._optional_main_optional_tenant(tenant, "force_allow_cors")
-        if result is None:
-            result = False
+        return self.tenant(tenant).allow_cors
+
+    def auto_format(self, tenant: str) -> bool:
+        """Returns True if format=auto may be used to choose the output format
+        based on the Accept header. Defaults to False."""
+
+        return self.tenant(tenant).auto_format
 
-        return result
+    def planner_internal_render(self, tenant: str) -> bool:
+        """Returns True if the planner should respond with the canonical image
+        itself instead of redirecting to it. Defaults to False."""
+
+        return self.tenant(tenant).planner_internal_render
+
+    def scale_animations(self, tenant: str) -> bool:
+        """Returns True if GIFs should be scaled, and animated GIF and WebP images
+        should keep their animation when scaled to GIF or WebP. Defaults to False."""
+
+        return self.tenant(tenant).scale_animations
 
     def force_default_format(self, tenant: str) -> bool:
         """Returns True if default_format should be applied even to image formats
@@ -243,26 +597,10 @@ class Config:
 
         Defaults to False."""
 
-        result = self._optional_main_optional_tenant(tenant, "force_default_format")
-        if result is None:
-            result = False
-
-        return result
+        return self.tenant(tenant).force_default_format
 
     def strip_regex(self, tenant: str):
         """Returns an optional (compiled) regular expression. Matches
         will be stripped from the path before it is sent to the origin."""
 
-        try:
-            return self._strip_regex_cache[tenant]
-        except KeyError:
-            pass
-
-        re_str = self._optional_main_optional_tenant(tenant, "strip_regex")
-        if not re_str:
-            result = None
-        else:
-            result = re.compile(re_str)
-
-        self._strip_regex_cache[tenant] = result
-        return result
+        return self.tenant(tenant).strip_regex
@@ -0,0 +1,106 @@
+"""Short-lived in-memory cache of decoded originals, so that several variants of
+one original requested in quick succession (a srcset) are decoded once."""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional, Tuple
+
+from pyvips import Image
+
+from skipscale import metrics
+
+
+@dataclass(frozen=True)
+class _Entry:
+    image: Image
+    pixels: int
+    expires: float
+
+
+class DecodedImageCache:
+    """Decoded, autorotated originals in memory, possibly reduced with
+    shrink-on-load. An image is stored with its scale relative to the full-size
+    original, and can be used for any variant that needs at most that resolution.
+
+    Bounded by the total number of pixels of the cached images, least recently
+    used first out. Thread safe, shared by the scale pool's threads."""
+
+    def __init__(self, max_pixels: int, ttl_seconds: float) -> None:
+        self.max_pixels = max_pixels
+        self.ttl_seconds = ttl_seconds
+        # (original key, scale) -> entry
+        self._entries: "OrderedDict[Tuple[Hashable, float], _Entry]" = OrderedDict()
+        self._pixels = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def pixels(self) -> int:
+        return self._pixels
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, min_scale: float) -> Optional[Image]:
+        """The smallest cached image of the original with at least min_scale of
+        its full resolution."""
+
+        now = time.monotonic()
+        with self._lock:
+            found: Optional[Tuple[Hashable, float]] = None
+            for entry_key, entry in list(self._entries.items()):
+                if entry.expires <= now:
+                    self._remove(entry_key)
+                    continue
+                original, scale = entry_key
+                if (
+                    original == key
+                    and scale >= min_scale
+                    and (found is None or scale < found[1])
+                ):
+                    found = entry_key
+
+            if found is None:
+                self.misses += 1
+                metrics.DECODED_CACHE_LOOKUPS.labels("miss").inc()
+                return None
+            self._entries.move_to_end(found)
+            self.hits += 1
+            metrics.DECODED_CACHE_LOOKUPS.labels("hit").inc()
+            return self._entries[found].image
+
+    def fits(self, image: Image) -> bool:
+        """Whether the image can be cached at all. Checked before decoding an
+        image into memory for put()."""
+
+        return image.width * image.height <= self.max_pixels
+
+    def put(self, key: Hashable, scale: float, image: Image) -> None:
+        if not self.fits(image):
+            return
+        pixels = image.width * image.height
+
+        with self._lock:
+            entry_key = (key, scale)
+            if entry_key in self._entries:
+                self._remove(entry_key)
+            self._entries[entry_key] = _Entry(
+                image, pixels, time.monotonic() + self.ttl_seconds
+            )
+            self._pixels += pixels
+            while self._pixels > self.max_pixels:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_key: Tuple[Hashable, float]) -> None:
+        self._pixels -= self._entries.pop(entry_key).pixels
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._pixels = 0
@@ -0,0 +1,230 @@
+"""Local on-disk cache for original images.
+
+Image bytes are stored content-addressed under `blobs/`, and each cached URL has a
+small JSON index file under `index/` pointing to a blob together with the response
+headers and expiry time. The directory can be shared by all worker processes on a
+host: files are written atomically, and hits are served from memory-mapped blobs
+so the workers share one copy through the page cache.
+
+Blob and index modification times are bumped on use, and the least recently used
+blobs are deleted once the total size exceeds the configured limit."""
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from typing import Any, List, Optional, Tuple
+
+import httpx
+from pyvips import ffi
+
+from skipscale.utils import get_logger
+
+log = get_logger(__name__)
+
+# Response headers stored with the cached image
+STORED_HEADERS = (
+    "content-type",
+    "etag",
+    "last-modified",
+    "cache-control",
+    "expires",
+    "pragma",
+    "access-control-allow-origin",
+    "access-control-allow-method",
+    "access-control-allow-headers",
+)
+
+
+def vips_buffer(content):
+    """Image.new_from_buffer() takes bytes or a cffi buffer. Wrap the memory
+    maps of cached originals without copying them."""
+
+    if isinstance(content, mmap.mmap):
+        return ffi.from_buffer(content)
+    return content
+
+
+class CachedOriginal:
+    """A cached original. Has the parts of httpx.Response the handlers use;
+    `content` is a read-only memory map of the blob."""
+
+    status_code = 200
+
+    def __init__(
+        self, headers: httpx.Headers, content: Any, expires: float, digest: str
+    ) -> None:
+        self.headers = headers
+        self.content = content
+        self.expires = expires
+        self.digest = digest
+
+    @property
+    def is_fresh(self) -> bool:
+        return self.expires > time.time()
+
+    def validators(self) -> dict:
+        """Conditional request headers for revalidating this entry."""
+        result = {}
+        if "etag" in self.headers:
+            result["if-none-match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            result["if-modified-since"] = self.headers["last-modified"]
+        return result
+
+
+class OriginalCache:
+    """Size-bounded on-disk cache of original image responses, keyed by URL.
+
+    The methods do blocking file I/O and are run in threads."""
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._blob_dir = os.path.join(directory, "blobs")
+        self._index_dir = os.path.join(directory, "index")
+        os.makedirs(self._blob_dir, exist_ok=True)
+        os.makedirs(self._index_dir, exist_ok=True)
+
+        # Approximate total size; other processes write here too, so the real
+        # size is only computed when evicting.
+        self._size = sum(size for _, _, size in self._scan(self._blob_dir))
+        self._size_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(
+            self._index_dir, hashlib.sha256(key.encode("utf-8")).hexdigest()
+        )
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._blob_dir, digest)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self._index_path(key))
+
+    def get(self, key: str) -> Optional[CachedOriginal]:
+        index_path = self._index_path(key)
+        try:
+            with open(index_path, encoding="UTF-8") as f:
+                index = json.load(f)
+            with open(self._blob_path(index["blob"]), "rb") as f:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError):
+            log.exception("dropping unreadable cache entry for %s", key)
+            self._remove(index_path)
+            self.misses += 1
+            return None
+
+        self._touch(index_path)
+        self._touch(self._blob_path(index["blob"]))
+        self.hits += 1
+        return CachedOriginal(
+            httpx.Headers(index["headers"]), content, index["expires"], index["blob"]
+        )
+
+    def put(self, key: str, response, ttl: float) -> None:
+        """Store a complete 200 response."""
+
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            self._write_atomic(blob_path, content)
+            with self._size_lock:
+                self._size += len(content)
+        self._write_index(key, digest, response.headers, ttl)
+
+        if self._size > self.max_bytes:
+            with self._size_lock:
+                # Another thread may have evicted meanwhile
+                if self._size > self.max_bytes:
+                    self._evict()
+
+    def refresh(self, key: str, cached: CachedOriginal, response, ttl: float) -> None:
+        """Update headers and expiry of an entry after a 304 revalidation."""
+
+        headers = httpx.Headers(cached.headers)
+        for name in STORED_HEADERS:
+            if name in response.headers:
+                headers[name] = response.headers[name]
+        cached.headers = headers
+        cached.expires = time.time() + ttl
+        self._write_index(key, cached.digest, headers, ttl)
+
+    def _write_index(self, key: str, digest: str, headers, ttl: float) -> None:
+        index = {
+            "blob": digest,
+            "headers": [
+                (name, headers[name]) for name in STORED_HEADERS if name in headers
+            ],
+            "expires": time.time() + ttl,
+        }
+        self._write_atomic(self._index_path(key), json.dumps(index).encode("utf-8"))
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+    def _evict(self) -> None:
+        """Delete least recently used blobs until the cache is below 90% of its
+        size limit, then index entries that haven't been used since. Called with
+        the size lock held."""
+
+        blobs = sorted(self._scan(self._blob_dir))
+        total = sum(size for _, _, size in blobs)
+        target = self.max_bytes * 0.9
+        cutoff = 0.0
+        for mtime, path, size in blobs:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            cutoff = mtime
+        self._size = total
+
+        for mtime, path, _ in self._scan(self._index_dir):
+            if mtime <= cutoff:
+                self._remove(path)
+        log.debug("evicted original cache entries, size now %d bytes", total)
+
+    @staticmethod
+    def _scan(directory: str) -> List[Tuple[float, str, int]]:
+        result = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, entry.path, stat.st_size))
+        return result
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
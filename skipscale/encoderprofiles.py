@@ -0,0 +1,46 @@
+"""Named encoder settings, trading compression against CPU time.
+
+Each profile has pyvips save options per output format. Quality, lossless and
+metadata stripping are set by the caller."""
+
+DEFAULT_ENCODER_PROFILE = "max"
+
+ENCODER_PROFILES = {
+    # Smallest output. Expensive for large images, AVIF in particular.
+    "max": {
+        "jpeg": {
+            "optimize_coding": True,
+            "interlace": True,
+            "trellis_quant": True,
+            "overshoot_deringing": True,
+            "optimize_scans": True,
+            "quant_table": 3,
+        },
+        "png": {"compression": 9, "effort": 10},
+        "webp": {"effort": 6},
+        "avif": {"effort": 4},
+        "gif": {"effort": 10},
+    },
+    # Without the trellis quantisation and scan optimisation that dominate JPEG
+    # encoding time, and a lower WebP/PNG/AVIF/GIF effort.
+    "balanced": {
+        "jpeg": {
+            "optimize_coding": True,
+            "interlace": True,
+            "overshoot_deringing": True,
+            "quant_table": 3,
+        },
+        "png": {"compression": 6},
+        "webp": {"effort": 4},
+        "avif": {"effort": 2},
+        "gif": {"effort": 7},
+    },
+    # Baseline JPEG with optimised Huffman tables only.
+    "fast": {
+        "jpeg": {"optimize_coding": True, "quant_table": 3},
+        "png": {"compression": 3},
+        "webp": {"effort": 2},
+        "avif": {"effort": 0},
+        "gif": {"effort": 1},
+    },
+}
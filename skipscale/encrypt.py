@@ -2,15 +2,14 @@ import asyncio
 import base64
 import binascii
 from typing import Any
-from urllib.parse import urljoin
 
-from httpx import AsyncClient
 from schema import Schema, Optional, SchemaError
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 import validators
 
+from skipscale.planner import fetch_center_point, fetch_imageinfo
 from skipscale.urlcrypto import encrypt_url
 from skipscale.utils import get_logger
 from skipscale.config import Config
@@ -48,6 +47,46 @@ def authenticate(request, tenant) -> bool:
     return False
 
 
+async def thumbnail_crop(
+    request: Request, tenant: str, encrypted_url: str
+) -> dict[str, Any]:
+    """Center point and size of an image, as thumbnail_crop and properties. Either
+    is left out if it is not available in time.
+
+    The size comes from imageinfo, which the planner caches, and visionrecognizer
+    is only asked for the center point."""
+
+    config: Config = request.app.state.config
+    timeout = config.thumbnail_crop_timeout_seconds()
+    try:
+        imageinfo, _ = await asyncio.wait_for(
+            fetch_imageinfo(
+                request, tenant, encrypted_url, {}, forward_conditional_headers=False
+            ),
+            timeout,
+        )
+    except Exception as exc:
+        log.debug("imageinfo for thumbnail crop failed: %r", exc)
+        return {}
+
+    crop: dict[str, Any] = {}
+    if imageinfo["format"] != "svg" and config.visionrecognizer_url() is not None:
+        try:
+            center_point = await asyncio.wait_for(
+                fetch_center_point(request, tenant, encrypted_url, {}), timeout
+            )
+        except asyncio.TimeoutError:
+            log.debug("visionrecognizer for thumbnail crop timed out")
+            center_point = None
+        if center_point is not None:
+            crop["thumbnail_crop"] = {
+                "center_x": center_point[0],
+                "center_y": center_point[1],
+            }
+    crop["properties"] = {"width": imageinfo["width"], "height": imageinfo["height"]}
+    return crop
+
+
 async def encrypt(request: Request):
     tenant = request.path_params["tenant"]
     if not authenticate(request, tenant):
@@ -67,10 +106,6 @@ async def encrypt(request: Request):
         raise HTTPException(400, detail="Missing configuration")
 
     config: Config = request.app.state.config
-    visionrecognizer_prefix = urljoin(
-        config.cache_endpoint(),
-        config.app_path_prefixes()[0] + "visionrecognizer/" + tenant + "/",
-    )
     image_prefix = config.encryption_url_prefix(tenant) + tenant + "/"
     asset_url_prefix = config.encryption_asset_url_prefix(tenant)
     if asset_url_prefix:
@@ -96,53 +131,20 @@ async def encrypt(request: Request):
                 extension = ""
             result[url] = prefix + encrypt_url(key, tenant, url) + extension
 
-    async def visionrecognizer_call(src_url, encrypted_url):
-        visionrecognizer_url = visionrecognizer_prefix + encrypted_url
-        client: AsyncClient = request.app.state.httpx_client
-        req = client.build_request("GET", visionrecognizer_url)
-        try:
-            r = await client.send(req)
-            result = r.json()
-            thumbnail_crop = {
-                "center_x": result["centerPoint"]["x"],
-                "center_y": 1.0
-                - result["centerPoint"]["y"],  # visionrecognizer has a flipped y-axis
-            }
-            image_properties = {
-                "width": result["imageSize"]["w"],
-                "height": result["imageSize"]["h"],
-            }
-        except Exception:
-            return {"src_url": src_url, "encrypted_url": encrypted_url}
-
-        return {
-            "src_url": src_url,
-            "encrypted_url": encrypted_url,
-            "thumbnail_crop": thumbnail_crop,
-            "properties": image_properties,
-        }
-
     if body.get("include_thumbnail_crop"):
         image_encrypt_result: dict[str, str] = {}
         array_to_result(image_encrypt_result, body.get("urls", []))
-        visionrecognizer_calls = []
-        for src_url, encrypted_url in image_encrypt_result.items():
-            visionrecognizer_calls.append(visionrecognizer_call(src_url, encrypted_url))
-        for visionrecognizer_result in await asyncio.gather(*visionrecognizer_calls):
-            img_result: dict[str, str]
-            if "thumbnail_crop" in visionrecognizer_result:
-                img_result = {
-                    "encrypted_url": image_prefix
-                    + visionrecognizer_result["encrypted_url"],
-                    "thumbnail_crop": visionrecognizer_result["thumbnail_crop"],
-                    "properties": visionrecognizer_result["properties"],
-                }
-            else:
-                img_result = {
-                    "encrypted_url": image_prefix
-                    + visionrecognizer_result["encrypted_url"]
-                }
-            result[visionrecognizer_result["src_url"]] = img_result
+        semaphore = asyncio.Semaphore(config.thumbnail_crop_concurrency())
+
+        async def bounded(encrypted_url):
+            async with semaphore:
+                return await thumbnail_crop(request, tenant, encrypted_url)
+
+        crops = await asyncio.gather(
+            *(bounded(url) for url in image_encrypt_result.values())
+        )
+        for (src_url, encrypted_url), crop in zip(image_encrypt_result.items(), crops):
+            result[src_url] = {"encrypted_url": image_prefix + encrypted_url, **crop}
     else:
         array_to_result(result, body.get("urls", []), image_prefix)
 
@@ -0,0 +1,180 @@
+"""Long-lived httpx clients for outgoing requests."""
+
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+
+import httpx
+
+from skipscale.config import Config
+from skipscale.utils import get_logger
+
+log = get_logger(__name__)
+
+# Clients replaced by a configuration reload are closed after this long, so that
+# requests in progress can finish.
+RETIRED_CLIENT_CLOSE_DELAY_SECONDS = 300
+
+
+@dataclass(frozen=True)
+class TransportSettings:
+    timeout_seconds: float
+    connect_timeout_seconds: float
+    max_connections: Optional[int]
+    max_keepalive_connections: Optional[int]
+    http2: bool
+    local_address: Optional[str]
+    proxy: Optional[str] = None
+
+    @classmethod
+    def for_origin(cls, config: Config, tenant: Optional[str] = None):
+        return cls(
+            timeout_seconds=config.origin_request_timeout_seconds(tenant),
+            connect_timeout_seconds=config.origin_request_connect_timeout_seconds(
+                tenant
+            ),
+            max_connections=config.origin_request_max_connections(tenant),
+            max_keepalive_connections=config.origin_request_max_keepalive_connections(
+                tenant
+            ),
+            http2=config.origin_request_http2(tenant),
+            local_address=config.origin_request_local_address(),
+            proxy=config.proxy(tenant) if tenant is not None else None,
+        )
+
+    @classmethod
+    def for_cache_endpoint(cls, config: Config):
+        return cls(
+            timeout_seconds=config.cache_endpoint_timeout_seconds(),
+            connect_timeout_seconds=config.cache_endpoint_connect_timeout_seconds(),
+            max_connections=config.cache_endpoint_max_connections(),
+            max_keepalive_connections=config.cache_endpoint_max_keepalive_connections(),
+            http2=config.cache_endpoint_http2(),
+            local_address=config.origin_request_local_address(),
+        )
+
+    def build_client(self) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(
+            self.timeout_seconds, connect=self.connect_timeout_seconds
+        )
+        limits = httpx.Limits(
+            max_keepalive_connections=self.max_keepalive_connections,
+            max_connections=self.max_connections,
+        )
+        transport = httpx.AsyncHTTPTransport(
+            http2=self.http2,
+            limits=limits,
+            local_address=self.local_address,
+            proxy=httpx.Proxy(self.proxy) if self.proxy else None,
+        )
+        return httpx.AsyncClient(timeout=timeout, transport=transport)
+
+
+class HTTPClients:
+    """Registry of long-lived httpx clients, each with its own connection pool.
+
+    * `internal` is used for the recursive requests through the cache endpoint, so
+      that slow origins can't use up the connections these depend on.
+    * `default` uses the global origin settings. It is used for origin requests of
+      tenants that don't override them, and other external services.
+    * Tenants with their own transport settings or a proxy get a client of their
+      own, created on first use and shared by tenants with the same settings.
+      Tenants come from the request path, so only configured ones are remembered
+      and others get `default`."""
+
+    def __init__(self, config: Config) -> None:
+        self._config = config
+        self._default_settings = TransportSettings.for_origin(config)
+        self.default = self._default_settings.build_client()
+        self._internal_settings = TransportSettings.for_cache_endpoint(config)
+        self.internal = self._internal_settings.build_client()
+        # Clients other than default, by their settings
+        self._clients: Dict[TransportSettings, httpx.AsyncClient] = {}
+        # Configured tenant -> its client, which may be default
+        self._tenants: Dict[str, httpx.AsyncClient] = {}
+        self._retired: Set[httpx.AsyncClient] = set()
+        self._close_tasks: Set[asyncio.Task] = set()
+
+    def for_tenant(self, tenant: str) -> httpx.AsyncClient:
+        """Returns the client for requests to the tenant's origin."""
+
+        try:
+            return self._tenants[tenant]
+        except KeyError:
+            pass
+        if not self._config.has_tenant(tenant):
+            return self.default
+
+        settings = TransportSettings.for_origin(self._config, tenant)
+        if settings == self._default_settings:
+            client = self.default
+        else:
+            client = self._clients.get(settings)
+            if client is None:
+                log.debug("creating client for tenant %r", tenant)
+                client = self._clients[settings] = settings.build_client()
+        self._tenants[tenant] = client
+        return client
+
+    def reconfigure(self, config: Config) -> None:
+        """Switch to a reloaded configuration. Only clients whose transport settings
+        changed are replaced, the others keep their connection pools. Nothing is
+        changed if building a new client fails."""
+
+        replaced: Set[httpx.AsyncClient] = set()
+        default_settings = TransportSettings.for_origin(config)
+        default = self.default
+        if default_settings != self._default_settings:
+            default = default_settings.build_client()
+        internal_settings = TransportSettings.for_cache_endpoint(config)
+        internal = self.internal
+        if internal_settings != self._internal_settings:
+            internal = internal_settings.build_client()
+
+        self._config = config
+        if default is not self.default:
+            log.info("origin transport settings changed, replacing client")
+            replaced.add(self.default)
+            self._default_settings, self.default = default_settings, default
+        if internal is not self.internal:
+            log.info("cache endpoint transport settings changed, replacing client")
+            replaced.add(self.internal)
+            self._internal_settings, self.internal = internal_settings, internal
+
+        # Tenants get their client again on next use, from the clients whose
+        # settings some configured tenant still has
+        self._tenants.clear()
+        tenant_settings = {
+            TransportSettings.for_origin(config, tenant)
+            for tenant in config.tenant_names()
+        }
+        for settings, client in list(self._clients.items()):
+            if settings not in tenant_settings:
+                log.info("tenant transport settings changed, replacing client")
+                replaced.add(client)
+                del self._clients[settings]
+
+        if replaced:
+            self._retired |= replaced
+            asyncio.get_running_loop().call_later(
+                RETIRED_CLIENT_CLOSE_DELAY_SECONDS, self._start_close, replaced
+            )
+
+    def _start_close(self, clients: Set[httpx.AsyncClient]) -> None:
+        task = asyncio.create_task(self._close_retired(clients))
+        self._close_tasks.add(task)
+        task.add_done_callback(self._close_tasks.discard)
+
+    async def _close_retired(self, clients: Set[httpx.AsyncClient]) -> None:
+        for client in clients & self._retired:
+            self._retired.discard(client)
+            await client.aclose()
+
+    async def aclose(self) -> None:
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._tenants.clear()
+        await self._close_retired(set(self._retired))
+        await self.default.aclose()
+        await self.internal.aclose()
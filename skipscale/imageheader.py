@@ -0,0 +1,160 @@
+"""Image dimension probing from the leading bytes of an image file."""
+
+import struct
+from dataclasses import dataclass
+from typing import Optional
+
+# JPEG start-of-frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = frozenset(
+    (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+)
+
+# Standalone JPEG markers that have no length field
+JPEG_STANDALONE_MARKERS = frozenset(
+    (0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7)
+)
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+@dataclass(frozen=True)
+class ImageHeader:
+    """Dimensions after applying EXIF orientation, as pyvips autorot() would
+    report them, and the format named like vips_format_from_loader() does."""
+
+    width: int
+    height: int
+    format: str
+
+
+def probe_image_header(data: bytes) -> Optional[ImageHeader]:
+    """Parse image dimensions from the start of an image file. Returns None if
+    the format is not recognized or if the data ends before the dimensions."""
+
+    try:
+        if data.startswith(b"\xff\xd8"):
+            return _probe_jpeg(data)
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return _probe_png(data)
+        if data.startswith((b"GIF87a", b"GIF89a")):
+            return _probe_gif(data)
+        if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+            return _probe_webp(data)
+    except (struct.error, IndexError):
+        pass
+    return None
+
+
+def _probe_png(data: bytes) -> Optional[ImageHeader]:
+    if data[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack_from(">II", data, 16)
+    return ImageHeader(width, height, "png")
+
+
+def _probe_gif(data: bytes) -> Optional[ImageHeader]:
+    # Logical screen descriptor
+    width, height = struct.unpack_from("<HH", data, 6)
+    return ImageHeader(width, height, "gif")
+
+
+def _probe_webp(data: bytes) -> Optional[ImageHeader]:
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: 3 byte frame tag, 3 byte start code, then 14 bit dimensions
+        if data[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack_from("<HH", data, 26)
+        return ImageHeader(width & 0x3FFF, height & 0x3FFF, "webp")
+    if chunk == b"VP8L":
+        if data[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return ImageHeader((bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, "webp")
+    if chunk == b"VP8X":
+        if len(data) < 30:
+            return None
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        if data[20] & 0x08:
+            # The EXIF chunk may carry an orientation, but it is stored after the
+            # image data. Only succeed if we happen to have all of it.
+            orientation = _webp_exif_orientation(data)
+            if orientation is None:
+                return None
+            if orientation in (5, 6, 7, 8):
+                width, height = height, width
+        return ImageHeader(width, height, "webp")
+    return None
+
+
+def _webp_exif_orientation(data: bytes) -> Optional[int]:
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk = data[pos : pos + 4]
+        (length,) = struct.unpack_from("<I", data, pos + 4)
+        if chunk == b"EXIF":
+            payload = data[pos + 8 : pos + 8 + length]
+            if len(payload) < length:
+                return None
+            if payload.startswith(b"Exif\x00\x00"):
+                payload = payload[6:]
+            return _exif_orientation(payload) or 1
+        # Chunks are padded to an even length
+        pos += 8 + length + (length & 1)
+    return None
+
+
+def _probe_jpeg(data: bytes) -> Optional[ImageHeader]:
+    orientation = 1
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        segment = data[pos + 4 : pos + 2 + length]
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", segment, 1)
+            if orientation in (5, 6, 7, 8):
+                width, height = height, width
+            return ImageHeader(width, height, "jpeg")
+        if marker == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            if len(segment) < length - 2:
+                # EXIF continues past the data we have, and SOF is after it anyway
+                return None
+            orientation = _exif_orientation(segment[6:]) or orientation
+        if marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        pos += 2 + length
+    return None
+
+
+def _exif_orientation(tiff: bytes) -> Optional[int]:
+    byte_order: str
+    if tiff.startswith(b"II*\x00"):
+        byte_order = "<"
+    elif tiff.startswith(b"MM\x00*"):
+        byte_order = ">"
+    else:
+        return None
+
+    (ifd_offset,) = struct.unpack_from(byte_order + "I", tiff, 4)
+    (count,) = struct.unpack_from(byte_order + "H", tiff, ifd_offset)
+    for n in range(count):
+        entry = ifd_offset + 2 + n * 12
+        # SHORT values are stored left-aligned in the 4 byte value field
+        tag, value_type, _, value = struct.unpack_from(byte_order + "HHIH", tiff, entry)
+        if tag == EXIF_ORIENTATION_TAG and value_type == 3:  # SHORT
+            if 1 <= value <= 8:
+                return value
+            return None
+    return None
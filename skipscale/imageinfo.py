@@ -1,17 +1,26 @@
+from typing import Optional
+
 from pyvips import Image
 from sentry_sdk import Hub
 from starlette.requests import Request
 from starlette.responses import Response, JSONResponse
 
+from skipscale.diskcache import OriginalCache, vips_buffer
+from skipscale.imageheader import probe_image_header
+from skipscale.original import fetch_original
 from skipscale.utils import (
     cache_url,
     cache_headers_with_config,
+    content_range_total,
     make_request,
     extract_forwardable_params,
+    get_logger,
     vips_format_from_loader,
 )
 from skipscale.config import Config
 
+log = get_logger(__name__)
+
 
 async def imageinfo(request: Request):
     """Return image dimensions, format and byte size."""
@@ -34,7 +43,36 @@ async def imageinfo(request: Request):
         fwd_q,
     )
 
-    r = await make_request(request, request_url)
+    # No need to probe if the whole original is available locally.
+    probe_bytes = config.imageinfo_probe_bytes()
+    disk_cache: Optional[OriginalCache] = request.app.state.original_cache
+    if probe_bytes and (disk_cache is None or request_url not in disk_cache):
+        r = await make_request(
+            request,
+            request_url,
+            headers={
+                "range": f"bytes=0-{probe_bytes - 1}",
+                "accept-encoding": "identity",
+            },
+        )
+        if r.status_code == 206:
+            probed = probe_image_header(r.content)
+            size = content_range_total(r.headers.get("content-range"))
+            if probed is not None and size is not None:
+                return JSONResponse(
+                    {
+                        "width": probed.width,
+                        "height": probed.height,
+                        "format": probed.format,
+                        "bytes": size,
+                    },
+                    headers=cache_headers_with_config(config, tenant, r),
+                )
+            log.debug("header probe failed for %s, fetching in full", request_url)
+            r = await fetch_original(request, tenant, image_uri, fwd_q)
+        # Otherwise the origin ignored the range and sent everything (or a 304).
+    else:
+        r = await fetch_original(request, tenant, image_uri, fwd_q)
     # Technically imageinfo is ever only called internally so it doesn't need CORS headers to
     # function... but the planner will set up headers for its user-facing 304/307 responses based on
     # the headers it receives from imageinfo, so we need to pass them through for its benefit here.
@@ -55,7 +93,7 @@ async def imageinfo(request: Request):
         )
 
     try:
-        i = Image.new_from_buffer(r.content, "")
+        i = Image.new_from_buffer(vips_buffer(r.content), "")
     except Exception:
         return Response(status_code=400, headers=output_headers)
     i = i.autorot()  # rotate based on EXIF orientation
@@ -0,0 +1,69 @@
+"""A small in-process LRU cache with optional per-entry expiry."""
+
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+from skipscale import metrics
+
+
+class LRUCache:
+    """Size-bounded least recently used cache. Entries may have a time to live,
+    expired entries are dropped when they are next looked up or evicted.
+
+    Not thread safe; meant to be used from the event loop. With a name, lookups
+    and evictions are counted in the skipscale_cache_* metrics."""
+
+    def __init__(self, max_entries: int, name: Optional[str] = None) -> None:
+        self.max_entries = max_entries
+        self.name = name
+        # key -> (expires (monotonic) or None, value)
+        self._entries: "OrderedDict[Hashable, Tuple[Optional[float], Any]]" = (
+            OrderedDict()
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            self._miss()
+            return default
+
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            self._miss()
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        if self.name is not None:
+            metrics.CACHE_LOOKUPS.labels(self.name, "hit").inc()
+        return value
+
+    def _miss(self) -> None:
+        self.misses += 1
+        if self.name is not None:
+            metrics.CACHE_LOOKUPS.labels(self.name, "miss").inc()
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.max_entries <= 0:
+            return
+
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            if self.name is not None:
+                metrics.CACHE_EVICTIONS.labels(self.name).inc()
+
+    def clear(self) -> None:
+        self._entries.clear()
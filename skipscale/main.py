@@ -1,9 +1,9 @@
 """Skipscale app setup. To be imported by an ASGI runner."""
 
+import contextlib
 import logging
 import os
 
-import httpx
 import sentry_sdk
 
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
@@ -12,29 +12,63 @@ from starlette.responses import Response
 from starlette.routing import Route, Mount
 
 from skipscale.utils import get_logger
+from skipscale.appstate import ConfigReloader, init_state
 from skipscale.config import Config
+from skipscale.metrics import instrument, metrics
 from skipscale.original import original
 from skipscale.imageinfo import imageinfo
 from skipscale.visionrecognizer import visionrecognizer
 from skipscale.scale import scale
 from skipscale.encrypt import encrypt
 from skipscale.planner import planner
+from skipscale.batchplanner import batch_planner
+from skipscale.warmup import warmup, warmup_status
 
 
 async def healthcheck(_):
     return Response(status_code=200)
 
 
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    reloader = ConfigReloader(app)
+    reloader.start()
+    yield
+    reloader.stop()
+    app.state.warmup.shutdown()
+    app.state.scale_pool.shutdown()
+    await app.state.http_clients.aclose()
+
+
 routes = [
     # Used for original images
-    Route("/original/{tenant}/{image_uri:path}", original, methods=["GET", "OPTIONS"]),
+    Route(
+        "/original/{tenant}/{image_uri:path}",
+        instrument("original", original),
+        methods=["GET", "OPTIONS"],
+    ),
     # Used for reverse-proxying non-image assets
-    Route("/asset/{tenant}/{image_uri:path}", original, methods=["GET", "OPTIONS"]),
-    Route("/imageinfo/{tenant}/{image_uri:path}", imageinfo),
-    Route("/visionrecognizer/{tenant}/{image_uri:path}", visionrecognizer),
-    Route("/scale/{tenant}/{image_uri:path}", scale),
-    Route("/{tenant}/{image_uri:path}", planner),
-    Route("/{tenant}/", encrypt, methods=["POST"]),
+    Route(
+        "/asset/{tenant}/{image_uri:path}",
+        instrument("asset", original),
+        methods=["GET", "OPTIONS"],
+    ),
+    Route("/imageinfo/{tenant}/{image_uri:path}", instrument("imageinfo", imageinfo)),
+    Route(
+        "/visionrecognizer/{tenant}/{image_uri:path}",
+        instrument("visionrecognizer", visionrecognizer),
+    ),
+    Route("/scale/{tenant}/{image_uri:path}", instrument("scale", scale)),
+    Route("/metrics", metrics),
+    Route("/warmup/{tenant}/", instrument("warmup", warmup), methods=["POST"]),
+    Route("/warmup/{tenant}/{batch_id}", instrument("warmup_status", warmup_status)),
+    Route(
+        "/plan/{tenant}/",
+        instrument("batch_planner", batch_planner),
+        methods=["POST"],
+    ),
+    Route("/{tenant}/{image_uri:path}", instrument("planner", planner)),
+    Route("/{tenant}/", instrument("encrypt", encrypt), methods=["POST"]),
     Route("/", healthcheck),
 ]
 
@@ -56,26 +90,8 @@ final_routes = []
 for prefix in app_config.app_path_prefixes():
     final_routes.append(Mount(prefix, routes=routes))
 
-app = Starlette(routes=final_routes)
-app.state.config = app_config
-
-timeout = httpx.Timeout(
-    app_config.origin_request_timeout_seconds(),
-    connect=app_config.origin_request_connect_timeout_seconds(),
-)
-
-limits = httpx.Limits(
-    max_keepalive_connections=app_config.origin_request_max_keepalive_connections(),
-    max_connections=app_config.origin_request_max_connections(),
-)
-
-transport = httpx.AsyncHTTPTransport(
-    http2=app_config.origin_request_http2(),
-    limits=limits,
-    local_address=app_config.origin_request_local_address(),
-)
-
-app.state.httpx_client = httpx.AsyncClient(timeout=timeout, transport=transport)
+app = Starlette(routes=final_routes, lifespan=lifespan)
+init_state(app, app_config)
 
 if app_config.sentry_dsn():
     if app_config.sentry_traces_sample_rate():
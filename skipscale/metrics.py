@@ -0,0 +1,183 @@
+"""Prometheus metrics.
+
+With several worker processes (gunicorn, or the process scale pool backend), set
+the PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory shared by
+the processes so /metrics reports totals across all of them. Gauges of exited
+gunicorn workers are removed by the child_exit hook in gunicorn.conf.py."""
+
+import functools
+import os
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import Response
+
+if TYPE_CHECKING:
+    # skipscale.config depends on this module through skipscale.utils
+    from skipscale.config import Config
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+SIZE_BUCKETS = tuple(1024 * 4**n for n in range(9))  # 1 KiB to 64 MiB
+
+REQUEST_SECONDS = Histogram(
+    "skipscale_request_duration_seconds",
+    "Time spent handling requests, by route",
+    ["route", "tenant"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "skipscale_requests",
+    "Requests handled, by route and response status",
+    ["route", "tenant", "status"],
+)
+UPSTREAM_SECONDS = Histogram(
+    "skipscale_upstream_request_duration_seconds",
+    "Time until the response headers of outgoing requests were received",
+    ["upstream", "tenant"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_BYTES = Counter(
+    "skipscale_upstream_response_bytes",
+    "Body bytes received from outgoing requests",
+    ["upstream", "tenant"],
+)
+SCALE_QUEUE_SECONDS = Histogram(
+    "skipscale_scale_queue_seconds",
+    "Time scaling jobs waited in the scale pool queue",
+    ["tenant"],
+    buckets=LATENCY_BUCKETS,
+)
+SCALE_STAGE_SECONDS = Histogram(
+    "skipscale_scale_stage_seconds",
+    "Time spent in each stage of scaling jobs (open, decode_resize or encode)",
+    ["tenant", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+SCALE_RESPONSE_BYTES = Histogram(
+    "skipscale_scale_response_bytes",
+    "Size of scaled images, by output format",
+    ["tenant", "format"],
+    buckets=SIZE_BUCKETS,
+)
+
+SCALE_POOL_JOBS = Gauge(
+    "skipscale_scale_pool_jobs",
+    "Scaling jobs in the scale pool, by state (queued or running)",
+    ["state"],
+    multiprocess_mode="livesum",
+)
+SCALE_POOL_RESULTS = Counter(
+    "skipscale_scale_pool_results",
+    "Scaling jobs that completed or were rejected because the queue was full",
+    ["result"],
+)
+SCALE_POOL_RUN_SECONDS = Counter(
+    "skipscale_scale_pool_run_seconds",
+    "Time spent running scaling jobs in the scale pool",
+)
+CACHE_LOOKUPS = Counter(
+    "skipscale_cache_lookups",
+    "Lookups in the in-memory caches, by cache and result (hit or miss)",
+    ["cache", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "skipscale_cache_evictions",
+    "Entries evicted from the in-memory caches to stay within their size",
+    ["cache"],
+)
+SINGLEFLIGHT_CALLS = Counter(
+    "skipscale_singleflight_calls",
+    "Calls started, and identical ones in flight coalesced into them, by kind "
+    "(upstream request or scaling job)",
+    ["kind", "result"],
+)
+DECODED_CACHE_LOOKUPS = Counter(
+    "skipscale_decoded_cache_lookups",
+    "Lookups of decoded originals for scaling, by result (hit or miss)",
+    ["result"],
+)
+WARMUP_REQUESTS = Counter(
+    "skipscale_warmup_requests",
+    "Warmup requests, by result (done, failed or deduplicated)",
+    ["tenant", "result"],
+)
+
+
+def tenant_label(config: "Config", tenant: str) -> str:
+    """Tenants come from the request path. Only configured ones get a label of
+    their own, so that arbitrary paths can't create new time series."""
+
+    if config.has_tenant(tenant):
+        return tenant
+    return "other"
+
+
+def instrument(route: str, handler: Callable[[Request], Awaitable[Response]]):
+    """Wrap a request handler to record its duration and response status."""
+
+    @functools.wraps(handler)
+    async def instrumented(request: Request) -> Response:
+        tenant = tenant_label(
+            request.app.state.config, request.path_params.get("tenant", "")
+        )
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status_code
+            return response
+        except HTTPException as e:
+            status = e.status_code
+            raise
+        finally:
+            REQUEST_SECONDS.labels(route, tenant).observe(time.perf_counter() - started)
+            REQUESTS.labels(route, tenant, str(status)).inc()
+
+    return instrumented
+
+
+def _render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+async def metrics(request: Request):
+    """Metrics in the Prometheus text format."""
+
+    config: "Config" = request.app.state.config
+    if not config.metrics_enabled():
+        raise HTTPException(404)
+
+    # Reads a file per metric and process in multiprocess mode
+    content = await run_in_threadpool(_render)
+    return Response(content, media_type=CONTENT_TYPE_LATEST)
@@ -1,10 +1,19 @@
+import asyncio
+from typing import Dict, Optional
+
+from httpx import Response as UpstreamResponse
+from starlette.background import BackgroundTask
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
-from skipscale.urlcrypto import decrypt_url
+from skipscale.diskcache import OriginalCache
+from skipscale.urlcrypto import decrypt_url_cached
 from skipscale.utils import (
+    cache_url,
+    cache_control_ttl,
     cache_headers_with_config,
+    is_not_modified,
     make_request,
     get_logger,
     is_safe_path,
@@ -16,14 +25,83 @@ from sentry_sdk import Hub
 log = get_logger(__name__)
 
 
+def should_stream(r: UpstreamResponse, method: str, threshold: int) -> bool:
+    if method != "GET" or r.status_code not in (200, 206):
+        return False
+    try:
+        return int(r.headers["content-length"]) > threshold
+    except (KeyError, ValueError):
+        # Unknown length, e.g. chunked transfer encoding
+        return True
+
+
+async def stream_body(r: UpstreamResponse):
+    try:
+        async for chunk in r.aiter_bytes():
+            yield chunk
+    finally:
+        await r.aclose()
+
+
+async def fetch_original(
+    request: Request, tenant: str, image_uri: str, fwd_q: Dict[str, str]
+):
+    """Fetch an original image for processing through the cache endpoint, or from
+    the local disk cache if one is configured.
+
+    Disk cache hits are revalidated once they are stale, and conditional headers
+    of the incoming request are evaluated against the cached response."""
+
+    config: Config = request.app.state.config
+    request_url = cache_url(
+        config.cache_endpoint(),
+        config.app_path_prefixes(),
+        "original",
+        tenant,
+        image_uri,
+        fwd_q,
+    )
+
+    disk_cache: Optional[OriginalCache] = request.app.state.original_cache
+    if disk_cache is None:
+        return await make_request(request, request_url)
+
+    # The cache reads and touches files, keep that off the event loop
+    cached = await asyncio.to_thread(disk_cache.get, request_url)
+    if cached is not None and cached.is_fresh:
+        result = cached
+    else:
+        r = await make_request(
+            request,
+            request_url,
+            headers=cached.validators() if cached is not None else None,
+            forward_conditional_headers=False,
+        )
+        ttl = cache_control_ttl(r.headers.get("cache-control"))
+        if cached is not None and r.status_code == 304:
+            await asyncio.to_thread(disk_cache.refresh, request_url, cached, r, ttl)
+            result = cached
+        elif r.status_code == 200 and "vary" not in r.headers and ttl > 0:
+            # ttl is 0 for private and no-store responses as well
+            await asyncio.to_thread(disk_cache.put, request_url, r, ttl)
+            result = r
+        else:
+            return r
+
+    if is_not_modified(request.headers, result.headers):
+        return UpstreamResponse(304, headers=result.headers)
+    return result
+
+
 async def original(request: Request):
     """Return an image from the origin."""
 
     tenant = request.path_params["tenant"]
     image_uri = request.path_params["image_uri"]
     config: Config = request.app.state.config
+    tenant_config = config.tenant(tenant)
 
-    strip_regex = config.strip_regex(tenant)
+    strip_regex = tenant_config.strip_regex
     if strip_regex is not None:
         original_uri = image_uri
         image_uri = strip_regex.sub("", original_uri)
@@ -32,7 +110,7 @@ async def original(request: Request):
                 "strip_regex transformed image_uri %s -> %s", original_uri, image_uri
             )
 
-    origin = config.origin(tenant)
+    origin = tenant_config.origin
     if origin:
         # Prevent traversal past configured origin's /
         if not is_safe_path(image_uri):
@@ -53,13 +131,17 @@ async def original(request: Request):
             )
     else:
         # If no origin is specified for the tenant, we expect encrypted urls.
-        key = config.encryption_key(tenant)
+        key = tenant_config.encryption_key
         if key is None:
             raise HTTPException(400)
         try:
-            request_url = decrypt_url(
-                key, tenant, image_uri.split(".")[0]
-            )  # omit file extension from encrypted url
+            request_url = decrypt_url_cached(
+                request.app.state.decrypted_url_cache,
+                key,
+                tenant,
+                image_uri.split(".")[0],  # omit file extension from encrypted url
+                request.app.state.invalid_url_cache,
+            )
         except Exception:
             raise HTTPException(400)
         log.debug(
@@ -76,17 +158,52 @@ async def original(request: Request):
     if method != "GET":
         log.debug("forwarding %s request to %s", request.method, request_url)
 
+    # Range requests are passed through, imageinfo uses them to read only the
+    # image header. A partial body can't be decoded, so ask for identity encoding.
+    range_headers = None
+    if "range" in request.headers:
+        range_headers = {
+            "range": request.headers["range"],
+            "accept-encoding": "identity",
+        }
+
+    stream_threshold = config.original_stream_threshold_bytes()
     r = await make_request(
         request,
         request_url,
-        proxy=config.proxy(tenant),
+        origin_tenant=tenant,
         method=method,
         follow_redirects=True,
+        headers=range_headers,
+        stream=stream_threshold is not None,
     )
     output_headers = cache_headers_with_config(config, tenant, r)
 
     if "content-type" in r.headers:
         output_headers["content-type"] = r.headers["content-type"]
+    if "content-range" in r.headers:
+        output_headers["content-range"] = r.headers["content-range"]
+
+    if stream_threshold is not None:
+        if should_stream(r, method, stream_threshold):
+            # Upstream content-length may include content-encoding, which is reversed
+            # by httpx. It is only valid for the decoded stream with identity encoding.
+            if (
+                "content-length" in r.headers
+                and r.headers.get("content-encoding", "identity") == "identity"
+            ):
+                output_headers["content-length"] = r.headers["content-length"]
+            log.debug("streaming response from %s", request_url)
+            # The background task closes the upstream response even if the client
+            # disconnects before the body iterator is started.
+            return StreamingResponse(
+                stream_body(r),
+                status_code=r.status_code,
+                headers=output_headers,
+                background=BackgroundTask(r.aclose),
+            )
+        await r.aread()
+
     # Since we're not streaming we know the real length.
     # Upstream content-length may include content-encoding, which is reversed by httpx.
     if method == "HEAD":
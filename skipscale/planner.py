@@ -1,12 +1,20 @@
+from urllib.parse import urljoin
+
 from schema import Schema, And, Optional, Use
+from starlette.background import BackgroundTask
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import Response, RedirectResponse
+from starlette.responses import Response, RedirectResponse, StreamingResponse
 
-from skipscale.planner_math import plan_scale
+from skipscale.encoderprofiles import DEFAULT_ENCODER_PROFILE
+from skipscale.lrucache import LRUCache
+from skipscale.original import stream_body
+from skipscale.planner_math import ScaleDimensions, plan_scale
+from skipscale.scale import LOSSY_FORMATS, avif_supported
 from skipscale.utils import (
     cache_url,
     cache_headers_with_config,
+    cache_control_ttl,
     make_request,
     get_logger,
     extract_forwardable_params,
@@ -18,6 +26,19 @@ from sentry_sdk import Hub
 # Image formats which will not be scaled by default
 NONSCALED_FORMATS = frozenset(('gif', 'png'))
 
+# Headers of the canonical response passed on by planner_internal_render
+RENDERED_HEADERS = (
+    "content-type",
+    "cache-control",
+    "expires",
+    "etag",
+    "last-modified",
+    "vary",
+    "access-control-allow-origin",
+    "server-timing",
+    "x-skipscale-quality",
+)
+
 log = get_logger(__name__)
 
 dimensions_fields = {
@@ -34,8 +55,11 @@ dimensions_fields = {
 additional_fields = {
     Optional("size"): And(Use(int), lambda n: n >= 0),
     Optional("quality"): And(Use(int), lambda n: 0 < n <= 100),
+    Optional("max_bytes"): And(Use(int), lambda n: n > 0),
     Optional("format"): And(
-        str, Use(str.lower), lambda s: s in ("jpeg", "png", "webp")
+        str,
+        Use(str.lower),
+        lambda s: s in ("jpeg", "png", "webp", "avif", "gif", "auto"),
     ),
 }
 
@@ -50,18 +74,43 @@ query_schema = Schema(
 )
 
 
-async def planner(request: Request):
-    """Redirect to a canonical url based on the request and the original image dimensions."""
+def accepted_media_types(accept: str | None) -> set[str]:
+    """Media types in an Accept header, except those with q=0."""
 
-    tenant = request.path_params["tenant"]
-    image_uri = request.path_params["image_uri"]
-    config: Config = request.app.state.config
+    result = set()
+    for media_range in (accept or "").split(","):
+        media_type, *params = media_range.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = media_type.strip().lower()
+        if media_type and quality > 0:
+            result.add(media_type)
+    return result
 
-    span = Hub.current.scope.span
-    if span is not None:
-        span.set_tag("tenant", tenant)
 
-    in_q, fwd_q = extract_forwardable_params(dict(request.query_params))
+def negotiate_format(accept: str | None) -> str:
+    """Smallest output format the client accepts. Wildcards are not taken to
+    include AVIF or WebP, since browsers without support send them too."""
+
+    accepted = accepted_media_types(accept)
+    if "image/avif" in accepted and avif_supported():
+        return "avif"
+    if "image/webp" in accepted:
+        return "webp"
+    return "jpeg"
+
+
+def validate_query(in_q: dict) -> dict:
+    """Validate and normalize planner parameters. Raises HTTPException(400) for
+    invalid combinations."""
+
+    in_q = dict(in_q)
     if "center-x" in in_q:
         in_q["center_x"] = in_q.pop("center-x")
     if "center-y" in in_q:
@@ -70,7 +119,6 @@ async def planner(request: Request):
     try:
         q = query_schema.validate(in_q)
     except Exception:
-        log.warning("invalid query parameters (planner) in request %s", request.url)
         raise HTTPException(400, "invalid set of query parameters")
 
     # size is a shortcut to set width/height to the same size and force fit mode
@@ -101,6 +149,23 @@ async def planner(request: Request):
     if q.get("mode") == "crop" and ("width" not in q or "height" not in q):
         raise HTTPException(400, "both width and height are required when cropping")
 
+    if q.get("format") == "avif" and not avif_supported():
+        raise HTTPException(400, "AVIF output is not supported")
+
+    return q
+
+
+async def fetch_imageinfo(
+    request: Request,
+    tenant: str,
+    image_uri: str,
+    fwd_q: dict,
+    forward_conditional_headers: bool = True,
+) -> tuple[dict | None, dict[str, str]]:
+    """Imageinfo of an image and the cache headers to respond with. The imageinfo
+    is None if the request was answered with a 304."""
+
+    config: Config = request.app.state.config
     imageinfo_url = cache_url(
         config.cache_endpoint(),
         config.app_path_prefixes(),
@@ -109,19 +174,76 @@ async def planner(request: Request):
         image_uri,
         fwd_q,
     )
-    r = await make_request(request, imageinfo_url)
-    output_headers = cache_headers_with_config(config, tenant, r)
+    # Conditional requests are always passed on, so that imageinfo can answer them
+    # with a 304. The Origin header affects the CORS headers we receive.
+    imageinfo_cache: LRUCache = request.app.state.imageinfo_cache
+    use_cache = not forward_conditional_headers or (
+        "if-none-match" not in request.headers
+        and "if-modified-since" not in request.headers
+    )
+    cache_key = (
+        tenant,
+        image_uri,
+        tuple(sorted(fwd_q.items())),
+        request.headers.get("origin"),
+    )
+    cached = imageinfo_cache.get(cache_key) if use_cache else None
+    if cached is not None:
+        imageinfo, output_headers = cached
+        output_headers = dict(output_headers)
+    else:
+        r = await make_request(
+            request,
+            imageinfo_url,
+            forward_conditional_headers=forward_conditional_headers,
+        )
+        output_headers = cache_headers_with_config(config, tenant, r)
+
+        if r.status_code == 304:
+            return None, output_headers
+
+        imageinfo = r.json()
+        ttl = min(
+            cache_control_ttl(output_headers.get("cache-control")),
+            config.imageinfo_cache_max_ttl_seconds(),
+        )
+        if use_cache and ttl > 0:
+            imageinfo_cache.set(cache_key, (imageinfo, dict(output_headers)), ttl)
+
+    return imageinfo, output_headers
 
-    if r.status_code == 304:
-        return Response(status_code=304, headers=output_headers)
 
-    imageinfo = r.json()
+def needs_center_point(config: Config, q: dict, imageinfo: dict) -> bool:
+    """Crop requested but center point not specified, so feature detection is
+    needed."""
+
+    return (
+        imageinfo["format"] != "svg"
+        and q.get("mode") == "crop"
+        and "center_x" not in q
+        and config.visionrecognizer_url() is not None
+    )
+
+
+def canonical_url(
+    config: Config,
+    tenant: str,
+    image_uri: str,
+    fwd_q: dict,
+    q: dict,
+    imageinfo: dict,
+    accept: str | None = None,
+    scale_dimensions: ScaleDimensions | None = None,
+) -> str:
+    """Relative URL of the original or scaled image that serves a validated
+    request best. scale_dimensions can be given when already planned, as the
+    batch planner does with plan_scale_many."""
 
     if imageinfo["format"] == "svg":
-        if q.get("mode") == "crop" or "format" in q:
+        if q.get("mode") == "crop" or q.get("format", "auto") != "auto":
             raise HTTPException(400, "cannot crop or convert SVG images")
         # The request is best served by the original image, so redirect straight to that.
-        original_url = cache_url(
+        return cache_url(
             None,  # Get relative URL for redirect
             config.app_path_prefixes(),
             "original",
@@ -129,46 +251,15 @@ async def planner(request: Request):
             image_uri,
             fwd_q,
         )
-        log.debug(
-            "redirecting to original request %s with input path %s",
-            original_url,
-            request.url.path,
-        )
-        return RedirectResponse(original_url, headers=output_headers)
 
-    if (
-        "mode" in q
-        and (q["mode"] == "crop" and "center_x" not in q)
-        and config.visionrecognizer_url() is not None
-    ):
-        # Crop requested but center point not specified. Perform feature detection.
-        visionrecognizer_url = cache_url(
-            config.cache_endpoint(),
-            config.app_path_prefixes(),
-            "visionrecognizer",
-            tenant,
-            image_uri,
-            fwd_q,
+    tenant_config = config.tenant(tenant)
+    if scale_dimensions is None:
+        scale_dimensions = plan_scale(
+            imageinfo["width"],
+            imageinfo["height"],
+            max_pixel_ratio=tenant_config.max_pixel_ratio,
+            **dimensions_schema.validate(q),
         )
-        try:
-            r = await make_request(request, visionrecognizer_url)
-            if r.status_code == 304:
-                return Response(status_code=304, headers=output_headers)
-            visionrecognizer_result = r.json()
-            q["center_x"] = visionrecognizer_result["centerPoint"]["x"]
-            q["center_y"] = (
-                1.0 - visionrecognizer_result["centerPoint"]["y"]
-            )  # visionrecognizer has a flipped y-axis
-        except Exception:
-            # the downstream code defaults to center crop
-            pass
-
-    scale_dimensions = plan_scale(
-        imageinfo["width"],
-        imageinfo["height"],
-        max_pixel_ratio=config.max_pixel_ratio(tenant),
-        **dimensions_schema.validate(q),
-    )
     size_identical = (
         scale_dimensions.width == imageinfo["width"]
         and scale_dimensions.height == imageinfo["height"]
@@ -177,13 +268,24 @@ async def planner(request: Request):
     if "quality" in q:
         quality = q["quality"]
     else:
-        quality = config.default_quality(tenant)
+        quality = tenant_config.default_quality
 
-    default_format = config.default_format(tenant)
-    force_default = config.force_default_format(tenant)
+    default_format = tenant_config.default_format
+    force_default = tenant_config.force_default_format
     is_nonscaled_source = imageinfo['format'] in NONSCALED_FORMATS
+    # GIFs are scaled and stay animated as GIF or WebP, see scale_animations
+    scale_gif = imageinfo["format"] == "gif" and tenant_config.scale_animations
 
-    if "format" in q:
+    if q.get("format") == "auto":
+        if scale_gif and not force_default:
+            format = "webp" if "image/webp" in accepted_media_types(accept) else "gif"
+        elif is_nonscaled_source and not force_default:
+            # Like with default_format, keep graphics and animations as they are
+            format = imageinfo["format"]
+        else:
+            format = negotiate_format(accept)
+            log.debug("negotiated format %s for Accept: %s", format, accept)
+    elif "format" in q:
         format = q["format"]
     elif default_format and not size_identical and \
          (not is_nonscaled_source or force_default):
@@ -200,13 +302,18 @@ async def planner(request: Request):
     else:
         format = imageinfo["format"]
 
-    if (size_identical and format == imageinfo["format"] and "quality" not in q) or \
-       (is_nonscaled_source and format in NONSCALED_FORMATS):
+    if (
+        size_identical
+        and format == imageinfo["format"]
+        and "quality" not in q
+        and "max_bytes" not in q
+    ) or (is_nonscaled_source and format in NONSCALED_FORMATS and not scale_gif):
         # The request is best served by the original image, so redirect straight to that.
         # This happens if either:
         # a) no scaling or format/quality conversion would happen, or
-        # b) both the source and target formats are non-scaleable (see comment above).
-        original_url = cache_url(
+        # b) both the source and target formats are non-scaleable (see comment above),
+        #    unless GIFs are scaled for this tenant.
+        return cache_url(
             None,  # Get relative URL for redirect
             config.app_path_prefixes(),
             "original",
@@ -214,12 +321,6 @@ async def planner(request: Request):
             image_uri,
             fwd_q,
         )
-        log.debug(
-            "redirecting to original request %s with input path %s",
-            original_url,
-            request.url.path,
-        )
-        return RedirectResponse(original_url, headers=output_headers)
 
     scale_params = {
         "width": scale_dimensions.width,
@@ -228,7 +329,17 @@ async def planner(request: Request):
         "quality": quality,
         "format": format,
     }
-    scale_url = cache_url(
+    if "max_bytes" in q and format in LOSSY_FORMATS:
+        # quality is then the highest quality tried
+        scale_params["max_bytes"] = q["max_bytes"]
+    profile = tenant_config.encoder_profile_for(
+        scale_dimensions.width * scale_dimensions.height
+    )
+    if profile != DEFAULT_ENCODER_PROFILE:
+        # Part of the canonical URL so that cached images match their settings.
+        # Left out for the default to keep existing URLs unchanged.
+        scale_params["profile"] = profile
+    return cache_url(
         None,  # Get relative URL for redirect
         config.app_path_prefixes(),
         "scale",
@@ -236,9 +347,122 @@ async def planner(request: Request):
         image_uri,
         scale_params | fwd_q,
     )
-    log.debug(
-        "redirecting to scale request %s with input path %s",
-        scale_url,
-        request.url.path,
+
+
+async def fetch_center_point(
+    request: Request, tenant: str, image_uri: str, fwd_q: dict
+) -> tuple[float, float] | None:
+    """Focal point found by visionrecognizer, None if it is not available."""
+
+    config: Config = request.app.state.config
+    visionrecognizer_url = cache_url(
+        config.cache_endpoint(),
+        config.app_path_prefixes(),
+        "visionrecognizer",
+        tenant,
+        image_uri,
+        fwd_q,
+    )
+    try:
+        r = await make_request(
+            request, visionrecognizer_url, forward_conditional_headers=False
+        )
+        visionrecognizer_result = r.json()
+        return (
+            visionrecognizer_result["centerPoint"]["x"],
+            1.0 - visionrecognizer_result["centerPoint"]["y"],
+        )  # visionrecognizer has a flipped y-axis
+    except Exception:
+        return None
+
+
+def merge_vary(output_headers: dict, vary: dict) -> None:
+    """Add the Vary header in vary to the one in output_headers, if any."""
+
+    if vary:
+        output_headers["vary"] = ", ".join(
+            v for v in (output_headers.get("vary"), vary["vary"]) if v
+        )
+
+
+async def render_canonical(request: Request, url: str, vary: dict) -> Response:
+    """Respond with the image at the canonical URL, fetched through the cache
+    endpoint, instead of redirecting to it. Content-Location has the canonical URL,
+    so that a cache can also store the response under it."""
+
+    config: Config = request.app.state.config
+    r = await make_request(request, urljoin(config.cache_endpoint(), url), stream=True)
+    output_headers = {
+        name: r.headers[name] for name in RENDERED_HEADERS if name in r.headers
+    }
+    merge_vary(output_headers, vary)
+    output_headers["content-location"] = url
+
+    if r.status_code == 304:
+        await r.aclose()
+        return Response(status_code=304, headers=output_headers)
+    # Upstream content-length is only valid for the decoded stream with identity
+    # encoding, see original.
+    if (
+        "content-length" in r.headers
+        and r.headers.get("content-encoding", "identity") == "identity"
+    ):
+        output_headers["content-length"] = r.headers["content-length"]
+    return StreamingResponse(
+        stream_body(r),
+        status_code=r.status_code,
+        headers=output_headers,
+        background=BackgroundTask(r.aclose),
+    )
+
+
+async def planner(request: Request):
+    """Redirect to a canonical url based on the request and the original image dimensions.
+    With planner_internal_render, respond with the image at that url instead."""
+
+    tenant = request.path_params["tenant"]
+    image_uri = request.path_params["image_uri"]
+    config: Config = request.app.state.config
+
+    span = Hub.current.scope.span
+    if span is not None:
+        span.set_tag("tenant", tenant)
+
+    in_q, fwd_q = extract_forwardable_params(dict(request.query_params))
+    try:
+        q = validate_query(in_q)
+    except HTTPException:
+        log.warning("invalid query parameters (planner) in request %s", request.url)
+        raise
+
+    if q.get("format") == "auto" and not config.tenant(tenant).auto_format:
+        raise HTTPException(400, "format=auto is not enabled")
+    # With format=auto, the response depends on the Accept header
+    vary = {"vary": "Accept"} if q.get("format") == "auto" else {}
+
+    imageinfo, output_headers = await fetch_imageinfo(request, tenant, image_uri, fwd_q)
+    # Keeps the Vary: origin of a CORS response
+    merge_vary(output_headers, vary)
+    if imageinfo is None:
+        return Response(status_code=304, headers=output_headers)
+
+    if needs_center_point(config, q, imageinfo):
+        center_point = await fetch_center_point(request, tenant, image_uri, fwd_q)
+        if center_point is not None:
+            # Otherwise the downstream code defaults to center crop
+            q["center_x"], q["center_y"] = center_point
+
+    url = canonical_url(
+        config,
+        tenant,
+        image_uri,
+        fwd_q,
+        q,
+        imageinfo,
+        request.headers.get("accept"),
     )
-    return RedirectResponse(scale_url, headers=output_headers)
+    if config.tenant(tenant).planner_internal_render:
+        log.debug("rendering %s with input path %s", url, request.url.path)
+        return await render_canonical(request, url, vary)
+    log.debug("redirecting to %s with input path %s", url, request.url.path)
+    return RedirectResponse(url, headers=output_headers)
@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Literal
+from typing import Literal, Sequence
+
+import numpy as np
 
 from skipscale.utils import get_logger
 
@@ -192,3 +194,116 @@ def plan_scale(
     )
 
     return scale_params
+
+
+@dataclass(frozen=True)
+class ScaleDimensionsArray:
+    """ScaleDimensions of many requests, as one array per field."""
+
+    width: np.ndarray
+    height: np.ndarray
+    source_x: np.ndarray
+    source_y: np.ndarray
+    source_x2: np.ndarray
+    source_y2: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.width)
+
+    def __getitem__(self, i: int) -> ScaleDimensions:
+        return ScaleDimensions(
+            width=int(self.width[i]),
+            height=int(self.height[i]),
+            source_x=int(self.source_x[i]),
+            source_y=int(self.source_y[i]),
+            source_x2=int(self.source_x2[i]),
+            source_y2=int(self.source_y2[i]),
+        )
+
+
+def _round_half_up(x: np.ndarray) -> np.ndarray:
+    """Decimal(x).quantize(1, rounding=ROUND_HALF_UP) for non-negative floats.
+    x - floor(x) is exact, unlike x + 0.5."""
+    whole = np.floor(x)
+    return (whole + (x - whole >= 0.5)).astype(np.int64)
+
+
+def plan_scale_many(
+    original_width: Sequence[int] | np.ndarray,
+    original_height: Sequence[int] | np.ndarray,
+    width: Sequence[int] | np.ndarray | int | None = None,
+    height: Sequence[int] | np.ndarray | int | None = None,
+    dpr: Sequence[int] | np.ndarray | int | None = None,
+    mode: Sequence[str | None] | str | None = None,
+    center_x: Sequence[float] | np.ndarray | float | None = None,
+    center_y: Sequence[float] | np.ndarray | float | None = None,
+    max_pixel_ratio: int | None = None,
+) -> ScaleDimensionsArray:
+    """plan_scale for many requests at once, with identical results. Arguments are
+    broadcast against each other. Unset values are given as 0 for width and
+    height, 1 for dpr, None for mode and NaN for center_x and center_y."""
+
+    ow, oh, w, h, d, cx, cy, modes = np.broadcast_arrays(
+        np.asarray(original_width, dtype=np.int64),
+        np.asarray(original_height, dtype=np.int64),
+        np.asarray(0 if width is None else width, dtype=np.int64),
+        np.asarray(0 if height is None else height, dtype=np.int64),
+        np.asarray(1 if dpr is None else dpr, dtype=np.int64),
+        np.asarray(np.nan if center_x is None else center_x, dtype=np.float64),
+        np.asarray(np.nan if center_y is None else center_y, dtype=np.float64),
+        np.asarray(mode, dtype=object),
+    )
+
+    if max_pixel_ratio:
+        d = np.where(d > max_pixel_ratio, max_pixel_ratio, d)
+    w = w * d
+    h = h * d
+
+    is_stretch = modes == "stretch"
+    is_fit = (modes == "fit") | np.equal(modes, None)
+    is_crop = ~(is_stretch | is_fit)
+
+    # Fit mode, see bounding_box
+    box_w = np.where((w == 0) | (w > ow), ow, w)
+    box_h = np.where((h == 0) | (h > oh), oh, h)
+    wider = ow * box_h > box_w * oh
+    fit_w = np.where(wider, box_w, _round_half_up((box_h * ow) / oh))
+    fit_h = np.where(wider, _round_half_up((box_w * oh) / ow), box_h)
+
+    # Crop mode, see crop_box and crop_origin. Other modes may divide by zero here.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crop_ratio = w / h
+        original_wider = ow / oh > crop_ratio
+        cropped_w = np.where(original_wider, _round_half_up(oh * crop_ratio), ow)
+        cropped_h = np.where(original_wider, oh, _round_half_up(ow / crop_ratio))
+    shrink = (w > cropped_w) | (h > cropped_h)
+    crop_w = np.where(shrink, cropped_w, w)
+    crop_h = np.where(shrink, cropped_h, h)
+
+    def select_span(cropped_length, original_length, center_point):
+        center_point = np.where(np.isnan(center_point), 0.5, center_point)
+        ideal_crop_origin = original_length * center_point - cropped_length / 2
+        clamped = np.minimum(
+            np.maximum(ideal_crop_origin, 0), original_length - cropped_length
+        )
+        # round() rounds half to even, like rint
+        return np.rint(clamped).astype(np.int64)
+
+    crop_horizontally = cropped_w < ow
+    crop_x = np.where(crop_horizontally, select_span(cropped_w, ow, cx), 0)
+    crop_y = np.where(crop_horizontally, 0, select_span(cropped_h, oh, cy))
+
+    source_x = np.where(is_crop, crop_x, 0)
+    source_y = np.where(is_crop, crop_y, 0)
+    return ScaleDimensionsArray(
+        width=np.select(
+            [is_stretch, is_fit], [np.minimum(w, ow), fit_w], default=crop_w
+        ),
+        height=np.select(
+            [is_stretch, is_fit], [np.minimum(h, oh), fit_h], default=crop_h
+        ),
+        source_x=source_x,
+        source_y=source_y,
+        source_x2=np.where(is_crop, source_x + (cropped_w - 1), ow),
+        source_y2=np.where(is_crop, source_y + (cropped_h - 1), oh),
+    )
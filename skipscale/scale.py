@@ -1,76 +1,340 @@
-import asyncio
-import concurrent.futures
 import functools
+import time
 
-from pyvips import Image
+from pyvips import Error, GValue, Image
 from schema import Schema, And, Optional, Use
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
 from starlette.responses import Response
 
+from skipscale import metrics
+from skipscale.diskcache import vips_buffer
+from skipscale.encoderprofiles import DEFAULT_ENCODER_PROFILE, ENCODER_PROFILES
+from skipscale.original import fetch_original
 from skipscale.utils import (
-    cache_url,
     cache_headers_with_config,
-    make_request,
     get_logger,
     extract_forwardable_params,
     vips_format_from_loader,
+    SingleFlight,
 )
 from skipscale.config import Config
+from skipscale.scalepool import ScalePool
 
 from sentry_sdk import Hub
 
 log = get_logger(__name__)
 
+# Source and output formats that can hold animations
+ANIMATED_FORMATS = frozenset(("gif", "webp"))
+
+# Output formats for which max_bytes searches the quality
+LOSSY_FORMATS = frozenset(("jpeg", "webp", "avif"))
+# Lowest quality max_bytes goes down to, and the most encodes it may take
+MAX_BYTES_MIN_QUALITY = 10
+MAX_BYTES_MAX_ENCODES = 8
+
+
+@functools.cache
+def avif_supported() -> bool:
+    """libvips may be built without libheif, or libheif without an AV1 encoder."""
+
+    try:
+        Image.black(16, 16).heifsave_buffer(compression="av1", effort=0)
+    except Error:
+        return False
+    return True
+
+
+def avif_quality(quality: int) -> int:
+    """Map a JPEG-like quality to the AVIF quantizer scale, where libvips' default
+    of 50 is roughly comparable to JPEG quality 80."""
+
+    return max(1, min(100, round(quality * 50 / 80)))
+
+
+def _output_size(crop_width, crop_height, width, height):
+    """Dimensions thumbnail_image would give for a full-resolution crop of the given
+    size. The pipeline is lazy, so this doesn't compute any pixels."""
+
+    t = Image.black(crop_width, crop_height).thumbnail_image(
+        width, height=height, size="both", linear=False
+    )
+    return t.width, t.height
+
+
+def _load_options(loader_format, factor):
+    """Shrink-on-load options for the loader, given the overall downscaling factor.
+
+    Like vips_thumbnail(), leave at least a factor of two for the final resize so
+    the block shrink done by the JPEG decoder doesn't add visible sharpening."""
+
+    if loader_format == "jpeg":
+        if factor >= 16:
+            return {"shrink": 8}
+        if factor >= 8:
+            return {"shrink": 4}
+        if factor >= 4:
+            return {"shrink": 2}
+    elif loader_format == "webp":
+        if factor > 2:
+            return {"scale": 2 / factor}
+    return {}
+
+
+def _load_scale(options):
+    """Resolution the loader gives with these options, relative to the original."""
+
+    if "shrink" in options:
+        return 1 / options["shrink"]
+    return options.get("scale", 1.0)
+
+
+def _scale_frame(content, q, header, original_format, decoded=None):
+    """Crop and resize a still image, or the first frame of an animation.
+
+    decoded is a (DecodedImageCache, key of the original) tuple. A cached
+    intermediate of at least the resolution needed is used instead of decoding,
+    and otherwise the decoded image is cached."""
+
+    full_width, full_height = header.width, header.height
+    if header.get_typeof("orientation") and header.get("orientation") in (5, 6, 7, 8):
+        # autorot() will swap the axes
+        full_width, full_height = full_height, full_width
 
-def blocking_scale(content, q):
-    i = Image.new_from_buffer(content, "")
-    i = i.autorot()  # rotate based on EXIF orientation
-    original_format = vips_format_from_loader(i)
     if q["crop"]:
         crop_left, crop_top, crop_right, crop_bottom = q["crop"]
-        crop_width = crop_right - crop_left
-        crop_height = crop_bottom - crop_top
-        i = i.extract_area(crop_left, crop_top, crop_width, crop_height)
-    i = i.thumbnail_image(q["width"], height=q["height"], size="both", linear=False)
-    match q["format"].lower():
+    else:
+        crop_left, crop_top, crop_right, crop_bottom = 0, 0, full_width, full_height
+    crop_width = crop_right - crop_left
+    crop_height = crop_bottom - crop_top
+
+    width, height = _output_size(crop_width, crop_height, q["width"], q["height"])
+    factor = min(crop_width / width, crop_height / height)
+    options = _load_options(original_format, factor)
+    cached = None
+    if decoded is not None:
+        decoded_cache, key = decoded
+        cached = decoded_cache.get(key, _load_scale(options))
+    if cached is not None:
+        i = cached
+    else:
+        if options:
+            i = Image.new_from_buffer(content, "", **options)
+        else:
+            i = header
+        i = i.autorot()  # rotate based on EXIF orientation
+        if decoded is not None and decoded_cache.fits(i):
+            # Decode all of it into memory, other variants may crop differently
+            i = i.copy_memory()
+            decoded_cache.put(key, _load_scale(options), i)
+
+    # Map the crop rectangle to the coordinates of the (possibly) shrunk image
+    x_scale = i.width / full_width
+    y_scale = i.height / full_height
+    left = int(crop_left * x_scale)
+    top = int(crop_top * y_scale)
+    i = i.extract_area(
+        left,
+        top,
+        max(1, min(round(crop_width * x_scale), i.width - left)),
+        max(1, min(round(crop_height * y_scale), i.height - top)),
+    )
+    return i.thumbnail_image(width, height=height, size="force", linear=False)
+
+
+def _animation_frames(header, q, original_format, animation_limits) -> int:
+    """Number of frames to scale, or 0 to scale the first frame only."""
+
+    if animation_limits is None:
+        return 0
+    if original_format not in ANIMATED_FORMATS or q["format"] not in ANIMATED_FORMATS:
+        return 0
+    if not header.get_typeof("n-pages") or header.get("n-pages") < 2:
+        return 0
+
+    frames = header.get("n-pages")
+    max_frames, max_pixels = animation_limits
+    if frames > max_frames or header.width * header.height * frames > max_pixels:
+        log.info(
+            "animation of %d frames of %dx%d over the limits, scaling the first frame",
+            frames,
+            header.width,
+            header.height,
+        )
+        return 0
+    return frames
+
+
+def _scale_animated(content, q, frames):
+    """Crop and resize each frame, keeping the frame delays and loop count."""
+
+    i = Image.new_from_buffer(content, "", n=frames)
+    frame_width, frame_height = i.width, i.height // frames
+    if q["crop"]:
+        crop_left, crop_top, crop_right, crop_bottom = q["crop"]
+    else:
+        crop_left, crop_top, crop_right, crop_bottom = 0, 0, frame_width, frame_height
+    # Past the edge of a frame, extract_area would read the next frame
+    crop_left = min(max(crop_left, 0), frame_width - 1)
+    crop_top = min(max(crop_top, 0), frame_height - 1)
+    crop_width = max(1, min(crop_right, frame_width) - crop_left)
+    crop_height = max(1, min(crop_bottom, frame_height) - crop_top)
+    width, height = _output_size(crop_width, crop_height, q["width"], q["height"])
+
+    scaled = [
+        i.extract_area(
+            crop_left, n * frame_height + crop_top, crop_width, crop_height
+        ).thumbnail_image(width, height=height, size="force", linear=False)
+        for n in range(frames)
+    ]
+    # Frames are stacked vertically, the savers split them by page-height
+    result = Image.arrayjoin(scaled, across=1).copy()
+    result.set_type(GValue.gint_type, "page-height", height)
+    if i.get_typeof("delay"):
+        result.set_type(GValue.array_int_type, "delay", i.get("delay"))
+    if i.get_typeof("loop"):
+        result.set_type(GValue.gint_type, "loop", i.get("loop"))
+    return result
+
+
+def blocking_scale(
+    content, q, metrics_tenant=None, animation_limits=None, decoded=None
+):
+    """Scale and encode an image. With metrics_tenant set, the time spent in each
+    stage is recorded under that tenant label.
+
+    With animation_limits (max frames, max total pixels of the frames) set,
+    animated GIF and WebP originals keep their animation when the output format
+    supports it. Larger animations are scaled to their first frame.
+
+    With decoded, a (DecodedImageCache, key of the original) tuple, still images
+    are decoded through the cache."""
+
+    return blocking_scale_with_quality(
+        content, q, metrics_tenant, animation_limits, decoded
+    )[0]
+
+
+def blocking_scale_with_quality(
+    content, q, metrics_tenant=None, animation_limits=None, decoded=None
+):
+    """Like blocking_scale, but also returns the quality chosen for max_bytes, or
+    None if the quality was not searched."""
+
+    started = time.perf_counter()
+    # Only reads the header, pixels are decoded once the image is used.
+    header = Image.new_from_buffer(content, "")
+    original_format = vips_format_from_loader(header)
+
+    frames = _animation_frames(header, q, original_format, animation_limits)
+    if frames:
+        i = _scale_animated(content, q, frames)
+    else:
+        i = _scale_frame(content, q, header, original_format, decoded)
+
+    search_quality = bool(q.get("max_bytes")) and q["format"] in LOSSY_FORMATS
+    if metrics_tenant is None and not search_quality:
+        return _encode(i, q, original_format), None
+
+    # Decoding is lazy and happens as pixels are needed for the output, so the open
+    # stage is reading the header and setting up the pipeline, and decoding only
+    # for originals kept in the decoded image cache. Resize into memory so that
+    # encoding can be timed separately, the decode_resize stage includes decoding,
+    # and so that encoding several times doesn't decode again. This costs a copy
+    # of the output image.
+    opened = time.perf_counter()
+    i = i.copy_memory()
+    resized = time.perf_counter()
+    if search_quality:
+        output, quality = _encode_to_size(i, q, original_format)
+    else:
+        output, quality = _encode(i, q, original_format), None
+    encoded = time.perf_counter()
+
+    if metrics_tenant is not None:
+        stage_seconds = metrics.SCALE_STAGE_SECONDS
+        stage_seconds.labels(metrics_tenant, "open").observe(opened - started)
+        stage_seconds.labels(metrics_tenant, "decode_resize").observe(resized - opened)
+        stage_seconds.labels(metrics_tenant, "encode").observe(encoded - resized)
+    return output, quality
+
+
+def _encode_to_size(i, q, original_format):
+    """Encode at the highest quality, up to q["quality"], whose output fits in
+    q["max_bytes"]. Binary search, bounded by MAX_BYTES_MAX_ENCODES. If no quality
+    that was tried fits, the smallest output is returned."""
+
+    quality = q["quality"]
+    output = _encode(i, q, original_format)
+    if len(output) <= q["max_bytes"]:
+        return output, quality
+
+    smallest = (output, quality)
+    fitting = None
+    low, high = MAX_BYTES_MIN_QUALITY, quality - 1
+    encodes = 1
+    while low <= high and encodes < MAX_BYTES_MAX_ENCODES:
+        quality = (low + high) // 2
+        output = _encode(i, q | {"quality": quality}, original_format)
+        encodes += 1
+        if len(output) <= q["max_bytes"]:
+            fitting = (output, quality)
+            low = quality + 1
+        else:
+            if len(output) < len(smallest[0]):
+                smallest = (output, quality)
+            high = quality - 1
+    return fitting or smallest
+
+
+def _encode(i, q, original_format):
+    format = q["format"].lower()
+    profile = ENCODER_PROFILES[q.get("profile", DEFAULT_ENCODER_PROFILE)]
+    match format:
         case "jpeg":
             return i.jpegsave_buffer(
                 Q=q["quality"],
-                optimize_coding=True,
-                interlace=True,
-                trellis_quant=True,
-                overshoot_deringing=True,
-                optimize_scans=True,
-                quant_table=3,
                 subsample_mode="auto",  # with this, chroma subsampling is disabled with quality >= 90
                 strip=True,
+                **profile[format],
             )
         case "png":
-            return i.pngsave_buffer(
-                compression=9,  # max
-                effort=10,  # max
-                strip=True,
-            )
+            return i.pngsave_buffer(strip=True, **profile[format])
         case "webp":
+            # PNG is kept lossless, unless there is a byte budget to meet
+            lossless = original_format == "png" and not q.get("max_bytes")
             return i.webpsave_buffer(
-                lossless=(original_format == "png"),
-                Q=100 if original_format == "png" else q["quality"],
-                effort=6,
+                lossless=lossless,
+                Q=100 if lossless else q["quality"],
+                strip=True,
+                **profile[format],
+            )
+        case "gif":
+            return i.gifsave_buffer(strip=True, **profile[format])
+        case "avif":
+            return i.heifsave_buffer(
+                compression="av1",
+                Q=avif_quality(q["quality"]),
                 strip=True,
+                **profile[format],
             )
         case _:
             raise ValueError(f"unsupported format: {q['format']}")
 
 
-bg_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-
 query_schema = Schema(
     {
         "width": And(Use(int), lambda n: n > 0),
         "height": And(Use(int), lambda n: n > 0),
         "quality": And(Use(int), lambda n: 0 < n <= 100),
-        "format": And(str, Use(str.lower), lambda s: s in ("jpeg", "png", "webp")),
+        "format": And(
+            str,
+            Use(str.lower),
+            lambda s: s in ("jpeg", "png", "webp", "avif", "gif"),
+        ),
+        Optional("max_bytes"): And(Use(int), lambda n: n > 0),
+        Optional("profile"): And(str, lambda s: s in ENCODER_PROFILES),
         Optional("crop"): And(
             str,
             Use(lambda s: s.split(",")),
@@ -105,25 +369,78 @@ async def scale(request: Request):
 
     if "crop" not in q:
         q["crop"] = None
+    if "profile" not in q:
+        q["profile"] = DEFAULT_ENCODER_PROFILE
 
-    request_url = cache_url(
-        config.cache_endpoint(),
-        config.app_path_prefixes(),
-        "original",
-        tenant,
-        image_uri,
-        fwd_q,
-    )
-
-    r = await make_request(request, request_url)
+    r = await fetch_original(request, tenant, image_uri, fwd_q)
     output_headers = cache_headers_with_config(config, tenant, r)
 
     if r.status_code == 304:
         return Response(status_code=304, headers=output_headers)
 
-    loop = asyncio.get_running_loop()
-    content = await loop.run_in_executor(
-        bg_pool, functools.partial(blocking_scale, r.content, q)
+    animation_limits = None
+    if config.tenant(tenant).scale_animations:
+        animation_limits = (
+            config.animation_max_frames(),
+            config.animation_max_pixels(),
+        )
+
+    # Other variants of the same original can start from its decoded image
+    decoded = None
+    decoded_cache = request.app.state.decoded_cache
+    etag, last_modified = r.headers.get("etag"), r.headers.get("last-modified")
+    if decoded_cache is not None and (etag or last_modified):
+        key = (tenant, image_uri, tuple(sorted(fwd_q.items())), etag, last_modified)
+        decoded = (decoded_cache, key)
+
+    pool: ScalePool = request.app.state.scale_pool
+    singleflight: SingleFlight = request.app.state.singleflight
+    # Concurrent requests for the same variant of the same original share one job.
+    job_key = (
+        "scale",
+        tenant,
+        image_uri,
+        tuple(sorted(fwd_q.items())),
+        r.headers.get("etag"),
+        r.headers.get("last-modified"),
+        tuple(sorted(q.items())),
+        animation_limits,
+    )
+    if pool.backend == "process":
+        # Arguments are pickled, memory maps of cached originals can't be
+        source = bytes(r.content)
+    else:
+        source = vips_buffer(r.content)
+    metrics_tenant = metrics.tenant_label(config, tenant)
+    # Timing the stages of the job separately has a cost, skip it if unused.
+    stage_metrics_tenant = metrics_tenant if config.metrics_enabled() else None
+    (content, quality), timings = await singleflight.do(
+        job_key,
+        functools.partial(
+            pool.run,
+            tenant,
+            blocking_scale_with_quality,
+            source,
+            q,
+            stage_metrics_tenant,
+            animation_limits,
+            decoded,
+        ),
+        kind="scale",
+    )
+    log.debug(
+        "scaled %s/%s: queued %.3fs, ran %.3fs",
+        tenant,
+        image_uri,
+        timings.queue_seconds,
+        timings.run_seconds,
+    )
+    output_headers["server-timing"] = timings.server_timing()
+    if quality is not None:
+        output_headers["x-skipscale-quality"] = str(quality)
+    metrics.SCALE_QUEUE_SECONDS.labels(metrics_tenant).observe(timings.queue_seconds)
+    metrics.SCALE_RESPONSE_BYTES.labels(metrics_tenant, q["format"]).observe(
+        len(content)
     )
 
     return Response(content, headers=output_headers, media_type="image/" + q["format"])
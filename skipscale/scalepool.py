@@ -0,0 +1,199 @@
+"""Executor for blocking scaling jobs with per-tenant fair scheduling."""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Tuple
+
+from starlette.exceptions import HTTPException
+
+from skipscale import metrics
+from skipscale.utils import get_logger
+
+log = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class ScaleTimings:
+    queue_seconds: float
+    run_seconds: float
+
+    def server_timing(self) -> str:
+        """Format the timings as a Server-Timing header value (in milliseconds)."""
+        return (
+            f"scale-queue;dur={self.queue_seconds * 1000:.1f}, "
+            f"scale-run;dur={self.run_seconds * 1000:.1f}"
+        )
+
+
+@dataclass
+class _Job:
+    fn: Callable[[], Any]
+    future: asyncio.Future
+    enqueued: float
+
+
+class ScalePool:
+    """Runs blocking scaling jobs in a thread or process pool.
+
+    Jobs are queued per tenant and handed to the executor round-robin between
+    tenants, so that one tenant with a lot of large originals can't starve the
+    others. At most `workers` jobs are running at a time; the rest wait in the
+    tenant queues. If `max_queue` jobs are already waiting, new jobs are rejected
+    with a 503 and a Retry-After header."""
+
+    def __init__(
+        self,
+        workers: int = 1,
+        backend: str = "thread",
+        max_queue: int = 0,
+        retry_after_seconds: int = 1,
+    ) -> None:
+        self._workers = workers
+        self._max_queue = max_queue
+        self._retry_after_seconds = retry_after_seconds
+
+        self._executor: concurrent.futures.Executor
+        if backend == "process":
+            # Forking a process with libvips threads running is unsafe, so spawn.
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.backend = backend
+
+        # Insertion ordered, the tenant at the front is served next.
+        self._queues: Dict[str, Deque[_Job]] = {}
+        self._queued = 0
+        self._running = 0
+        self._retiring = False
+
+        self.completed = 0
+        self.rejected = 0
+        self.queue_seconds_total = 0.0
+        self.run_seconds_total = 0.0
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def run(
+        self, tenant: str, fn: Callable[..., Any], *args: Any
+    ) -> Tuple[Any, ScaleTimings]:
+        """Run fn(*args) in the pool on behalf of tenant. Returns the result and
+        the time spent waiting in the queue and running."""
+
+        if self._max_queue and self._queued >= self._max_queue:
+            self.rejected += 1
+            metrics.SCALE_POOL_RESULTS.labels("rejected").inc()
+            log.warning(
+                "scale queue full (%d queued, %d running), rejecting job for tenant %r",
+                self._queued,
+                self._running,
+                tenant,
+            )
+            raise HTTPException(
+                503,
+                "Scaling queue full",
+                headers={"retry-after": str(self._retry_after_seconds)},
+            )
+
+        loop = asyncio.get_running_loop()
+        job = _Job(functools.partial(fn, *args), loop.create_future(), time.monotonic())
+        self._queues.setdefault(tenant, collections.deque()).append(job)
+        self._queued += 1
+        metrics.SCALE_POOL_JOBS.labels("queued").inc()
+        self._dispatch()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self._dequeue(tenant, job)
+            raise
+
+    def _dequeue(self, tenant: str, job: _Job) -> None:
+        """Remove a job that was cancelled before it started, so that it doesn't
+        count against max_queue."""
+
+        queue = self._queues.get(tenant)
+        if queue is None or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del self._queues[tenant]
+        self._queued -= 1
+        metrics.SCALE_POOL_JOBS.labels("queued").dec()
+
+    def _dispatch(self) -> None:
+        while self._running < self._workers and self._queues:
+            tenant, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            # Move the tenant to the back of the round.
+            del self._queues[tenant]
+            if queue:
+                self._queues[tenant] = queue
+            self._queued -= 1
+            metrics.SCALE_POOL_JOBS.labels("queued").dec()
+
+            if job.future.cancelled():
+                # The waiting request went away before the job started, and the
+                # job was not dequeued then.
+                continue
+
+            started = time.monotonic()
+            self._running += 1
+            metrics.SCALE_POOL_JOBS.labels("running").inc()
+            running = asyncio.wrap_future(self._executor.submit(job.fn))
+            running.add_done_callback(
+                functools.partial(self._finished, job, started - job.enqueued, started)
+            )
+
+    def _finished(
+        self, job: _Job, queue_seconds: float, started: float, running: asyncio.Future
+    ) -> None:
+        run_seconds = time.monotonic() - started
+        self._running -= 1
+        self.completed += 1
+        self.queue_seconds_total += queue_seconds
+        self.run_seconds_total += run_seconds
+        metrics.SCALE_POOL_JOBS.labels("running").dec()
+        metrics.SCALE_POOL_RESULTS.labels("completed").inc()
+        metrics.SCALE_POOL_RUN_SECONDS.inc(run_seconds)
+
+        if job.future.cancelled():
+            # Nobody is waiting for the result anymore.
+            pass
+        elif running.cancelled():
+            job.future.cancel()
+        elif running.exception() is not None:
+            job.future.set_exception(running.exception())
+        else:
+            job.future.set_result(
+                (running.result(), ScaleTimings(queue_seconds, run_seconds))
+            )
+
+        self._dispatch()
+        if self._retiring and not self._running:
+            self._executor.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown_when_idle(self) -> None:
+        """Shut down once the queued and running jobs have finished. Used when the
+        pool is replaced, so that the jobs already accepted are not lost."""
+        self._retiring = True
+        if not self._running and not self._queued:
+            self._executor.shutdown(wait=False)
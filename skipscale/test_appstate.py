@@ -0,0 +1,119 @@
+import asyncio
+
+from starlette.applications import Starlette
+
+from skipscale import appstate
+from skipscale.appstate import ConfigReloader, init_state
+from skipscale.config import Config
+from skipscale.httpclients import TransportSettings
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+default_quality = {quality}
+origin_request_timeout_seconds = {timeout}
+app_path_prefixes = ["{prefix}"]
+
+[tenants.custom]
+origin = "https://storage.example.com/"
+origin_request_timeout_seconds = 2.0
+"""
+
+
+def write_config(path, quality=80, timeout=5.0, prefix="/"):
+    path.write_text(CONFIG.format(quality=quality, timeout=timeout, prefix=prefix))
+
+
+def test_reload(tmp_path):
+    path = tmp_path / "config.toml"
+    write_config(path)
+
+    async def run():
+        app = Starlette()
+        init_state(app, Config(str(path)))
+        reloader = ConfigReloader(app)
+        clients = app.state.http_clients
+        default, internal = clients.default, clients.internal
+        custom = clients.for_tenant("custom")
+        assert clients.for_tenant("other") is default
+        app.state.imageinfo_cache.set("key", "value", 60)
+        scale_pool, warmup = app.state.scale_pool, app.state.warmup
+
+        write_config(path, quality=70)
+        assert reloader.reload()
+        assert app.state.config.tenant("other").default_quality == 70
+        assert app.state.imageinfo_cache.get("key") is None
+        # Transport settings are unchanged, so are the connection pools
+        assert clients.default is default and clients.internal is internal
+        assert clients.for_tenant("custom") is custom
+        assert app.state.scale_pool is scale_pool
+        assert app.state.warmup is warmup
+
+        write_config(path, quality=70, timeout=10.0)
+        assert reloader.reload()
+        assert clients.default is not default
+        assert clients.for_tenant("other") is clients.default
+        assert clients.for_tenant("custom") is custom
+        await clients.aclose()
+
+    asyncio.run(run())
+
+
+def test_reload_keeps_config_on_error(tmp_path):
+    path = tmp_path / "config.toml"
+    write_config(path)
+
+    async def run():
+        app = Starlette()
+        init_state(app, Config(str(path)))
+        config = app.state.config
+        reloader = ConfigReloader(app)
+
+        path.write_text("default_quality = 80")  # cache_endpoint is required
+        assert not reloader.reload()
+        assert app.state.config is config
+
+        write_config(path, quality=70, prefix="/images/")
+        assert not reloader.reload()
+        assert app.state.config is config
+        await app.state.http_clients.aclose()
+
+    asyncio.run(run())
+
+
+def test_reload_failure_keeps_state(tmp_path, monkeypatch):
+    path = tmp_path / "config.toml"
+    write_config(path)
+
+    async def run():
+        app = Starlette()
+        init_state(app, Config(str(path)))
+        before = dict(vars(app.state)["_state"])
+        clients = app.state.http_clients
+        default = clients.default
+        reloader = ConfigReloader(app)
+
+        new_pools = []
+        scale_pool = appstate._scale_pool
+
+        def track_scale_pool(config):
+            new_pools.append(scale_pool(config))
+            return new_pools[-1]
+
+        def fail(settings):
+            raise RuntimeError("cannot build client")
+
+        monkeypatch.setattr(appstate, "_scale_pool", track_scale_pool)
+        monkeypatch.setattr(TransportSettings, "build_client", fail)
+        write_config(path, quality=70, timeout=10.0)
+        path.write_text("scale_pool_workers = 3\n" + path.read_text())
+        assert not reloader.reload()
+
+        assert dict(vars(app.state)["_state"]) == before
+        assert clients.default is default
+        assert not app.state.scale_pool._retiring
+        # The scale pool built for the new configuration was shut down
+        assert len(new_pools) == 1
+        assert new_pools[0]._executor._shutdown
+        await clients.aclose()
+
+    asyncio.run(run())
@@ -0,0 +1,158 @@
+import base64
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from skipscale import batchplanner
+from skipscale.config import Config
+from skipscale.planner import canonical_url
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+app_path_prefixes = ["/"]
+default_quality = 85
+max_pixel_ratio = 2
+
+[encryption]
+key = "01234567890123456789012345678901"
+username = "admin"
+password = "admin"
+url_prefix = "https://images.example.com/"
+
+[tenants.t]
+origin = "https://storage.example.com/"
+"""
+
+IMAGEINFO = {
+    "a.jpg": {"format": "jpeg", "width": 3000, "height": 2000},
+    "a.svg": {"format": "svg", "width": 100, "height": 100},
+}
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    async def fetch_imageinfo(request, tenant, image_uri, fwd_q, **kwargs):
+        if image_uri == "unreachable.jpg":
+            raise httpx.ConnectError("connection refused")
+        if image_uri == "malformed.jpg":
+            return {"format": "jpeg"}, {}
+        if image_uri not in IMAGEINFO:
+            raise HTTPException(404)
+        return IMAGEINFO[image_uri], {}
+
+    monkeypatch.setattr(batchplanner, "fetch_imageinfo", fetch_imageinfo)
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    config = Config(str(config_path))
+    app = Starlette(
+        routes=[Route("/plan/{tenant}/", batchplanner.batch_planner, methods=["POST"])]
+    )
+    app.state.config = config
+    return TestClient(app)
+
+
+def auth(username="admin", password="admin"):
+    credentials = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {"Authorization": "Basic " + credentials}
+
+
+def test_batch_planner(client):
+    body = {
+        "images": [
+            {
+                "uri": "a.jpg?v=2",
+                "variants": [
+                    {"width": 300},
+                    {"width": 100, "height": 100, "mode": "crop", "format": "webp"},
+                    {"width": "x"},
+                ],
+            },
+            {"uri": "a.svg", "variants": [{"width": 50}]},
+            {"uri": "missing.jpg", "variants": [{"width": 50}]},
+        ]
+    }
+    r = client.post("/plan/t/", json=body, headers=auth())
+    assert r.status_code == 200
+    assert r.json() == {
+        "images": [
+            {
+                "uri": "a.jpg?v=2",
+                "variants": [
+                    {
+                        "url": "/scale/t/a.jpg?width=300&height=200&crop=0,0,3000,2000&quality=85&format=jpeg&v=2"
+                    },
+                    {
+                        "url": "/scale/t/a.jpg?width=100&height=100&crop=500,0,2499,1999&quality=85&format=webp&v=2"
+                    },
+                    {"error": "invalid set of query parameters"},
+                ],
+            },
+            {"uri": "a.svg", "variants": [{"url": "/original/t/a.svg"}]},
+            {"uri": "missing.jpg", "error": 404},
+        ]
+    }
+
+
+def test_batch_planner_ladder(client):
+    variants = [
+        {"width": width, "dpr": dpr}
+        for width in (0, 100, 640, 1500, 4000)
+        for dpr in (1, 2, 3)
+    ]
+    variants += [
+        {"width": 100, "height": 300, "mode": "crop", "center_x": 0.1, "center_y": 1},
+        {"width": 5000, "height": 300, "mode": "stretch", "dpr": 3},
+        {"height": 50, "format": "webp"},
+    ]
+    body = {"images": [{"uri": "a.jpg", "variants": variants}]}
+    r = client.post("/plan/t/", json=body, headers=auth())
+    assert r.status_code == 200
+    # Same as planning each variant on its own
+    config = client.app.state.config
+    assert r.json()["images"][0]["variants"] == [
+        {
+            "url": canonical_url(
+                config,
+                "t",
+                "a.jpg",
+                {},
+                batchplanner.validate_query({k: str(v) for k, v in variant.items()}),
+                IMAGEINFO["a.jpg"],
+            )
+        }
+        for variant in variants
+    ]
+
+
+def test_batch_planner_unexpected_errors(client):
+    body = {
+        "images": [
+            {"uri": "unreachable.jpg", "variants": [{"width": 50}]},
+            {"uri": "malformed.jpg", "variants": [{"width": 50}]},
+            {"uri": "a.svg", "variants": [{"width": 50}]},
+        ]
+    }
+    r = client.post("/plan/t/", json=body, headers=auth())
+    assert r.status_code == 200
+    assert r.json()["images"] == [
+        {"uri": "unreachable.jpg", "error": 500},
+        {"uri": "malformed.jpg", "error": 500},
+        {"uri": "a.svg", "variants": [{"url": "/original/t/a.svg"}]},
+    ]
+
+
+def test_batch_planner_rejects(client):
+    body = {"images": [{"uri": "a.jpg", "variants": [{"width": 300}]}]}
+    assert client.post("/plan/t/", json=body).status_code == 401
+    assert (
+        client.post("/plan/t/", json=body, headers=auth(password="x")).status_code
+        == 401
+    )
+    assert (
+        client.post("/plan/t/", json={"images": [{}]}, headers=auth()).status_code
+        == 400
+    )
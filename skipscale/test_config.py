@@ -0,0 +1,94 @@
+import dataclasses
+
+import pytest
+import schema
+
+from skipscale.config import Config
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+default_quality = 80
+max_pixel_ratio = 2
+cache_control_minimum = "public, max-age=60"
+origin_request_max_connections = 0
+
+[encryption]
+key = "01234567890123456789012345678901"
+username = "admin"
+password = "admin"
+url_prefix = "https://images.example.com/"
+
+[tenants.plain]
+origin = "https://storage.example.com/"
+
+[tenants.custom]
+default_quality = 90
+default_format = "webp"
+strip_regex = "_v[0-9]+"
+encoder_profile = "fast"
+encoder_profile_max_pixels = { max = 1000, balanced = 10 }
+cache_control_override = "public, max-age=3600"
+origin_request_timeout_seconds = 1.5
+
+[tenants.custom.encryption]
+key = "0123456789abcdef0123456789abcdef"
+username = "custom"
+password = "secret"
+url_prefix = "https://custom.example.com/"
+asset_url_prefix = "https://assets.example.com/"
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    return Config(str(path))
+
+
+def test_tenant_defaults(config):
+    plain = config.tenant("plain")
+    assert plain.default_quality == 80
+    assert plain.default_format is None
+    assert plain.max_pixel_ratio == 2
+    assert plain.encoder_profile_for(10**9) == "max"
+    assert plain.origin == "https://storage.example.com/"
+    assert plain.strip_regex is None
+    assert plain.encryption_credentials == ("admin", "admin")
+    assert plain.encryption_asset_url_prefix == "https://images.example.com/"
+    assert str(plain.parsed_cache_control_minimum) == "public, max-age=60"
+    assert plain.origin_request_timeout_seconds == 5.0
+    assert plain.origin_request_max_connections is None
+    assert plain.origin_request_max_keepalive_connections == 10
+
+
+def test_tenant_overrides(config):
+    custom = config.tenant("custom")
+    assert custom.default_quality == 90
+    assert custom.default_format == "webp"
+    assert custom.strip_regex.sub("", "a_v2.jpg") == "a.jpg"
+    assert custom.encoder_profile_for(10) == "balanced"
+    assert custom.encoder_profile_for(11) == "max"
+    assert custom.encoder_profile_for(1001) == "fast"
+    assert custom.cache_control_override == "public, max-age=3600"
+    assert custom.encryption_key == bytes.fromhex("0123456789abcdef0123456789abcdef")
+    assert custom.encryption_asset_url_prefix == "https://assets.example.com/"
+    assert custom.origin_request_timeout_seconds == 1.5
+    # The accessors return the resolved values
+    assert config.default_quality("custom") == 90
+    assert config.encoder_profile("custom", 10) == "balanced"
+
+
+def test_unknown_tenants_share_defaults(config):
+    assert config.tenant("unknown") is config.tenant("other") is config.tenant(None)
+    assert config.tenant("unknown").origin is None
+    assert config.tenant("unknown").default_quality == 80
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        config.tenant("plain").default_quality = 1
+
+
+def test_reserved_tenant_name(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG + '\n[tenants.warmup]\norigin = "https://example.com/"\n')
+    with pytest.raises(schema.SchemaError, match="Wrong key 'warmup'"):
+        Config(str(path))
@@ -0,0 +1,85 @@
+import time
+
+from pyvips import Image
+
+from skipscale.decodedcache import DecodedImageCache
+from skipscale.scale import blocking_scale
+from skipscale.test_scale import make_image
+
+
+def test_nearest_larger():
+    cache = DecodedImageCache(max_pixels=10000, ttl_seconds=60)
+    full, half = Image.black(80, 60), Image.black(40, 30)
+    cache.put("a", 1.0, full)
+    cache.put("a", 0.5, half)
+    assert cache.get("a", 0.25) is half
+    assert cache.get("a", 0.5) is half
+    assert cache.get("a", 0.75) is full
+    assert cache.get("b", 0.25) is None
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_eviction_and_expiry():
+    cache = DecodedImageCache(max_pixels=100, ttl_seconds=60)
+    cache.put("a", 1.0, Image.black(8, 8))
+    cache.put("b", 1.0, Image.black(6, 6))
+    assert cache.pixels == 100
+    # Over the budget on its own
+    cache.put("c", 1.0, Image.black(20, 20))
+    assert cache.get("c", 1.0) is None
+    cache.get("a", 1.0)
+    cache.put("d", 1.0, Image.black(5, 5))
+    assert cache.get("b", 1.0) is None
+    assert cache.get("a", 1.0) is not None
+    assert cache.pixels == 89
+
+    cache = DecodedImageCache(max_pixels=100, ttl_seconds=0.01)
+    cache.put("a", 1.0, Image.black(8, 8))
+    time.sleep(0.02)
+    assert cache.get("a", 0.1) is None
+    assert cache.pixels == 0
+
+
+def test_blocking_scale_variants():
+    content = make_image("jpeg", 3000, 2000)
+    cache = DecodedImageCache(max_pixels=10_000_000, ttl_seconds=60)
+    decoded = (cache, "a.jpg")
+    for width, height, crop in [
+        (300, 200, None),
+        (600, 400, None),
+        (200, 200, (500, 0, 2500, 2000)),
+        (1500, 1000, None),
+    ]:
+        q = {"width": width, "height": height, "crop": crop, "quality": 80}
+        q["format"] = "jpeg"
+        output = Image.new_from_buffer(blocking_scale(content, q, decoded=decoded), "")
+        expected = Image.new_from_buffer(blocking_scale(content, q), "")
+        assert (output.width, output.height) == (expected.width, expected.height)
+
+    # 300 and 600 wide use shrink-on-load by 4 and 2, the crop can start from
+    # the latter, 1500 wide needs the full image
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert len(cache) == 3
+
+
+def test_too_large_not_decoded_into_memory(monkeypatch):
+    content = make_image("jpeg", 300, 200)
+    copies = []
+    copy_memory = Image.copy_memory
+
+    def counting_copy_memory(image):
+        copies.append((image.width, image.height))
+        return copy_memory(image)
+
+    monkeypatch.setattr(Image, "copy_memory", counting_copy_memory)
+    q = {"width": 30, "height": 20, "crop": None, "quality": 80, "format": "jpeg"}
+    # Shrunk on load to 75x50
+    cache = DecodedImageCache(max_pixels=1000, ttl_seconds=60)
+    blocking_scale(content, q, decoded=(cache, "a.jpg"))
+    assert copies == []
+    assert len(cache) == 0
+
+    cache = DecodedImageCache(max_pixels=100_000, ttl_seconds=60)
+    blocking_scale(content, q, decoded=(cache, "a.jpg"))
+    assert copies == [(75, 50)]
+    assert len(cache) == 1
@@ -0,0 +1,74 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from skipscale.diskcache import OriginalCache
+
+
+def make_response(content: bytes, etag: str) -> httpx.Response:
+    return httpx.Response(
+        200,
+        content=content,
+        headers={"content-type": "image/jpeg", "etag": etag, "x-other": "1"},
+    )
+
+
+def test_put_get(tmp_path):
+    cache = OriginalCache(str(tmp_path), 1000)
+    assert cache.get("http://a/") is None
+    assert "http://a/" not in cache
+
+    cache.put("http://a/", make_response(b"a" * 100, '"1"'), 60)
+    cached = cache.get("http://a/")
+    assert "http://a/" in cache
+    assert cached.is_fresh
+    assert cached.content[:] == b"a" * 100
+    assert cached.headers["etag"] == '"1"'
+    assert "x-other" not in cached.headers
+    assert cached.validators() == {"if-none-match": '"1"'}
+
+    # Identical content is stored once
+    cache.put("http://b/", make_response(b"a" * 100, '"1"'), 60)
+    assert len(os.listdir(tmp_path / "blobs")) == 1
+
+
+def test_refresh(tmp_path):
+    cache = OriginalCache(str(tmp_path), 1000)
+    cache.put("http://a/", make_response(b"a" * 100, '"1"'), 0)
+    cached = cache.get("http://a/")
+    assert not cached.is_fresh
+
+    cache.refresh("http://a/", cached, httpx.Response(304, headers={"etag": '"2"'}), 60)
+    cached = cache.get("http://a/")
+    assert cached.is_fresh
+    assert cached.headers["etag"] == '"2"'
+    assert cached.headers["content-type"] == "image/jpeg"
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = OriginalCache(str(tmp_path), 250)
+    cache.put("http://a/", make_response(b"a" * 100, '"a"'), 60)
+    cache.put("http://b/", make_response(b"b" * 100, '"b"'), 60)
+    # Make "a" the least recently used entry
+    past = time.time() - 10
+    for directory in ("blobs", "index"):
+        for name in os.listdir(tmp_path / directory):
+            os.utime(tmp_path / directory / name, (past, past))
+    cache.get("http://b/")
+
+    cache.put("http://c/", make_response(b"c" * 100, '"c"'), 60)
+    assert cache.get("http://a/") is None
+    assert "http://a/" not in cache
+    assert cache.get("http://b/") is not None
+    assert cache.get("http://c/") is not None
+
+
+def test_concurrent_puts(tmp_path):
+    cache = OriginalCache(str(tmp_path), 10**6)
+    responses = [make_response(bytes([n]) * 1000, f'"{n}"') for n in range(64)]
+    with ThreadPoolExecutor(8) as executor:
+        for n, response in enumerate(responses):
+            executor.submit(cache.put, f"http://{n}/", response, 60)
+    assert cache._size == 64 * 1000
@@ -0,0 +1,112 @@
+import asyncio
+import base64
+
+import pytest
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from skipscale import encrypt
+from skipscale.config import Config
+from skipscale.urlcrypto import encrypt_url
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+app_path_prefixes = ["/"]
+default_quality = 85
+thumbnail_crop_concurrency = 2
+thumbnail_crop_timeout_seconds = 0.2
+visionrecognizer_url = "http://localhost:9001/"
+visionrecognizer_bearer_token = "token"
+
+[encryption]
+key = "01234567890123456789012345678901"
+username = "admin"
+password = "admin"
+url_prefix = "https://images.example.com/"
+
+[tenants.t]
+origin = "https://storage.example.com/"
+"""
+
+KEY = bytes.fromhex("01234567890123456789012345678901")
+IMAGES = {
+    "https://example.com/a.jpg": {"format": "jpeg", "width": 300, "height": 200},
+    "https://example.com/b.svg": {"format": "svg", "width": 100, "height": 100},
+    "https://example.com/slow.jpg": {"format": "jpeg", "width": 30, "height": 20},
+}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    by_encrypted = {
+        encrypt_url(KEY, "t", url) + (".jpg" if url.endswith(".jpg") else ""): url
+        for url in IMAGES
+    }
+    calls = {"imageinfo": 0, "visionrecognizer": 0, "in_flight": 0, "max": 0}
+
+    async def fetch_imageinfo(request, tenant, image_uri, fwd_q, **kwargs):
+        calls["imageinfo"] += 1
+        calls["in_flight"] += 1
+        calls["max"] = max(calls["max"], calls["in_flight"])
+        await asyncio.sleep(0.01)
+        calls["in_flight"] -= 1
+        if image_uri not in by_encrypted:
+            raise HTTPException(404)
+        return IMAGES[by_encrypted[image_uri]], {}
+
+    async def fetch_center_point(request, tenant, image_uri, fwd_q):
+        calls["visionrecognizer"] += 1
+        if by_encrypted[image_uri].endswith("slow.jpg"):
+            await asyncio.sleep(1)
+        return 0.25, 0.5
+
+    monkeypatch.setattr(encrypt, "fetch_imageinfo", fetch_imageinfo)
+    monkeypatch.setattr(encrypt, "fetch_center_point", fetch_center_point)
+    return calls
+
+
+@pytest.fixture
+def client(tmp_path):
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    app = Starlette(
+        routes=[Route("/encrypt/{tenant}/", encrypt.encrypt, methods=["POST"])]
+    )
+    app.state.config = Config(str(config_path))
+    return TestClient(app)
+
+
+def auth():
+    return {"Authorization": "Basic " + base64.b64encode(b"admin:admin").decode()}
+
+
+def test_thumbnail_crop(client, calls):
+    urls = list(IMAGES) + ["https://example.com/missing.png"]
+    r = client.post(
+        "/encrypt/t/",
+        json={"urls": urls, "include_thumbnail_crop": True},
+        headers=auth(),
+    )
+    assert r.status_code == 200
+    result = r.json()["processedURLs"]
+    prefix = "https://images.example.com/t/"
+    assert result["https://example.com/a.jpg"] == {
+        "encrypted_url": prefix
+        + encrypt_url(KEY, "t", "https://example.com/a.jpg")
+        + ".jpg",
+        "thumbnail_crop": {"center_x": 0.25, "center_y": 0.5},
+        "properties": {"width": 300, "height": 200},
+    }
+    # No center point for SVG, and the slow one times out
+    assert set(result["https://example.com/b.svg"]) == {"encrypted_url", "properties"}
+    assert set(result["https://example.com/slow.jpg"]) == {
+        "encrypted_url",
+        "properties",
+    }
+    assert set(result["https://example.com/missing.png"]) == {"encrypted_url"}
+
+    assert calls["imageinfo"] == 4
+    assert calls["visionrecognizer"] == 2
+    assert calls["max"] == 2
@@ -0,0 +1,53 @@
+import asyncio
+
+from skipscale.config import Config
+from skipscale.httpclients import HTTPClients
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+
+[tenants.a]
+origin = "https://a.example.com/"
+origin_request_timeout_seconds = {timeout}
+
+[tenants.b]
+origin = "https://b.example.com/"
+origin_request_timeout_seconds = {b_timeout}
+
+[tenants.plain]
+origin = "https://plain.example.com/"
+"""
+
+
+def load(tmp_path, timeout=2.0, b_timeout=2.0):
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG.format(timeout=timeout, b_timeout=b_timeout))
+    return Config(str(path))
+
+
+def test_clients_by_settings(tmp_path):
+    async def run():
+        clients = HTTPClients(load(tmp_path))
+        a = clients.for_tenant("a")
+        assert a is not clients.default
+        assert clients.for_tenant("b") is a
+        assert clients.for_tenant("plain") is clients.default
+        # Tenants that are not configured are not remembered
+        for n in range(100):
+            assert clients.for_tenant(f"made-up-{n}") is clients.default
+        assert set(clients._tenants) == {"a", "b", "plain"}
+        assert len(clients._clients) == 1
+
+        clients.reconfigure(load(tmp_path, timeout=3.0))
+        assert clients.for_tenant("b") is a
+        new_a = clients.for_tenant("a")
+        assert new_a is not a and new_a is not clients.default
+        assert not clients._retired
+
+        # No tenant has the settings of the first client anymore
+        clients.reconfigure(load(tmp_path, timeout=3.0, b_timeout=3.0))
+        assert clients._retired == {a}
+        assert clients.for_tenant("b") is new_a
+        await clients.aclose()
+
+    asyncio.run(run())
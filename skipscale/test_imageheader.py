@@ -0,0 +1,49 @@
+import pytest
+from pyvips import GValue, Image
+
+from skipscale.imageheader import probe_image_header
+from skipscale.utils import vips_format_from_loader
+
+
+def make_image(suffix: str, width: int, height: int, bands=3, orientation=1) -> bytes:
+    i = Image.black(width, height, bands=bands) + 128
+    if orientation != 1:
+        i = i.copy()
+        i.set_type(GValue.gint_type, "orientation", orientation)
+    return i.write_to_buffer(suffix)
+
+
+def vips_header(content: bytes):
+    i = Image.new_from_buffer(content, "").autorot()
+    return i.width, i.height, vips_format_from_loader(i)
+
+
+@pytest.mark.parametrize(
+    "suffix,width,height,bands,orientation",
+    [
+        (".jpg", 641, 480, 3, 1),
+        (".jpg[interlace]", 641, 480, 3, 1),
+        (".jpg", 641, 480, 3, 6),
+        (".jpg", 641, 480, 3, 3),
+        (".png", 17, 9999, 3, 1),
+        (".png", 300, 200, 4, 1),
+        (".gif", 123, 45, 3, 1),
+        (".webp", 1001, 333, 3, 1),
+        (".webp[lossless]", 1001, 333, 3, 1),
+        (".webp", 1001, 333, 4, 1),
+        (".webp", 1001, 333, 3, 8),
+        (".webp[strip]", 1001, 333, 3, 1),
+    ],
+)
+def test_probe_matches_vips(suffix, width, height, bands, orientation):
+    content = make_image(suffix, width, height, bands, orientation)
+    probed = probe_image_header(content[:4096])
+    assert probed is not None
+    assert (probed.width, probed.height, probed.format) == vips_header(content)
+
+
+def test_probe_truncated():
+    content = make_image(".jpg", 641, 480)
+    assert probe_image_header(content[:20]) is None
+    assert probe_image_header(b"") is None
+    assert probe_image_header(b"<svg xmlns='http://www.w3.org/2000/svg'/>") is None
@@ -0,0 +1,42 @@
+from unittest import mock
+
+from skipscale.lrucache import LRUCache
+
+
+def test_eviction_order():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Looking up a makes b the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    # Setting an existing key refreshes it
+    cache.set("a", 4)
+    cache.set("d", 5)
+    assert cache.get("c", "gone") == "gone"
+    assert cache.get("a") == 4
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses, cache.evictions) == (4, 2, 2)
+
+
+def test_ttl():
+    cache = LRUCache(10)
+    with mock.patch("skipscale.lrucache.time.monotonic", return_value=100.0):
+        cache.set("a", 1, ttl=5)
+        cache.set("b", 2)
+    with mock.patch("skipscale.lrucache.time.monotonic", return_value=104.9):
+        assert cache.get("a") == 1
+    with mock.patch("skipscale.lrucache.time.monotonic", return_value=105.0):
+        assert cache.get("a") is None
+        assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_disabled():
+    cache = LRUCache(0)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
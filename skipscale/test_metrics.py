@@ -0,0 +1,161 @@
+import asyncio
+
+from prometheus_client import REGISTRY
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from skipscale.lrucache import LRUCache
+from skipscale.metrics import instrument, tenant_label
+from skipscale.scale import blocking_scale
+from skipscale.scalepool import ScalePool
+from skipscale.test_scale import make_image
+from skipscale.utils import SingleFlight
+
+
+class FakeConfig:
+    def has_tenant(self, tenant):
+        return tenant == "known"
+
+
+async def ok(request):
+    return Response("ok")
+
+
+async def not_found(request):
+    raise HTTPException(404)
+
+
+def make_client():
+    app = Starlette(
+        routes=[
+            Route("/ok/{tenant}", instrument("test_ok", ok)),
+            Route("/missing/{tenant}", instrument("test_missing", not_found)),
+        ]
+    )
+    app.state.config = FakeConfig()
+    return TestClient(app)
+
+
+def requests_total(route, tenant, status):
+    return (
+        REGISTRY.get_sample_value(
+            "skipscale_requests_total",
+            {"route": route, "tenant": tenant, "status": status},
+        )
+        or 0
+    )
+
+
+def test_tenant_label():
+    assert tenant_label(FakeConfig(), "known") == "known"
+    assert tenant_label(FakeConfig(), "made-up") == "other"
+
+
+def test_instrument_records_status():
+    client = make_client()
+    before_ok = requests_total("test_ok", "known", "200")
+    before_missing = requests_total("test_missing", "other", "404")
+
+    assert client.get("/ok/known").status_code == 200
+    assert client.get("/missing/made-up").status_code == 404
+
+    assert requests_total("test_ok", "known", "200") == before_ok + 1
+    assert requests_total("test_missing", "other", "404") == before_missing + 1
+    assert (
+        REGISTRY.get_sample_value(
+            "skipscale_request_duration_seconds_count",
+            {"route": "test_ok", "tenant": "known"},
+        )
+        >= 1
+    )
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_cache_metrics():
+    before = {
+        result: sample("skipscale_cache_lookups_total", cache="test", result=result)
+        for result in ("hit", "miss")
+    }
+    evictions = sample("skipscale_cache_evictions_total", cache="test")
+
+    cache = LRUCache(1, "test")
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    cache.set("b", 2)
+    # Unnamed caches are not counted
+    LRUCache(1).get("a")
+
+    assert sample("skipscale_cache_lookups_total", cache="test", result="hit") == (
+        before["hit"] + 1
+    )
+    assert sample("skipscale_cache_lookups_total", cache="test", result="miss") == (
+        before["miss"] + 1
+    )
+    assert sample("skipscale_cache_evictions_total", cache="test") == evictions + 1
+
+
+def test_singleflight_metrics():
+    def calls(kind, result):
+        return sample("skipscale_singleflight_calls_total", kind=kind, result=result)
+
+    before = {
+        (kind, result): calls(kind, result)
+        for kind in ("upstream", "scale")
+        for result in ("started", "coalesced")
+    }
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+
+    async def run():
+        singleflight = SingleFlight()
+        await asyncio.gather(
+            *(singleflight.do("a", fetch) for _ in range(3)),
+            *(singleflight.do("b", fetch, kind="scale") for _ in range(2)),
+        )
+
+    asyncio.run(run())
+    assert calls("upstream", "started") == before["upstream", "started"] + 1
+    assert calls("upstream", "coalesced") == before["upstream", "coalesced"] + 2
+    assert calls("scale", "started") == before["scale", "started"] + 1
+    assert calls("scale", "coalesced") == before["scale", "coalesced"] + 1
+
+
+def test_scale_stage_metrics():
+    def count(stage):
+        return sample("skipscale_scale_stage_seconds_count", tenant="test", stage=stage)
+
+    stages = ("open", "decode_resize", "encode")
+    before = {stage: count(stage) for stage in stages}
+    q = {"width": 30, "height": 20, "crop": None, "quality": 80, "format": "jpeg"}
+    blocking_scale(make_image("jpeg", 300, 200), q, metrics_tenant="test")
+    assert all(count(stage) == before[stage] + 1 for stage in stages)
+
+
+def test_scale_pool_metrics():
+    completed = sample("skipscale_scale_pool_results_total", result="completed")
+    run_seconds = sample("skipscale_scale_pool_run_seconds_total")
+
+    async def run():
+        pool = ScalePool(workers=1)
+        tasks = [asyncio.create_task(pool.run("t", sum, [1, 2])) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert sample("skipscale_scale_pool_jobs", state="running") == 1
+        assert sample("skipscale_scale_pool_jobs", state="queued") == 2
+        await asyncio.gather(*tasks)
+        pool.shutdown()
+
+    asyncio.run(run())
+    assert sample("skipscale_scale_pool_jobs", state="running") == 0
+    assert sample("skipscale_scale_pool_jobs", state="queued") == 0
+    assert sample("skipscale_scale_pool_results_total", result="completed") == (
+        completed + 3
+    )
+    assert sample("skipscale_scale_pool_run_seconds_total") > run_seconds
@@ -0,0 +1,166 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from skipscale import original
+from skipscale.config import Config
+from skipscale.diskcache import OriginalCache
+from skipscale.original import should_stream
+from skipscale.utils import SingleFlight
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+original_stream_threshold_bytes = 10
+
+[tenants.t]
+origin = "https://storage.example.com/"
+"""
+
+
+@pytest.mark.parametrize(
+    "status,headers,method,expected",
+    [
+        (200, {"content-length": "11"}, "GET", True),
+        (200, {"content-length": "10"}, "GET", False),
+        (206, {"content-length": "11"}, "GET", True),
+        (200, {}, "GET", True),
+        (200, {"content-length": "bogus"}, "GET", True),
+        (200, {"content-length": "11"}, "HEAD", False),
+        (404, {"content-length": "11"}, "GET", False),
+    ],
+)
+def test_should_stream(status, headers, method, expected):
+    r = httpx.Response(status, headers=headers)
+    assert should_stream(r, method, 10) == expected
+
+
+class ClosingStream(httpx.AsyncByteStream):
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def app(tmp_path):
+    streams = []
+
+    def handler(request):
+        delay = 1.0 if request.url.path == "/slow.jpg" else 0.0
+        if request.url.path == "/small.jpg":
+            stream = ClosingStream([b"01234"])
+        else:
+            stream = ClosingStream([b"0123456789", b"abcdef"], delay)
+        streams.append(stream)
+        headers = {"content-type": "image/jpeg"}
+        if request.url.path != "/chunked.jpg":
+            headers["content-length"] = str(sum(map(len, stream.chunks)))
+        return httpx.Response(200, headers=headers, stream=stream)
+
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    app = Starlette(
+        routes=[Route("/original/{tenant}/{image_uri:path}", original.original)]
+    )
+    app.state.config = Config(str(config_path))
+    app.state.singleflight = SingleFlight()
+    app.state.http_clients = SimpleNamespace(for_tenant=lambda tenant: client)
+    app.streams = streams
+    return app
+
+
+def test_streamed(app):
+    client = TestClient(app)
+    for path in ("a.jpg", "chunked.jpg"):
+        r = client.get("/original/t/" + path)
+        assert r.status_code == 200
+        assert r.content == b"0123456789abcdef"
+    assert r.headers.get("content-length") is None
+    # Under the threshold, buffered
+    r = client.get("/original/t/small.jpg")
+    assert r.content == b"01234"
+    assert r.headers["content-length"] == "5"
+    assert all(stream.closed for stream in app.streams)
+
+
+def test_streamed_client_disconnect(app):
+    sent = []
+
+    async def run():
+        messages = [
+            {"type": "http.request", "body": b"", "more_body": False},
+            {"type": "http.disconnect"},
+        ]
+
+        async def receive():
+            if len(messages) > 1:
+                return messages.pop(0)
+            return messages[0]
+
+        async def send(message):
+            sent.append(message)
+            # The disconnect is seen before the body iterator is started
+            await asyncio.sleep(0.01)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/original/t/slow.jpg",
+            "raw_path": b"/original/t/slow.jpg",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [],
+            "client": ("127.0.0.1", 1234),
+            "server": ("testserver", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), 0.5)
+
+    asyncio.run(run())
+    assert [m["type"] for m in sent] == ["http.response.start"]
+    assert app.streams[0].closed
+
+
+@pytest.mark.parametrize(
+    "cache_control,cached",
+    [
+        ("max-age=60", True),
+        ("max-age=0", False),
+        ("private, max-age=60", False),
+        ("no-store", False),
+        (None, False),
+    ],
+)
+def test_fetch_original_cacheability(tmp_path, monkeypatch, cache_control, cached):
+    async def make_request(request, request_url, **kwargs):
+        headers = {"content-type": "image/jpeg"}
+        if cache_control is not None:
+            headers["cache-control"] = cache_control
+        return httpx.Response(200, headers=headers, content=b"0123")
+
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    disk_cache = OriginalCache(str(tmp_path / "cache"), 1000)
+    state = SimpleNamespace(config=Config(str(config_path)), original_cache=disk_cache)
+    request = SimpleNamespace(app=SimpleNamespace(state=state), headers={})
+    monkeypatch.setattr(original, "make_request", make_request)
+
+    r = asyncio.run(original.fetch_original(request, "t", "a.jpg", {}))
+    assert r.status_code == 200
+    assert (disk_cache._size > 0) == cached
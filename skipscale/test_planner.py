@@ -0,0 +1,214 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from skipscale import planner
+from skipscale.config import Config
+from skipscale.lrucache import LRUCache
+from skipscale.planner import accepted_media_types, negotiate_format
+from skipscale.utils import SingleFlight
+
+CONFIG = """
+cache_endpoint = "http://localhost:9000/"
+default_quality = 85
+
+[tenants.redirect]
+origin = "https://storage.example.com/"
+
+[tenants.render]
+origin = "https://storage.example.com/"
+planner_internal_render = true
+
+[tenants.animated]
+origin = "https://storage.example.com/"
+scale_animations = true
+
+[tenants.auto]
+origin = "https://storage.example.com/"
+auto_format = true
+"""
+
+FETCH_IMAGEINFO = planner.fetch_imageinfo
+
+
+def test_accepted_media_types():
+    assert accepted_media_types(None) == set()
+    assert accepted_media_types("image/avif,image/webp;q=0.9, */*;q=0.8") == {
+        "image/avif",
+        "image/webp",
+        "*/*",
+    }
+    assert accepted_media_types("image/webp;q=0, image/png") == {"image/png"}
+    assert accepted_media_types("Image/WebP; q=bogus") == set()
+
+
+@pytest.mark.parametrize(
+    "accept,expected",
+    [
+        ("image/avif,image/webp,image/apng,image/*,*/*;q=0.8", "avif"),
+        ("image/webp,*/*", "webp"),
+        ("image/avif;q=0,image/webp", "webp"),
+        ("image/*,*/*;q=0.8", "jpeg"),
+        (None, "jpeg"),
+    ],
+)
+def test_negotiate_format(accept, expected):
+    with mock.patch("skipscale.planner.avif_supported", return_value=True):
+        assert negotiate_format(accept) == expected
+
+
+def test_negotiate_format_without_avif_support():
+    with mock.patch("skipscale.planner.avif_supported", return_value=False):
+        assert negotiate_format("image/avif,image/webp") == "webp"
+        assert negotiate_format("image/avif") == "jpeg"
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    async def fetch_imageinfo(request, tenant, image_uri, fwd_q, **kwargs):
+        return {"format": "jpeg", "width": 3000, "height": 2000}, {}
+
+    upstream = []
+
+    def handler(request):
+        upstream.append(request.url.path)
+        if request.url.path.startswith("/imageinfo/"):
+            return httpx.Response(
+                200,
+                headers={
+                    "access-control-allow-origin": "https://www.example.com",
+                    "cache-control": "public, max-age=60",
+                },
+                json={"format": "jpeg", "width": 3000, "height": 2000},
+            )
+        if request.headers.get("if-none-match") == '"1"':
+            return httpx.Response(304, headers={"etag": '"1"'})
+        return httpx.Response(
+            200,
+            headers={
+                "content-type": "image/jpeg",
+                "etag": '"1"',
+                "cache-control": "public, max-age=60",
+                "x-internal": "1",
+                "x-skipscale-quality": "72",
+            },
+            stream=httpx.ByteStream(request.url.path.encode()),
+        )
+
+    monkeypatch.setattr(planner, "fetch_imageinfo", fetch_imageinfo)
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    app = Starlette(routes=[Route("/{tenant}/{image_uri:path}", planner.planner)])
+    app.state.config = Config(str(config_path))
+    app.state.singleflight = SingleFlight()
+    app.state.imageinfo_cache = LRUCache(100)
+    app.state.http_clients = SimpleNamespace(
+        internal=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    client = TestClient(app)
+    client.upstream = upstream
+    return client
+
+
+def test_planner_redirect(client):
+    r = client.get("/redirect/a.jpg?width=300", follow_redirects=False)
+    assert r.status_code == 307
+    assert r.headers["location"].startswith("/scale/redirect/a.jpg?width=300&")
+
+
+def test_planner_internal_render(client):
+    r = client.get("/render/a.jpg?width=300", follow_redirects=False)
+    assert r.status_code == 200
+    assert r.content == b"/scale/render/a.jpg"
+    assert r.headers["content-location"] == (
+        "/scale/render/a.jpg?width=300&height=200&crop=0,0,3000,2000"
+        "&quality=85&format=jpeg"
+    )
+    assert r.headers["cache-control"] == "public, max-age=60"
+    assert r.headers["content-type"] == "image/jpeg"
+    assert r.headers["x-skipscale-quality"] == "72"
+    assert "x-internal" not in r.headers
+
+    r = client.get("/render/a.jpg?width=300", headers={"if-none-match": '"1"'})
+    assert r.status_code == 304
+
+
+def test_planner_vary(client, monkeypatch):
+    monkeypatch.setattr(planner, "fetch_imageinfo", FETCH_IMAGEINFO)
+    r = client.get(
+        "/auto/a.jpg?width=300&format=auto",
+        headers={"accept": "image/webp", "origin": "https://www.example.com"},
+        follow_redirects=False,
+    )
+    assert r.status_code == 307
+    assert r.headers["access-control-allow-origin"] == "https://www.example.com"
+    assert r.headers["vary"] == "origin, Accept"
+    assert "format=webp" in r.headers["location"]
+
+    r = client.get("/redirect/a.jpg?width=300", follow_redirects=False)
+    assert r.headers["vary"] == "origin"
+
+
+def test_planner_imageinfo_cache(client, monkeypatch):
+    monkeypatch.setattr(planner, "fetch_imageinfo", FETCH_IMAGEINFO)
+    for width in (300, 400):
+        r = client.get(f"/redirect/a.jpg?width={width}", follow_redirects=False)
+        assert r.status_code == 307
+        assert r.headers["cache-control"] == "public, max-age=60"
+    assert client.upstream == ["/imageinfo/redirect/a.jpg"]
+    assert client.app.state.imageinfo_cache.hits == 1
+
+    # Other images, and conditional requests, go to imageinfo
+    client.get("/redirect/b.jpg?width=300", follow_redirects=False)
+    client.get(
+        "/redirect/a.jpg?width=300",
+        headers={"if-none-match": '"1"'},
+        follow_redirects=False,
+    )
+    assert client.upstream[1:] == [
+        "/imageinfo/redirect/b.jpg",
+        "/imageinfo/redirect/a.jpg",
+    ]
+
+
+@pytest.mark.parametrize(
+    "tenant,q,accept,expected",
+    [
+        ("redirect", {"width": 100}, None, "/original/redirect/a.gif"),
+        ("animated", {"width": 400}, None, "/original/animated/a.gif"),
+        ("animated", {"width": 100}, None, "format=gif"),
+        ("animated", {"width": 100, "format": "auto"}, "image/webp", "format=webp"),
+        ("animated", {"width": 100, "format": "auto"}, "image/png", "format=gif"),
+    ],
+)
+def test_canonical_url_gif(tmp_path, tenant, q, accept, expected):
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    imageinfo = {"format": "gif", "width": 400, "height": 300}
+    url = planner.canonical_url(
+        Config(str(config_path)), tenant, "a.gif", {}, q, imageinfo, accept
+    )
+    assert url == expected or url.endswith(expected)
+
+
+def test_canonical_url_max_bytes(tmp_path):
+    config_path = tmp_path / "config.toml"
+    config_path.write_text(CONFIG)
+    config = Config(str(config_path))
+    imageinfo = {"format": "jpeg", "width": 400, "height": 300}
+
+    q = planner.validate_query({"max_bytes": "20000"})
+    url = planner.canonical_url(config, "redirect", "a.jpg", {}, q, imageinfo)
+    assert url == (
+        "/scale/redirect/a.jpg?width=400&height=300&crop=0,0,400,300"
+        "&quality=85&format=jpeg&max_bytes=20000"
+    )
+
+    q = planner.validate_query({"max_bytes": "20000", "format": "png"})
+    url = planner.canonical_url(config, "redirect", "a.jpg", {}, q, imageinfo)
+    assert "max_bytes" not in url
@@ -1,4 +1,8 @@
-from skipscale.planner_math import plan_scale
+import itertools
+import math
+import random
+
+from skipscale.planner_math import plan_scale, plan_scale_many
 
 
 def test_square_linear_downscale():
@@ -279,3 +283,86 @@ def test_wide_tall_crop_unspecified_upscale():
     assert result.source_y == 0
     assert result.source_x2 == 1263
     assert result.source_y2 == 1079
+
+
+def assert_plan_scale_many_matches(requests, max_pixel_ratio):
+    columns = list(zip(*requests))
+    result = plan_scale_many(
+        columns[0],
+        columns[1],
+        width=[r or 0 for r in columns[2]],
+        height=[r or 0 for r in columns[3]],
+        dpr=[1 if r is None else r for r in columns[4]],
+        mode=columns[5],
+        center_x=[math.nan if r is None else r for r in columns[6]],
+        center_y=[math.nan if r is None else r for r in columns[7]],
+        max_pixel_ratio=max_pixel_ratio,
+    )
+    assert len(result) == len(requests)
+    for i, (ow, oh, w, h, dpr, mode, cx, cy) in enumerate(requests):
+        expected = plan_scale(
+            ow,
+            oh,
+            width=w,
+            height=h,
+            dpr=dpr,
+            mode=mode,
+            center_x=cx,
+            center_y=cy,
+            max_pixel_ratio=max_pixel_ratio,
+        )
+        assert result[i] == expected, requests[i]
+
+
+def test_plan_scale_many_edge_cases():
+    # Small sizes hit exact halves when rounding
+    sizes = [1, 2, 3, 5, 7, 10, 333, 1080, 1920]
+    requests = [
+        (ow, oh, w, h, dpr, mode, cx, cy)
+        for ow, oh, w, h in itertools.product(sizes, repeat=4)
+        for dpr, mode, cx, cy in [
+            (None, None, None, None),
+            (2, "fit", None, None),
+            (3, "stretch", None, None),
+            (None, "crop", None, None),
+            (2, "crop", 0.0, 1.0),
+            (None, "crop", 0.3, 0.7),
+        ]
+    ]
+    requests += [
+        (1000, 500, None, 100, None, None, None, None),
+        (1000, 500, 100, None, None, "fit", None, None),
+        (1000, 500, None, None, None, None, None, None),
+        (1000, 500, 100, None, None, "stretch", None, None),
+        # dpr=0 zeroes the requested dimensions, which then are unconstrained
+        (1000, 800, 300, None, 0, None, None, None),
+        (1000, 800, 300, 200, 0, "fit", None, None),
+        (1000, 800, 300, 200, 0, "stretch", None, None),
+    ]
+    assert_plan_scale_many_matches(requests, max_pixel_ratio=2)
+    assert_plan_scale_many_matches(requests, max_pixel_ratio=None)
+
+
+def test_plan_scale_many_random():
+    rng = random.Random(1)
+    requests = []
+    for _ in range(20000):
+        mode = rng.choice([None, "fit", "crop", "stretch"])
+        width = rng.choice([None, rng.randint(1, 5000)])
+        height = rng.choice([None, rng.randint(1, 5000)])
+        if mode == "crop":
+            width = width or rng.randint(1, 5000)
+            height = height or rng.randint(1, 5000)
+        requests.append(
+            (
+                rng.randint(1, 12000),
+                rng.randint(1, 12000),
+                width,
+                height,
+                rng.choice([None, 1, 2, 3]),
+                mode,
+                rng.choice([None, 0.0, 0.5, 1.0, rng.random()]),
+                rng.choice([None, 0.0, 0.5, 1.0, rng.random()]),
+            )
+        )
+    assert_plan_scale_many_matches(requests, max_pixel_ratio=2)
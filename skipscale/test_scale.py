@@ -0,0 +1,175 @@
+import functools
+
+import pytest
+from pyvips import GValue, Image
+
+from skipscale.encoderprofiles import ENCODER_PROFILES
+from skipscale.scale import avif_supported, blocking_scale, blocking_scale_with_quality
+from skipscale.utils import vips_format_from_loader
+
+
+@functools.lru_cache
+def make_image(fmt: str, width: int, height: int, orientation: int = 1) -> bytes:
+    i = Image.black(width, height, bands=3).draw_circle(
+        [200, 40, 40], width // 2, height // 2, min(width, height) // 3, fill=True
+    )
+    if orientation != 1:
+        i = i.copy()
+        i.set_type(GValue.gint_type, "orientation", orientation)
+    return i.write_to_buffer("." + fmt)
+
+
+def legacy_geometry(content: bytes, q) -> tuple[int, int]:
+    """Output dimensions of the full-decode path that shrink-on-load replaced."""
+    i = Image.new_from_buffer(content, "")
+    i = i.autorot()
+    if q["crop"]:
+        crop_left, crop_top, crop_right, crop_bottom = q["crop"]
+        i = i.extract_area(
+            crop_left, crop_top, crop_right - crop_left, crop_bottom - crop_top
+        )
+    i = i.thumbnail_image(q["width"], height=q["height"], size="both", linear=False)
+    return i.width, i.height
+
+
+@pytest.mark.parametrize("fmt", ["jpeg", "webp", "png"])
+@pytest.mark.parametrize("orientation", [1, 6])
+@pytest.mark.parametrize(
+    "width,height,crop",
+    [
+        (300, 200, None),
+        (100, 67, None),
+        (37, 25, None),
+        (1000, 1000, None),
+        (200, 200, (420, 0, 1499, 1079)),
+        (150, 150, (0, 0, 999, 999)),
+        (61, 89, (7, 3, 619, 897)),
+        (400, 225, (0, 0, 3000, 1000)),
+    ],
+)
+def test_geometry_matches_full_decode(fmt, orientation, width, height, crop):
+    content = make_image(fmt, 3000, 2000, orientation)
+    q = {"width": width, "height": height, "crop": crop, "quality": 80, "format": "png"}
+    if crop and orientation == 6:
+        # Rotated image is 2000x3000; keep the crop inside it
+        left, top, right, bottom = crop
+        q["crop"] = (top, left, bottom, right)
+
+    output = Image.new_from_buffer(blocking_scale(content, q), "")
+    assert (output.width, output.height) == legacy_geometry(content, q)
+
+
+def test_shrink_on_load_output_formats():
+    content = make_image("jpeg", 4000, 3000)
+    for fmt in ("jpeg", "png", "webp"):
+        q = {"width": 400, "height": 300, "crop": None, "quality": 80, "format": fmt}
+        output = Image.new_from_buffer(blocking_scale(content, q), "")
+        assert (output.width, output.height) == (400, 300)
+
+
+@pytest.mark.parametrize("profile", list(ENCODER_PROFILES))
+def test_encoder_profiles(profile):
+    content = make_image("jpeg", 800, 600)
+    for fmt in ("jpeg", "png", "webp"):
+        q = {
+            "width": 400,
+            "height": 300,
+            "crop": None,
+            "quality": 80,
+            "format": fmt,
+            "profile": profile,
+        }
+        output = Image.new_from_buffer(blocking_scale(content, q), "")
+        assert (output.width, output.height) == (400, 300)
+        assert vips_format_from_loader(output) == fmt
+
+
+@pytest.mark.skipif(not avif_supported(), reason="libvips lacks AV1 encoding")
+def test_avif_output():
+    content = make_image("jpeg", 800, 600)
+    q = {"width": 400, "height": 300, "crop": None, "quality": 80, "format": "avif"}
+    output = Image.new_from_buffer(blocking_scale(content, q), "")
+    assert (output.width, output.height) == (400, 300)
+    assert vips_format_from_loader(output) == "heif"
+
+
+def make_animation(fmt: str, width: int, height: int, frames: int) -> bytes:
+    i = Image.arrayjoin(
+        [
+            Image.black(width, height, bands=3).draw_circle(
+                [200, 40, 40], width * n // frames, height // 2, height // 4, fill=True
+            )
+            for n in range(frames)
+        ],
+        across=1,
+    ).copy()
+    i.set_type(GValue.gint_type, "page-height", height)
+    i.set_type(GValue.array_int_type, "delay", [40 * (n + 1) for n in range(frames)])
+    i.set_type(GValue.gint_type, "loop", 3)
+    return i.write_to_buffer("." + fmt)
+
+
+@pytest.mark.parametrize("source", ["gif", "webp"])
+@pytest.mark.parametrize("fmt", ["gif", "webp"])
+def test_animated_output(source, fmt):
+    content = make_animation(source, 400, 300, 5)
+    q = {"width": 100, "height": 50, "crop": (0, 50, 400, 250), "quality": 80}
+    q["format"] = fmt
+    output = Image.new_from_buffer(
+        blocking_scale(content, q, animation_limits=(10, 10**7)), "", n=-1
+    )
+    assert vips_format_from_loader(output) == fmt
+    assert (output.width, output.get("page-height")) == (100, 50)
+    assert output.height == 5 * 50
+    assert output.get("delay") == [40, 80, 120, 160, 200]
+    assert output.get("loop") == 3
+
+
+@pytest.mark.parametrize(
+    "crop,size",
+    [
+        ((300, 250, 500, 400), (100, 50)),
+        # Clamped to the last pixel of the frame, then fit in 100x100
+        ((400, 300, 500, 400), (100, 100)),
+        ((-10, 900, 100, 1000), (100, 1)),
+    ],
+)
+def test_animated_crop_past_frame_edge(crop, size):
+    content = make_animation("gif", 400, 300, 5)
+    q = {"width": 100, "height": 100, "crop": crop, "quality": 80, "format": "webp"}
+    # Identical frames are merged by the encoder, check the first one
+    output = Image.new_from_buffer(
+        blocking_scale(content, q, animation_limits=(10, 10**7)), ""
+    )
+    assert (output.width, output.height) == size
+
+
+def test_animation_limits():
+    content = make_animation("gif", 400, 300, 5)
+    q = {"width": 100, "height": 75, "crop": None, "quality": 80, "format": "webp"}
+    for animation_limits in (None, (4, 10**7), (10, 400 * 300 * 4)):
+        output = Image.new_from_buffer(
+            blocking_scale(content, q, animation_limits=animation_limits), "", n=-1
+        )
+        # The first frame only
+        assert (output.width, output.height) == (100, 75)
+
+
+@pytest.mark.parametrize("fmt", ["jpeg", "webp"])
+def test_max_bytes(fmt):
+    content = Image.gaussnoise(400, 300, sigma=60).cast("uchar").jpegsave_buffer()
+    q = {"width": 200, "height": 150, "crop": None, "quality": 85, "format": fmt}
+    unbounded = blocking_scale(content, q)
+
+    max_bytes = len(unbounded) // 2
+    output, quality = blocking_scale_with_quality(content, q | {"max_bytes": max_bytes})
+    assert len(output) <= max_bytes
+    assert output == blocking_scale(content, q | {"quality": quality})
+    # Within the precision of a bounded binary search
+    assert len(blocking_scale(content, q | {"quality": quality + 2})) > max_bytes
+
+    output, quality = blocking_scale_with_quality(
+        content, q | {"max_bytes": len(unbounded)}
+    )
+    assert (output, quality) == (unbounded, 85)
+    assert blocking_scale_with_quality(content, q) == (unbounded, None)
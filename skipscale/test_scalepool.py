@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import threading
+
+import pytest
+from starlette.exceptions import HTTPException
+
+from skipscale.scalepool import ScalePool, ScaleTimings
+from skipscale.utils import SingleFlight
+
+
+def blocked(gate: threading.Event, name: str, order: list) -> str:
+    gate.wait(5)
+    order.append(name)
+    return name
+
+
+def test_round_robin_between_tenants():
+    gate = threading.Event()
+    order: list = []
+
+    async def run():
+        pool = ScalePool(workers=1)
+        jobs = [("a", f"a{n}") for n in range(4)] + [("b", "b0"), ("b", "b1")]
+        tasks = []
+        for tenant, name in jobs:
+            tasks.append(
+                asyncio.create_task(pool.run(tenant, blocked, gate, name, order))
+            )
+            await asyncio.sleep(0)
+        assert (pool.running, pool.queued) == (1, 5)
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        pool.shutdown()
+        return pool, results
+
+    pool, results = asyncio.run(run())
+    assert [result for result, _ in results] == ["a0", "a1", "a2", "a3", "b0", "b1"]
+    # a0 was already running when the others were queued
+    assert order == ["a0", "a1", "b0", "a2", "b1", "a3"]
+    assert pool.completed == 6
+    assert all(timings.queue_seconds >= 0 for _, timings in results)
+
+
+def test_queue_full():
+    gate = threading.Event()
+
+    async def run():
+        pool = ScalePool(workers=1, max_queue=1, retry_after_seconds=2)
+        running = asyncio.create_task(pool.run("a", blocked, gate, "a0", []))
+        queued = asyncio.create_task(pool.run("b", blocked, gate, "b0", []))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc_info:
+            await pool.run("c", blocked, gate, "c0", [])
+        gate.set()
+        await asyncio.gather(running, queued)
+        pool.shutdown()
+        return pool, exc_info.value
+
+    pool, exc = asyncio.run(run())
+    assert exc.status_code == 503
+    assert exc.headers == {"retry-after": "2"}
+    assert (pool.rejected, pool.completed) == (1, 2)
+
+
+def test_cancel_queued_job():
+    gate = threading.Event()
+    order: list = []
+
+    async def run():
+        pool = ScalePool(workers=1)
+        running = asyncio.create_task(pool.run("a", blocked, gate, "a0", order))
+        queued = asyncio.create_task(pool.run("a", blocked, gate, "a1", order))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.sleep(0)
+        gate.set()
+        assert (await running)[0] == "a0"
+        with pytest.raises(asyncio.CancelledError):
+            await queued
+        pool.shutdown()
+        return pool
+
+    pool = asyncio.run(run())
+    assert order == ["a0"]
+    assert (pool.completed, pool.queued, pool.running) == (1, 0, 0)
+
+
+def test_cancel_coalesced_waiters():
+    gate = threading.Event()
+    order: list = []
+
+    async def run():
+        pool = ScalePool(workers=1, max_queue=1)
+        singleflight = SingleFlight()
+        running = asyncio.create_task(pool.run("a", blocked, gate, "a0", order))
+        job = functools.partial(pool.run, "a", blocked, gate, "a1", order)
+        waiters = [asyncio.create_task(singleflight.do("a1", job)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        assert pool.queued == 1
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        # Dropped from the queue, so there is room for another job
+        assert pool.queued == 0
+        queued = asyncio.create_task(pool.run("b", blocked, gate, "b0", order))
+        await asyncio.sleep(0)
+        gate.set()
+        await asyncio.gather(running, queued)
+        pool.shutdown()
+
+    asyncio.run(run())
+    assert order == ["a0", "b0"]
+
+
+def test_shutdown_when_idle():
+    gate = threading.Event()
+
+    async def run():
+        pool = ScalePool(workers=1)
+        running = asyncio.create_task(pool.run("a", blocked, gate, "a0", []))
+        queued = asyncio.create_task(pool.run("a", blocked, gate, "a1", []))
+        await asyncio.sleep(0)
+        pool.shutdown_when_idle()
+        # Jobs accepted before are still run
+        gate.set()
+        results = await asyncio.gather(running, queued)
+        with pytest.raises(RuntimeError):
+            await pool.run("a", blocked, gate, "a2", [])
+        return results
+
+    results = asyncio.run(run())
+    assert [result for result, _ in results] == ["a0", "a1"]
+
+
+def test_server_timing():
+    timings = ScaleTimings(queue_seconds=0.0123, run_seconds=0.4567)
+    assert timings.server_timing() == "scale-queue;dur=12.3, scale-run;dur=456.7"
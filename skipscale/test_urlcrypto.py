@@ -0,0 +1,53 @@
+import pytest
+
+from skipscale.lrucache import LRUCache
+from skipscale.urlcrypto import decrypt_url, decrypt_url_cached, encrypt_url
+
+KEY = bytes.fromhex("01234567890123456789012345678901")
+URL = "https://storage.example.com/images/a.jpg"
+
+
+def test_round_trip():
+    ciphertext = encrypt_url(KEY, "t", URL)
+    assert decrypt_url(KEY, "t", ciphertext) == URL
+    with pytest.raises(ValueError):
+        decrypt_url(KEY, "other", ciphertext)
+
+
+def test_decrypt_url_cached():
+    cache = LRUCache(10)
+    ciphertext = encrypt_url(KEY, "t", URL)
+    assert decrypt_url_cached(cache, KEY, "t", ciphertext) == URL
+    assert decrypt_url_cached(cache, KEY, "t", ciphertext) == URL
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # The tenant is authenticated, so a cached URL is not returned for another one
+    with pytest.raises(ValueError):
+        decrypt_url_cached(cache, KEY, "other", ciphertext)
+
+    tampered = ciphertext[:-2] + ("A" if ciphertext[-2] != "A" else "B") + "A"
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            decrypt_url_cached(cache, KEY, "t", tampered)
+    # Failures are only cached in an invalid_cache
+    assert cache.hits == 1
+    assert len(cache) == 1
+
+
+def test_decrypt_url_cached_invalid():
+    cache, invalid_cache = LRUCache(2), LRUCache(10)
+    ciphertext = encrypt_url(KEY, "t", URL)
+    decrypt_url_cached(cache, KEY, "t", ciphertext, invalid_cache)
+
+    tampered = [f"{n:04d}" + ciphertext[4:] for n in range(20)]
+    for _ in range(2):
+        for invalid in tampered[:5]:
+            with pytest.raises(ValueError):
+                decrypt_url_cached(cache, KEY, "t", invalid, invalid_cache)
+    assert invalid_cache.hits == 5
+    # A flood of invalid ciphertexts doesn't push out the valid ones
+    for invalid in tampered:
+        with pytest.raises(ValueError):
+            decrypt_url_cached(cache, KEY, "t", invalid, invalid_cache)
+    assert len(invalid_cache) == 10
+    assert cache.get((KEY, "t", ciphertext)) == URL
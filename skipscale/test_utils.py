@@ -0,0 +1,164 @@
+import asyncio
+
+import httpx
+import pytest
+
+from skipscale.utils import (
+    ParsedCacheControl,
+    SingleFlight,
+    cache_headers,
+    parse_cache_control,
+)
+
+
+def test_parsed_cache_control():
+    cc = ParsedCacheControl("public, max-age=60.5, must-revalidate, foo=bar")
+    assert cc.is_present
+    assert cc.storage == "public"
+    assert cc.max_age == 60
+    assert str(cc) == "public, max-age=60, must-revalidate, foo=bar"
+    assert str(ParsedCacheControl("max-age=60, immutable")) == "immutable"
+    assert not ParsedCacheControl(None).is_present
+    assert parse_cache_control("max-age=60") is parse_cache_control("max-age=60")
+
+
+def test_merge_does_not_modify():
+    received = parse_cache_control("max-age=60, stale-if-error=3600")
+    minimum = parse_cache_control("public, max-age=600, stale-if-error=60")
+    merged = received.merge(minimum)
+    assert str(merged) == "public, max-age=600, stale-if-error=3600"
+    assert str(received) == "max-age=60, stale-if-error=3600"
+    assert str(minimum) == "public, max-age=600, stale-if-error=60"
+    assert parse_cache_control(None).merge(minimum) is minimum
+
+
+def test_cache_headers_minimum():
+    minimum = ParsedCacheControl("public, max-age=600")
+    r = httpx.Response(200, headers={"cache-control": "max-age=60", "etag": '"1"'})
+    for _ in range(2):
+        assert cache_headers(None, minimum, False, r) == {
+            "etag": '"1"',
+            "cache-control": "public, max-age=600",
+        }
+    assert cache_headers(None, "public, max-age=30", False, r) == {
+        "etag": '"1"',
+        "cache-control": "public, max-age=60",
+    }
+    assert cache_headers("no-store", minimum, True, r) == {
+        "etag": '"1"',
+        "cache-control": "no-store",
+        "access-control-allow-origin": "*",
+    }
+
+
+def test_singleflight_coalesces():
+    calls = []
+
+    def fetch(key):
+        async def call():
+            calls.append(key)
+            result = f"{key}{len(calls)}"
+            await asyncio.sleep(0.01)
+            return result
+
+        return call
+
+    async def run():
+        singleflight = SingleFlight()
+        results = await asyncio.gather(
+            *(singleflight.do("a", fetch("a")) for _ in range(3)),
+            singleflight.do("b", fetch("b")),
+        )
+        # Not in flight anymore, so called again
+        results.append(await singleflight.do("a", fetch("a")))
+        return singleflight, results
+
+    singleflight, results = asyncio.run(run())
+    assert results == ["a1", "a1", "a1", "b2", "a3"]
+    assert calls == ["a", "b", "a"]
+    assert (singleflight.calls, singleflight.coalesced) == (3, 2)
+
+
+def test_singleflight_exception():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream")
+
+    async def run():
+        singleflight = SingleFlight()
+        return await asyncio.gather(
+            *(singleflight.do("a", fail) for _ in range(3)), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_singleflight_first_caller_cancelled():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        singleflight = SingleFlight()
+        first = asyncio.create_task(singleflight.do("a", fetch))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(singleflight.do("a", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "result"
+    assert calls == 1
+
+
+def test_singleflight_all_callers_cancelled():
+    cancelled = False
+
+    async def fetch():
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    async def run():
+        singleflight = SingleFlight()
+        waiters = [asyncio.create_task(singleflight.do("a", fetch)) for _ in range(2)]
+        await asyncio.sleep(0)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+        return singleflight
+
+    singleflight = asyncio.run(run())
+    assert cancelled
+    assert not singleflight._calls and not singleflight._waiters
+
+
+def test_singleflight_disabled():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def run():
+        singleflight = SingleFlight(enabled=False)
+        results = await asyncio.gather(*(singleflight.do("a", fetch) for _ in range(3)))
+        return singleflight, results
+
+    singleflight, results = asyncio.run(run())
+    assert sorted(results) == [3, 3, 3]
+    assert calls == 3
+    assert (singleflight.calls, singleflight.coalesced) == (0, 0)
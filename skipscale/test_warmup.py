@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.exceptions import HTTPException
+
+from skipscale.warmup import Warmup
+
+
+def test_warmup():
+    requested = []
+    in_flight = 0
+    max_in_flight = 0
+
+    async def handler(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        requested.append(str(request.url))
+        if request.url.path == "/missing":
+            return httpx.Response(404)
+        return httpx.Response(200, stream=httpx.ByteStream(b"image"))
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        warmup = Warmup(client, concurrency=2, max_queue=10)
+        urls = [f"http://cache/{n}" for n in range(5)]
+        first = warmup.enqueue("t", urls + ["http://cache/missing"], "t")
+        # Already queued, so not requested again
+        second = warmup.enqueue("t", urls[:2], "t")
+        assert second.progress()["deduplicated"] == 2
+        assert warmup.batch(first.id) is first
+
+        while warmup.queued or warmup.running:
+            await asyncio.sleep(0.01)
+        await client.aclose()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first.progress() == {
+        "id": first.id,
+        "total": 6,
+        "pending": 0,
+        "done": 5,
+        "failed": 1,
+        "deduplicated": 0,
+    }
+    assert second.progress()["pending"] == 0
+    assert len(requested) == 6
+    assert max_in_flight == 2
+
+
+def test_warmup_queue_full():
+    async def run():
+        client = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200))
+        )
+        warmup = Warmup(client, concurrency=1, max_queue=2)
+        with pytest.raises(HTTPException) as exc_info:
+            warmup.enqueue(
+                "t", ["http://cache/1", "http://cache/2", "http://cache/3"], "t"
+            )
+        assert exc_info.value.status_code == 503
+        warmup.shutdown()
+        await client.aclose()
+
+    asyncio.run(run())
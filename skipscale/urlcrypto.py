@@ -1,9 +1,17 @@
 import base64
+from typing import Optional
 from urllib.parse import quote
 
 from Cryptodome.Cipher import AES, _mode_gcm
 from Cryptodome.Hash import SHA1
 
+from skipscale.lrucache import LRUCache
+
+# Invalid ciphertexts are remembered in a cache of their own, so that a flood of
+# them can't push out valid ones, and for a shorter time.
+INVALID_CACHE_ENTRIES = 1000
+INVALID_TTL_SECONDS = 60
+
 
 def encrypt_url(key: bytes, tenant: str, url: str) -> str:
     # strip 'https://' from urls to save space
@@ -45,3 +53,31 @@ def decrypt_url(key: bytes, tenant: str, ciphertext: str) -> str:
     if not url.startswith("https://") and not url.startswith("http://"):
         return "https://" + url
     return url
+
+
+def decrypt_url_cached(
+    cache: LRUCache,
+    key: bytes,
+    tenant: str,
+    ciphertext: str,
+    invalid_cache: Optional[LRUCache] = None,
+) -> str:
+    """decrypt_url with the results kept in cache, and failures in invalid_cache if
+    given. Raises ValueError for invalid ciphertexts, also when the failure was
+    cached."""
+
+    cache_key = (key, tenant, ciphertext)
+    url = cache.get(cache_key)
+    if url is not None:
+        return url
+    if invalid_cache is not None and invalid_cache.get(cache_key) is not None:
+        raise ValueError("invalid ciphertext (cached)")
+
+    try:
+        url = decrypt_url(key, tenant, ciphertext)
+    except Exception:
+        if invalid_cache is not None:
+            invalid_cache.set(cache_key, True, INVALID_TTL_SECONDS)
+        raise ValueError("invalid ciphertext")
+    cache.set(cache_key, url)
+    return url
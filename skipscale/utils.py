@@ -1,15 +1,30 @@
 """Miscellaneous utility functions."""
 
+import asyncio
+import functools
 import logging
-import copy
+import time
+from email.utils import parsedate_to_datetime
 from urllib.parse import urljoin, urlencode
-from typing import Optional, Union, Dict, List, Tuple
-
-from httpx import AsyncClient, RequestError, TimeoutException
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+    Union,
+    Dict,
+    List,
+    Tuple,
+)
+
+from httpx import RequestError, TimeoutException
 import sentry_sdk
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
 
+from skipscale import metrics
+
 
 def get_logger(*components) -> logging.Logger:
     """Get a logger under the app's hierarchy."""
@@ -31,17 +46,75 @@ def cache_url(
     return url
 
 
+class SingleFlight:
+    """Coalesces concurrent calls with the same key: while a call is in flight,
+    callers with the same key wait for it and get its result (or exception)
+    instead of starting their own.
+
+    The call runs in its own task, so it is not cancelled if the caller that
+    started it goes away while others are still waiting. It is cancelled when
+    the last caller waiting for it goes away."""
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        # Number of callers waiting for each call
+        self._waiters: Dict[asyncio.Future, int] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(
+        self, key: Hashable, fn: Callable[[], Awaitable[Any]], kind: str = "upstream"
+    ) -> Any:
+        """kind labels the call in metrics."""
+
+        if not self.enabled:
+            return await fn()
+
+        call = self._calls.get(key)
+        if call is None:
+            self.calls += 1
+            metrics.SINGLEFLIGHT_CALLS.labels(kind, "started").inc()
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+            metrics.SINGLEFLIGHT_CALLS.labels(kind, "coalesced").inc()
+
+        self._waiters[call] = self._waiters.get(call, 0) + 1
+        try:
+            return await asyncio.shield(call)
+        finally:
+            self._waiters[call] -= 1
+            if not self._waiters[call]:
+                del self._waiters[call]
+                if not call.done():
+                    # Nobody is waiting for the result anymore
+                    call.cancel()
+
+    def _done(self, key: Hashable, call: asyncio.Future) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # Mark the exception retrieved in case every waiter was cancelled
+        if not call.cancelled():
+            call.exception()
+
+
 async def make_request(
     incoming_request: Request,
     outgoing_request_url: str,
     stream=False,
     method="GET",
-    proxy: Optional[str] = None,
+    origin_tenant: Optional[str] = None,
     follow_redirects=False,
+    headers: Optional[Dict[str, str]] = None,
+    forward_conditional_headers=True,
 ):
     log = get_logger("utils", "make_request")
 
-    outgoing_request_headers = {}
+    outgoing_request_headers = dict(headers) if headers else {}
 
     def fwd_header(name, do_log=False) -> None:
         if name in incoming_request.headers:
@@ -51,40 +124,68 @@ async def make_request(
                     "forwarding downstream %s: %s", name, outgoing_request_headers[name]
                 )
 
-    fwd_header("if-modified-since")
-    fwd_header("if-none-match")
+    if forward_conditional_headers:
+        fwd_header("if-modified-since")
+        fwd_header("if-none-match")
     fwd_header("origin", do_log=True)
     fwd_header("access-control-request-method")
     fwd_header("access-control-request-headers")
 
-    close_client = False
-    client = incoming_request.app.state.httpx_client
-
-    # httpx proxy settings are per-client, if one is set we need to create a new one
-    # instead of using the global instance. This assumes that proxy usage is limited
-    # to test/QA feeds.
-    if proxy:
-        close_client = True
-        client = AsyncClient(timeout=client.timeout, proxies=proxy)
-        log.debug("fetching %s through proxy", outgoing_request_url)
+    # Requests to an origin use the tenant's connection pool (and proxy), others
+    # are recursive requests through the cache endpoint.
+    if origin_tenant is not None:
+        client = incoming_request.app.state.http_clients.for_tenant(origin_tenant)
+    else:
+        client = incoming_request.app.state.http_clients.internal
 
     req = client.build_request(
         method, outgoing_request_url, headers=outgoing_request_headers
     )
-    try:
+    upstream = "origin" if origin_tenant is not None else "cache_endpoint"
+    metrics_tenant = metrics.tenant_label(
+        incoming_request.app.state.config,
+        origin_tenant or incoming_request.path_params.get("tenant", ""),
+    )
+
+    async def send():
+        started = time.perf_counter()
         r = await client.send(req, stream=stream, follow_redirects=follow_redirects)
+        metrics.UPSTREAM_SECONDS.labels(upstream, metrics_tenant).observe(
+            time.perf_counter() - started
+        )
+        if not stream:
+            metrics.UPSTREAM_BYTES.labels(upstream, metrics_tenant).inc(len(r.content))
+        elif "content-length" in r.headers:
+            metrics.UPSTREAM_BYTES.labels(upstream, metrics_tenant).inc(
+                int(r.headers["content-length"])
+            )
+        return r
+
+    try:
+        if stream:
+            r = await send()
+        else:
+            # Identical concurrent requests share one upstream request and response.
+            singleflight: SingleFlight = incoming_request.app.state.singleflight
+            key = (
+                method,
+                outgoing_request_url,
+                origin_tenant,
+                follow_redirects,
+                tuple(sorted(outgoing_request_headers.items())),
+            )
+            r = await singleflight.do(key, send)
     except TimeoutException:
         raise HTTPException(status_code=504, detail="Timeout while fetching image")
     except RequestError:
         raise HTTPException(status_code=502, detail="Error while fetching image")
-    finally:
-        if close_client:
-            await client.aclose()
 
     if r.is_error:
+        if stream:
+            await r.aclose()
         raise HTTPException(r.status_code)
 
-    if method == "GET" and r.status_code != 304 and not r.content:
+    if not stream and method == "GET" and r.status_code != 304 and not r.content:
         # No error, but we got no response body.
         sentry_sdk.set_context(
             "outbound_request",
@@ -101,40 +202,45 @@ async def make_request(
 
 # Shortcut for the most common type of cache_headers invocation
 def cache_headers_with_config(config, tenant: str, received_response) -> Dict[str, str]:
+    tenant_config = config.tenant(tenant)
     return cache_headers(
-        config.cache_control_override(tenant),
-        config.cache_control_minimum(tenant),
-        config.allow_cors(tenant),
+        tenant_config.cache_control_override,
+        tenant_config.parsed_cache_control_minimum,
+        tenant_config.allow_cors,
         received_response,
     )
 
 
 def cache_headers(
     cache_control_override: Optional[str],
-    cache_control_minimum: Optional[str],
+    cache_control_minimum: Union[str, "ParsedCacheControl", None],
     force_cors: bool,
     received_response,
 ) -> Dict[str, str]:
+    # Each lookup in httpx.Headers scans all headers, so look each one up once
+    received_headers = received_response.headers
     output_headers: Dict[str, str] = {}
-    if "last-modified" in received_response.headers:
-        output_headers["last-modified"] = received_response.headers["last-modified"]
-    if "etag" in received_response.headers:
-        output_headers["etag"] = received_response.headers["etag"]
+    last_modified = received_headers.get("last-modified")
+    if last_modified is not None:
+        output_headers["last-modified"] = last_modified
+    etag = received_headers.get("etag")
+    if etag is not None:
+        output_headers["etag"] = etag
     if cache_control_override:
         output_headers["cache-control"] = cache_control_override
     elif cache_control_minimum:
-        received_cc = ParsedCacheControl(received_response.headers.get("cache-control"))
-        reference_cc = ParsedCacheControl(cache_control_minimum)
-        new_cc = str(received_cc.merge(reference_cc))
+        if not isinstance(cache_control_minimum, ParsedCacheControl):
+            cache_control_minimum = parse_cache_control(cache_control_minimum)
+        new_cc = merged_cache_control(
+            received_headers.get("cache-control"), cache_control_minimum
+        )
         if new_cc:
             output_headers["cache-control"] = new_cc
     else:
-        if "cache-control" in received_response.headers:
-            output_headers["cache-control"] = received_response.headers["cache-control"]
-        if "expires" in received_response.headers:
-            output_headers["expires"] = received_response.headers["expires"]
-        if "pragma" in received_response.headers:
-            output_headers["pragma"] = received_response.headers["pragma"]
+        for name in ("cache-control", "expires", "pragma"):
+            value = received_headers.get(name)
+            if value is not None:
+                output_headers[name] = value
 
     allow_cors = should_allow_cors(force_cors, received_response)
     if allow_cors:
@@ -151,19 +257,49 @@ def cache_headers(
     return output_headers
 
 
-def should_allow_cors(force_flag: bool, upstream_response) -> Union[dict, bool]:
-    log = get_logger("utils", "should_allow_cors")
+def is_not_modified(request_headers, response_headers) -> bool:
+    """Evaluate the conditional headers of a request against a response we have
+    locally, as a cache would."""
+
+    if "if-none-match" in request_headers:
+        etag = response_headers.get("etag")
+        if etag is None:
+            return False
+        wanted = [t.strip() for t in request_headers["if-none-match"].split(",")]
+        # Weak comparison
+        return "*" in wanted or etag.removeprefix("W/") in (
+            t.removeprefix("W/") for t in wanted
+        )
 
+    if "if-modified-since" in request_headers:
+        last_modified = response_headers.get("last-modified")
+        if last_modified is None:
+            return False
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(
+                request_headers["if-modified-since"]
+            )
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+cors_log = get_logger("utils", "should_allow_cors")
+
+
+def should_allow_cors(force_flag: bool, upstream_response) -> Union[dict, bool]:
     # If force is set in configuration, always return ACAO=*
     if force_flag:
         return True
 
     # Check if upstream returned ACAO and pass it on if it did
-    if (
-        upstream_response is not None
-        and "access-control-allow-origin" in upstream_response.headers
-    ):
-        acao = upstream_response.headers["access-control-allow-origin"]
+    acao = (
+        upstream_response.headers.get("access-control-allow-origin")
+        if upstream_response is not None
+        else None
+    )
+    if acao is not None:
         addl_headers: Dict[str, str] = {"access-control-allow-origin": acao}
 
         if "access-control-allow-method" in upstream_response.headers:
@@ -175,12 +311,26 @@ def should_allow_cors(force_flag: bool, upstream_response) -> Union[dict, bool]:
                 "access-control-allow-headers"
             ]
 
-        log.debug("forwarding upstream ACAO: %s", acao)
+        cors_log.debug("forwarding upstream ACAO: %s", acao)
         return acao
 
     return False
 
 
+def cache_control_ttl(header: Optional[str]) -> int:
+    """Returns the time in seconds a response with the given Cache-Control header
+    may be reused by a shared cache, 0 if it may not be stored."""
+
+    parsed = ParsedCacheControl(header)
+    if parsed.storage in ("private", "no-cache", "no-store"):
+        return 0
+    if parsed.s_maxage is not None:
+        return parsed.s_maxage
+    if parsed.max_age is not None:
+        return parsed.max_age
+    return 0
+
+
 def is_safe_path(path: str) -> bool:
     """Checks whether the given path attempts traversal with /. Returns True
     if path is safe, False otherwise."""
@@ -229,8 +379,24 @@ def extract_forwardable_params(
     return q_params, result
 
 
+cache_control_log = get_logger("utils", "ParsedCacheControl")
+
+
 class ParsedCacheControl:
-    """A parsed representation of a Cache-Control header."""
+    """A parsed representation of a Cache-Control header.
+
+    Instances returned by `parse_cache_control` are shared, so they are not
+    modified after parsing; `merge` returns a new instance."""
+
+    __slots__ = (
+        "is_present",
+        "storage",
+        "max_age",
+        "s_maxage",
+        "stale_error",
+        "stale_revalidate",
+        "other",
+    )
 
     def __init__(self, header: Optional[str]) -> None:
         self.is_present = False
@@ -240,9 +406,7 @@ class ParsedCacheControl:
         self.s_maxage: Optional[int] = None
         self.stale_error: Optional[int] = None
         self.stale_revalidate: Optional[int] = None
-        self.other: List[Tuple[str, Optional[str]]] = []
-
-        self._log = get_logger("utils", "ParsedCacheControl")
+        self.other: Tuple[Tuple[str, Optional[str]], ...] = ()
 
         if header is None:
             return
@@ -250,7 +414,9 @@ class ParsedCacheControl:
         try:
             self._parse_header(header)
         except Exception:
-            self._log.exception("failed to parse Cache-Control header %r", header)
+            cache_control_log.exception(
+                "failed to parse Cache-Control header %r", header
+            )
 
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} present={self.is_present} header={str(self)!r}>"
@@ -282,7 +448,7 @@ class ParsedCacheControl:
                 comps.append(other_key)
                 continue
 
-            comps.append("f{other_key}={other_value}")
+            comps.append(f"{other_key}={other_value}")
 
         return ", ".join(comps)
 
@@ -318,6 +484,7 @@ class ParsedCacheControl:
             except (TypeError, ValueError):
                 return None
 
+        other = []
         for comp in header.split(","):
             comp = comp.strip()
             if not comp:
@@ -345,14 +512,18 @@ class ParsedCacheControl:
                 self.max_age = self.IMMUTABLE_AGE
                 self.s_maxage = None
             else:
-                self.other.append((comp, value))
+                other.append((comp, value))
+        self.other = tuple(other)
 
     def copy(self) -> "ParsedCacheControl":
-        return copy.deepcopy(self)
+        result = ParsedCacheControl.__new__(ParsedCacheControl)
+        for key in self.__slots__:
+            setattr(result, key, getattr(self, key))
+        return result
 
     def merge(self, other: "ParsedCacheControl") -> "ParsedCacheControl":
-        """Merge max-age values from `other` to this instance if they are
-        longer than in this one."""
+        """A copy of this instance with the max-age values from `other` where
+        they are longer than in this one."""
 
         if not self.is_present:
             return other
@@ -369,21 +540,50 @@ class ParsedCacheControl:
 
             return a < b  # type: ignore
 
+        result = self.copy()
+
         def merge_field(key):
             a = getattr(self, key)
             b = getattr(other, key)
             if safe_le(a, b):
-                setattr(self, key, b)
+                setattr(result, key, b)
 
         merge_field("max_age")
         merge_field("s_maxage")
         merge_field("stale_revalidate")
         merge_field("stale_error")
 
-        if self.storage is None:
-            self.storage = other.storage
+        if result.storage is None:
+            result.storage = other.storage
+
+        return result
+
 
-        return self
+@functools.lru_cache(maxsize=1024)
+def parse_cache_control(header: Optional[str]) -> ParsedCacheControl:
+    """Memoized ParsedCacheControl for header values repeated across responses.
+    The result is shared and must not be modified."""
+    return ParsedCacheControl(header)
+
+
+@functools.lru_cache(maxsize=1024)
+def merged_cache_control(received: Optional[str], minimum: ParsedCacheControl) -> str:
+    """The received Cache-Control header raised to at least `minimum`. Keyed by
+    the identity of `minimum`, which is parsed once per tenant."""
+    return str(parse_cache_control(received).merge(minimum))
+
+
+def content_range_total(content_range: Optional[str]) -> Optional[int]:
+    """Returns the complete length from a Content-Range header such as
+    "bytes 0-4095/123456", or None if it is missing or unknown."""
+
+    if not content_range:
+        return None
+    _, _, total = content_range.rpartition("/")
+    try:
+        return int(total)
+    except ValueError:
+        return None
 
 
 def vips_format_from_loader(img) -> str:
@@ -53,7 +53,7 @@ async def visionrecognizer(request: Request):
         "Authorization": "Bearer " + visionrecognizer_bearer_token
     }
 
-    client: AsyncClient = request.app.state.httpx_client
+    client: AsyncClient = request.app.state.http_clients.default
     req = client.build_request(
         "GET", outgoing_request_url, headers=outgoing_request_headers
     )
@@ -0,0 +1,225 @@
+"""Cache warming: requests planner URLs through the cache endpoint in the
+background, so that the caching proxy has the scaled images before readers ask
+for them."""
+
+import asyncio
+import collections
+import uuid
+from dataclasses import dataclass
+from typing import Any, Deque, Iterable, Set
+from urllib.parse import parse_qsl, urlsplit
+
+import httpx
+from schema import Schema, And, SchemaError
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from skipscale import metrics
+from skipscale.config import Config
+from skipscale.encrypt import authenticate
+from skipscale.lrucache import LRUCache
+from skipscale.planner import validate_query
+from skipscale.utils import cache_url, extract_forwardable_params, get_logger
+
+log = get_logger(__name__)
+
+# Batches whose progress can be looked up, per worker process
+MAX_BATCHES = 1000
+
+post_schema = Schema(
+    {
+        "uris": [And(str, len)],
+        "variants": And({str: {str: And(object, lambda v: v is not None)}}, len),
+    }
+)
+
+
+@dataclass
+class WarmupBatch:
+    id: str
+    tenant: str
+    total: int
+    done: int = 0
+    failed: int = 0
+    deduplicated: int = 0
+
+    def progress(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "total": self.total,
+            "pending": self.total - self.done - self.failed - self.deduplicated,
+            "done": self.done,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+        }
+
+
+@dataclass(frozen=True)
+class _Job:
+    url: str
+    batch: WarmupBatch
+    metrics_tenant: str
+
+
+class Warmup:
+    """Queue of URLs to request through the cache endpoint, at most `concurrency`
+    at a time. URLs that are already queued or being requested are not queued
+    again. If `max_queue` URLs are waiting, new batches are rejected with a 503."""
+
+    def __init__(
+        self, client: httpx.AsyncClient, concurrency: int = 4, max_queue: int = 10000
+    ) -> None:
+        self._client = client
+        self._concurrency = concurrency
+        self._max_queue = max_queue
+
+        self._queue: Deque[_Job] = collections.deque()
+        self._pending_urls: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._batches = LRUCache(MAX_BATCHES)
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def enqueue(
+        self, tenant: str, urls: Iterable[str], metrics_tenant: str
+    ) -> WarmupBatch:
+        urls = list(urls)
+        if self._max_queue and len(self._queue) + len(urls) > self._max_queue:
+            raise HTTPException(503, "Warmup queue full")
+
+        batch = WarmupBatch(id=uuid.uuid4().hex, tenant=tenant, total=len(urls))
+        self._batches.set(batch.id, batch)
+        for url in urls:
+            if url in self._pending_urls:
+                batch.deduplicated += 1
+                metrics.WARMUP_REQUESTS.labels(metrics_tenant, "deduplicated").inc()
+                continue
+            self._pending_urls.add(url)
+            self._queue.append(_Job(url, batch, metrics_tenant))
+
+        self._dispatch()
+        return batch
+
+    def batch(self, batch_id: str) -> WarmupBatch | None:
+        return self._batches.get(batch_id)
+
+    def _dispatch(self) -> None:
+        while len(self._tasks) < self._concurrency and self._queue:
+            task = asyncio.create_task(self._run(self._queue.popleft()))
+            self._tasks.add(task)
+            task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._dispatch()
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            # Redirects are followed through the cache endpoint, so that both the
+            # planner redirect and the scaled image are cached.
+            async with self._client.stream("GET", job.url, follow_redirects=True) as r:
+                async for _ in r.aiter_raw():
+                    pass
+            ok = not r.is_error
+            if not ok:
+                log.info("warmup request %s failed with %d", job.url, r.status_code)
+        except httpx.HTTPError as exc:
+            log.info("warmup request %s failed: %r", job.url, exc)
+            ok = False
+        except Exception:
+            log.exception("warmup request %s failed", job.url)
+            ok = False
+        finally:
+            self._pending_urls.discard(job.url)
+
+        if ok:
+            job.batch.done += 1
+        else:
+            job.batch.failed += 1
+        metrics.WARMUP_REQUESTS.labels(
+            job.metrics_tenant, "done" if ok else "failed"
+        ).inc()
+
+    def reconfigure(
+        self, client: httpx.AsyncClient, concurrency: int, max_queue: int
+    ) -> None:
+        """Apply reloaded settings. Requests in flight finish with the old client."""
+        self._client = client
+        self._concurrency = concurrency
+        self._max_queue = max_queue
+        self._dispatch()
+
+    def shutdown(self) -> None:
+        self._queue.clear()
+        for task in self._tasks:
+            task.cancel()
+
+
+async def warmup(request: Request):
+    """Queue planner requests for each image and variant."""
+
+    tenant = request.path_params["tenant"]
+    if not authenticate(request, tenant):
+        raise HTTPException(401)
+    try:
+        raw_body = await request.json()
+        body = post_schema.validate(raw_body)
+    except SchemaError as exc:
+        log.warning("warmup request validation failed: %s", exc)
+        raise HTTPException(400, detail="Validation failed")
+    except Exception:
+        log.exception("warmup request parsing failed")
+        raise HTTPException(400, detail="Parsing failed")
+
+    variants: list[dict[str, str]] = []
+    for name, params in body["variants"].items():
+        params = {k: str(v) for k, v in params.items()}
+        try:
+            q = validate_query(params)
+        except HTTPException as exc:
+            raise HTTPException(400, detail=f"variant {name}: {exc.detail}")
+        if q.get("format") == "auto":
+            raise HTTPException(400, detail=f"variant {name}: format=auto")
+        variants.append(params)
+
+    config: Config = request.app.state.config
+    urls = []
+    for uri in body["uris"]:
+        parts = urlsplit(uri)
+        _, fwd_q = extract_forwardable_params(dict(parse_qsl(parts.query)))
+        for params in variants:
+            urls.append(
+                cache_url(
+                    config.cache_endpoint(),
+                    config.app_path_prefixes(),
+                    None,
+                    tenant,
+                    parts.path.lstrip("/"),
+                    params | fwd_q,
+                )
+            )
+
+    batch = request.app.state.warmup.enqueue(
+        tenant, urls, metrics.tenant_label(config, tenant)
+    )
+    return JSONResponse(batch.progress(), status_code=202)
+
+
+async def warmup_status(request: Request):
+    """Progress of a batch queued in this worker process."""
+
+    tenant = request.path_params["tenant"]
+    if not authenticate(request, tenant):
+        raise HTTPException(401)
+
+    batch = request.app.state.warmup.batch(request.path_params["batch_id"])
+    if batch is None or batch.tenant != tenant:
+        raise HTTPException(404)
+    return JSONResponse(batch.progress())